@@ -0,0 +1,70 @@
+"""Upload throughput of `streaming_bulk` and the parallel adaptive loader.
+
+Synthetic `movies` documents are uploaded to a scratch index created with
+the `movies` schema and deleted afterwards. Requires the ElasticSearch
+configured by `ELASTIC_*` environment variables.
+
+Usage (from the `etl` directory):
+    python -m benchmarks.bulk_loader --films 5000 --threads 1 4 8
+"""
+import argparse
+import os
+import time
+from typing import Any
+
+from benchmarks.common import memory_state
+from benchmarks.synthetic import merged_film_rows
+from etl_utils.elastic_search_handlers import (
+    ElasticSearchFilmTransformer,
+    ElasticSearchLoader,
+)
+
+
+def run(
+    documents: list[dict[str, Any]], batch_size: int, threads: int
+) -> None:
+    loader = ElasticSearchLoader(batch_size, 'movies', bulk_threads=threads)
+    scratch = f'benchmark_movies_{os.getpid()}_{threads}'
+    mappings, settings = loader.index_schema()
+    loader.es_client.indices.create(
+        index=scratch, mappings=mappings, settings=settings
+    )
+    loader.write_index = scratch
+    loader.index_exists = True
+    # Failures of the scratch index raise instead of going to the store.
+    loader.dead_letters = None
+    try:
+        started = time.perf_counter()
+        loader.upload(document for document in documents)
+        elapsed = time.perf_counter() - started
+    finally:
+        loader.es_client.indices.delete(index=scratch)
+    mode = 'streaming_bulk' if threads == 1 else f'parallel x{threads}'
+    details = ''
+    if loader.bulk_uploader:
+        details = (
+            f'{loader.stats.bytes_per_second / 2**20:>8.2f} MiB/s  '
+            f'final chunk {loader.bulk_uploader.chunk_size.value}'
+        )
+    print(f'{mode:<16} {len(documents) / elapsed:>10,.0f} docs/s {details}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--films', type=int, default=5000)
+    parser.add_argument('--persons', type=int, default=40, help='per film')
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+
+    documents = list(
+        ElasticSearchFilmTransformer(memory_state()).transform(
+            list(merged_film_rows(args.films, args.persons, 3))
+        )
+    )
+    for threads in args.threads:
+        run(documents, args.batch_size, threads)
+
+
+if __name__ == '__main__':
+    main()
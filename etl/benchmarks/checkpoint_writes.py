@@ -0,0 +1,78 @@
+"""Cost of checkpoint writes with `RedisStorage` and coalesced `RedisHashStorage`.
+
+Every update moves a producer checkpoint, like one produced batch. Keys
+`benchmark_checkpoints*` are written to the Redis configured by `REDIS_*`
+environment variables and deleted afterwards.
+
+Usage (from the `etl` directory):
+    python -m benchmarks.checkpoint_writes --updates 5000 --flush-every 10
+"""
+import argparse
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from config import REDIS_HOST, REDIS_PORT
+from redis import Redis
+
+from etl_utils.state import (
+    BaseStorage,
+    RedisHashStorage,
+    RedisStorage,
+    State,
+    StatefulMixin,
+)
+
+
+def measure(storage: BaseStorage, updates: int, flush_every: int) -> float:
+    """Returns checkpoint updates per second."""
+    state = State(storage, flush_every=flush_every)
+    # Other keys of a pipeline state, rewritten with every blob save.
+    for name in ('enricher', 'films', 'genres', 'persons'):
+        StatefulMixin(state, f'{name}_last_modified')
+    producer = StatefulMixin(state, 'producer_last_modified')
+    started_at = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    started = time.perf_counter()
+    for i in range(updates):
+        producer.set_last_modified(
+            started_at + timedelta(seconds=i), str(uuid.uuid4())
+        )
+    state.flush()
+    return updates / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--flush-every', type=int, default=10)
+    args = parser.parse_args()
+
+    redis = Redis(REDIS_HOST, REDIS_PORT)
+    modes = {
+        'json blob, every update': (
+            RedisStorage(redis, 'benchmark_checkpoints'),
+            1,
+        ),
+        'hash fields, every update': (
+            RedisHashStorage(redis, 'benchmark_checkpoints:hash'),
+            1,
+        ),
+        f'hash fields, every {args.flush_every}': (
+            RedisHashStorage(redis, 'benchmark_checkpoints:coalesced'),
+            args.flush_every,
+        ),
+    }
+    try:
+        for name, (storage, flush_every) in modes.items():
+            rate = measure(storage, args.updates, flush_every)
+            print(f'{name:<28} {rate:>12,.0f} updates/s')
+    finally:
+        redis.delete(
+            'benchmark_checkpoints',
+            'benchmark_checkpoints:hash',
+            'benchmark_checkpoints:coalesced',
+        )
+
+
+if __name__ == '__main__':
+    main()
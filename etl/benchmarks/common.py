@@ -0,0 +1,16 @@
+import resource
+import sys
+
+from etl_utils.state import MemoryStorage, State
+
+
+def memory_state() -> State:
+    """State of a benchmark run, which never touches real checkpoints."""
+    return State(MemoryStorage())
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the current process in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere.
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
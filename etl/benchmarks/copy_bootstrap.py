@@ -0,0 +1,131 @@
+"""Cold start extraction through keyset pages and through `COPY ... TO STDOUT`.
+
+Every mode extracts and transforms all the documents of an index from an
+empty checkpoint; nothing is uploaded. Film documents of both paths are
+checked to be equal. Requires the Postgres configured by `POSTGRES_*`
+environment variables.
+
+Usage (from the `etl` directory):
+    python -m benchmarks.copy_bootstrap --batch-size 128 --repeat 3
+"""
+import argparse
+import time
+from collections.abc import Callable, Iterable
+from typing import Any
+
+from psycopg2.extras import DictRow
+
+from benchmarks.common import memory_state
+from etl_utils.elastic_search_handlers import (
+    ElasticSearchAggregatedFilmTransformer,
+    ElasticSearchFilmTransformer,
+    ElasticSearchPersonTransformer,
+)
+from etl_utils.pool import close_pool, get_pool
+from etl_utils.postgres_handlers import (
+    PostgresFilmAggregateMerger,
+    PostgresFilmMerger,
+    PostgresFilmProducer,
+    PostgresPersonProducer,
+)
+
+
+def film_batches(
+    aggregate: bool, batch_size: int, copy: bool
+) -> Iterable[list[DictRow]]:
+    pool = get_pool()
+    merger_class = (
+        PostgresFilmAggregateMerger if aggregate else PostgresFilmMerger
+    )
+    merger = merger_class(pool)
+    producer = PostgresFilmProducer(
+        memory_state(), batch_size, 'benchmark', 'film_work', pool
+    )
+    if copy:
+        yield from producer.copy_batches(merger.keyset_query, 'fw_id')
+        return
+    for batch in producer.produce_batch():
+        yield merger.merge_batch(batch)
+
+
+def person_batches(batch_size: int, copy: bool) -> Iterable[list[DictRow]]:
+    producer = PostgresPersonProducer(memory_state(), batch_size, 'benchmark')
+    producer.bootstrap = copy
+    yield from producer.produce_batch()
+
+
+def normalized(documents: list[dict[str, Any]]) -> list[str]:
+    # Films of a person come in no particular order.
+    return sorted(
+        str({**document, 'film_ids': sorted(document['film_ids'])})
+        if 'film_ids' in document
+        else str(document)
+        for document in documents
+    )
+
+
+def measure(
+    batches: Callable[[], Iterable[list[DictRow]]],
+    transform: Callable[[list[DictRow]], Iterable[dict[str, Any]]],
+    repeat: int,
+) -> tuple[float, float, int, list[dict[str, Any]]]:
+    """Best extraction and transform times of `repeat` runs, rows and
+    documents of the last one."""
+    best_extract = best_transform = float('inf')
+    for _ in range(repeat):
+        rows = 0
+        documents: list[dict[str, Any]] = []
+        extract = transform_time = 0.0
+        started = time.perf_counter()
+        for batch in batches():
+            extracted = time.perf_counter()
+            extract += extracted - started
+            rows += len(batch)
+            documents.extend(transform(batch))
+            started = time.perf_counter()
+            transform_time += started - extracted
+        extract += time.perf_counter() - started
+        best_extract = min(best_extract, extract)
+        best_transform = min(best_transform, transform_time)
+    return best_extract, best_transform, rows, documents
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    modes: dict[str, tuple[Any, Any]] = {
+        'films, flat join': (
+            lambda copy: film_batches(False, args.batch_size, copy),
+            ElasticSearchFilmTransformer(memory_state()).transform,
+        ),
+        'films, json_agg': (
+            lambda copy: film_batches(True, args.batch_size, copy),
+            ElasticSearchAggregatedFilmTransformer(memory_state()).transform,
+        ),
+        'persons': (
+            lambda copy: person_batches(args.batch_size, copy),
+            ElasticSearchPersonTransformer(memory_state()).transform,
+        ),
+    }
+    for name, (batches, transform) in modes.items():
+        pages, transformed, _, expected = measure(
+            lambda: batches(False), transform, args.repeat
+        )
+        copied, _, rows, documents = measure(
+            lambda: batches(True), transform, args.repeat
+        )
+        same = normalized(documents) == normalized(expected)
+        print(
+            f'{name:<17} {rows:>7,} rows {len(documents):>6,} documents  '
+            f'extract: pages {pages:.3f}s, copy {copied:.3f}s '
+            f'(x{pages / copied:.1f})  transform {transformed:.3f}s'
+            f'{"" if same else "  OUTPUT DIFFERS"}'
+        )
+    close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Plan and execution time of id batch lookups of the film enricher.
+
+The `person` enricher query is run with the ids of a batch passed as a
+literal `IN (...)` list, as a `uuid[]` compared with `= ANY(...)` or joined
+through `unnest`, as the prepared `unnest` statement of `IdBatchQuery` and
+copied into a temporary table. Planning and
+execution times are reported by `EXPLAIN (ANALYZE, FORMAT JSON)`, the
+round trip time is measured by the client and includes parsing and, for
+the temporary table, its creation. Batches larger than the `person` table
+are padded with random ids. Requires the Postgres configured by
+`POSTGRES_*` environment variables.
+
+Usage (from the `etl` directory):
+    python -m benchmarks.enricher_lookup --sizes 128 1000 10000 --repeat 5
+"""
+import argparse
+import statistics
+import time
+import uuid
+from contextlib import closing
+from typing import Any
+
+from psycopg2 import sql
+from psycopg2.extensions import cursor as Cursor
+
+from etl_utils.pool import close_pool, get_pool
+from etl_utils.postgres_handlers import MIN_UUID, IdBatchQuery
+
+TEMPLATE = """
+    SELECT fw.id, fw.updated_at
+    FROM content.film_work fw
+    WHERE fw.id IN (
+        SELECT film_work_id FROM content.person_film_work WHERE {}
+    )
+    AND (fw.updated_at, fw.id) > (%(updated_at)s, %(id)s)
+    ORDER BY fw.updated_at, fw.id
+    LIMIT %(limit)s"""
+
+
+def explain(
+    cur: Cursor, query: Any, params: dict[str, Any]
+) -> tuple[float, float]:
+    """Planning and execution time of the query in milliseconds."""
+    cur.execute(
+        sql.SQL('EXPLAIN (ANALYZE, FORMAT JSON) {}').format(
+            query if isinstance(query, sql.Composable) else sql.SQL(query)
+        ),
+        params,
+    )
+    (plans,) = cur.fetchone() or ([{}],)
+    return plans[0]['Planning Time'], plans[0]['Execution Time']
+
+
+def measure(
+    cur: Cursor,
+    strategy: str,
+    lookup: IdBatchQuery,
+    ids: list[str],
+    params: dict[str, Any],
+) -> tuple[float, float, float]:
+    """Planning, execution and round trip time of one lookup in ms."""
+    array = '{%s}' % ','.join(ids)
+    if strategy == 'literal list':
+        query: Any = TEMPLATE.format('person_id IN %(ids)s')
+        params = {'ids': tuple(ids), **params}
+    elif strategy == '= ANY(array)':
+        query = TEMPLATE.format('person_id = ANY(%(ids)s::uuid[])')
+        params = {'ids': array, **params}
+    elif strategy == 'unnest join':
+        query = TEMPLATE.format(
+            'person_id IN (SELECT unnest(%(ids)s::uuid[]))'
+        )
+        params = {'ids': array, **params}
+    started = time.perf_counter()
+    if strategy in ('prepared', 'temp table'):
+        lookup.execute(cur, ids, params)
+    else:
+        cur.execute(query, params)
+    cur.fetchall()
+    round_trip = (time.perf_counter() - started) * 1000
+
+    if strategy == 'prepared':
+        query = sql.SQL('EXECUTE {} (%(ids)s, {})').format(
+            sql.Identifier(lookup.name),
+            sql.SQL(', ').join(map(sql.Placeholder, params)),
+        )
+        params = {'ids': array, **params}
+    elif strategy == 'temp table':
+        query = lookup.temp_table_query
+    planning, execution = explain(cur, query, params)
+    return planning, execution, round_trip
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=[128, 500, 1000, 2000, 5000, 10000],
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    strategies = (
+        'literal list',
+        '= ANY(array)',
+        'unnest join',
+        'prepared',
+        'temp table',
+    )
+    pool = get_pool()
+    params = {'updated_at': '-infinity', 'id': MIN_UUID, 'limit': 100}
+    with pool.connection() as conn:
+        with closing(conn.cursor()) as cur:
+            cur.execute('SELECT id::text FROM content.person ORDER BY id')
+            person_ids = [row[0] for row in cur.fetchall()]
+
+    print(
+        f'{"ids":>6} {"strategy":<13} {"plan ms":>9} {"exec ms":>9} '
+        f'{"round trip ms":>14}'
+    )
+    for size in args.sizes:
+        ids = person_ids[:size] + [
+            str(uuid.uuid4()) for _ in range(size - len(person_ids))
+        ]
+        for strategy in strategies:
+            # The pool keeps the statement prepared between the lookups.
+            lookup = IdBatchQuery(
+                f'etl_benchmark_lookup_{size}',
+                sql.SQL(TEMPLATE.replace('{}', '{ids}')),
+                sql.Identifier('person_id'),
+                threshold=len(ids) if strategy == 'prepared' else 0,
+                custom_plan=True,
+            )
+            timings = []
+            for _ in range(args.repeat):
+                with pool.connection() as conn:
+                    with closing(conn.cursor()) as cur:
+                        timings.append(
+                            measure(cur, strategy, lookup, ids, params)
+                        )
+            planning, execution, round_trip = map(
+                statistics.median, zip(*timings)
+            )
+            print(
+                f'{size:>6} {strategy:<13} {planning:>9.3f} '
+                f'{execution:>9.3f} {round_trip:>14.3f}'
+            )
+    close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Rows, payload and time of the flat and the JSON-aggregating film mergers.
+
+Both mergers read the same filmworks, and their documents are checked to be
+equal. The payload is the size of the result rows as computed by Postgres
+(`pg_column_size`). Requires the Postgres configured by `POSTGRES_*`
+environment variables.
+
+Usage (from the `etl` directory):
+    python -m benchmarks.film_merger --films 1000 --batch-size 128
+"""
+import argparse
+import time
+from contextlib import closing
+from typing import Any
+
+from psycopg2 import sql
+from psycopg2.extras import DictRow
+
+from benchmarks.common import memory_state
+from etl_utils.elastic_search_handlers import (
+    ElasticSearchAggregatedFilmTransformer,
+    ElasticSearchFilmTransformer,
+)
+from etl_utils.pool import close_pool, get_pool
+from etl_utils.postgres_handlers import (
+    PostgresFilmAggregateMerger,
+    PostgresFilmMerger,
+    PostgresFilmProducer,
+)
+
+
+def payload_bytes(merger: PostgresFilmMerger, batch: list[DictRow]) -> int:
+    ids = ','.join(str(row['id']) for row in batch)
+    with merger.pool.connection() as conn:
+        query = merger.query.array_query.as_string(conn)
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                sql.SQL('SELECT sum(pg_column_size(t.*)) FROM ({}) t').format(
+                    sql.SQL(query.rstrip().rstrip(';'))
+                ),
+                {'ids': f'{{{ids}}}'},
+            )
+            (size,) = cur.fetchone() or (0,)
+            return int(size or 0)
+
+
+def measure(
+    merger: PostgresFilmMerger,
+    transform: Any,
+    batches: list[list[DictRow]],
+) -> dict[str, Any]:
+    result: dict[str, Any] = {
+        'rows': 0,
+        'payload_mb': 0.0,
+        'merge_seconds': 0.0,
+        'transform_seconds': 0.0,
+        'documents': [],
+    }
+    for batch in batches:
+        started = time.perf_counter()
+        rows = merger.merge_batch(batch)
+        merged = time.perf_counter()
+        result['documents'].extend(transform(rows))
+        result['merge_seconds'] += merged - started
+        result['transform_seconds'] += time.perf_counter() - merged
+        result['rows'] += len(rows)
+        result['payload_mb'] += payload_bytes(merger, batch) / 2**20
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--films', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=128)
+    args = parser.parse_args()
+
+    producer = PostgresFilmProducer(
+        memory_state(), args.batch_size, 'benchmark', 'film_work'
+    )
+    batches: list[list[DictRow]] = []
+    for batch in producer.produce_batch():
+        batches.append(batch)
+        if sum(len(batch) for batch in batches) >= args.films:
+            break
+
+    pool = get_pool()
+    results = {
+        'flat join': measure(
+            PostgresFilmMerger(pool),
+            ElasticSearchFilmTransformer(memory_state()).transform,
+            batches,
+        ),
+        'json_agg': measure(
+            PostgresFilmAggregateMerger(pool),
+            ElasticSearchAggregatedFilmTransformer(memory_state()).transform,
+            batches,
+        ),
+    }
+    close_pool()
+
+    expected = sorted(results['flat join']['documents'], key=str)
+    for name, result in results.items():
+        same = sorted(result['documents'], key=str) == expected
+        print(
+            f'{name:<10} {result["rows"]:>9,} rows '
+            f'{result["payload_mb"]:>8.2f} MiB  '
+            f'merge {result["merge_seconds"]:.3f}s  '
+            f'transform {result["transform_seconds"]:.3f}s  '
+            f'{len(result["documents"])} documents'
+            f'{"" if same else "  OUTPUT DIFFERS"}'
+        )
+
+
+if __name__ == '__main__':
+    main()
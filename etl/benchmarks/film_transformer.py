@@ -0,0 +1,127 @@
+"""Throughput and peak memory of `ElasticSearchFilmTransformer`.
+
+Compares the single-pass transformer with the previous groupby/deepcopy
+implementation on synthetic merged batches, without Postgres or Redis.
+
+Usage (from the `etl` directory):
+    python -m benchmarks.film_transformer --films 128 --persons 40 --genres 5
+"""
+import argparse
+import time
+import tracemalloc
+from collections.abc import Callable, Generator, Iterator
+from copy import deepcopy
+from itertools import groupby
+from operator import attrgetter
+from typing import Any, cast
+from uuid import UUID
+
+from psycopg2.extras import DictRow
+
+from benchmarks.common import memory_state
+from benchmarks.synthetic import merged_film_rows
+from etl_utils.elastic_search_handlers import ElasticSearchFilmTransformer
+from etl_utils.models import Filmwork, NamedEntity
+
+
+def legacy_transform(
+    merged_data: list[DictRow],
+) -> Generator[dict[str, Any], None, None]:
+    """The transformer before the single-pass rewrite, kept as a baseline."""
+    groups: Iterator[tuple[UUID, Iterator[DictRow]]] = groupby(
+        sorted(merged_data, key=lambda row: cast(UUID, row['fw_id'])),
+        lambda row: cast(UUID, row['fw_id']),
+    )
+    filmworks = [
+        dict(list(next(group).items())[:5])  # type: ignore
+        for fw_id, group in deepcopy(groups)
+    ]
+
+    def get_unique_persons(
+        groups: Iterator[tuple[UUID, Iterator[DictRow]]], role: str
+    ) -> list[list[NamedEntity]]:
+        return [
+            sorted(
+                {
+                    NamedEntity(name=row['p_full_name'], id=row['p_id'])
+                    for row in group
+                    if row['p_role'] == role
+                },
+                key=attrgetter('name'),
+            )
+            for fw_id, group in deepcopy(groups)
+        ]
+
+    genres = [
+        sorted(
+            {NamedEntity(id=row['g_id'], name=row['g_name']) for row in group},
+            key=attrgetter('name'),
+        )
+        for fw_id, group in deepcopy(groups)
+    ]
+    actors = get_unique_persons(groups, 'AC')
+    writers = get_unique_persons(groups, 'WR')
+    directors = get_unique_persons(groups, 'DR')
+
+    for i in range(len(filmworks)):
+        yield Filmwork(
+            id=filmworks[i]['fw_id'],
+            _id=filmworks[i]['fw_id'],
+            imdb_rating=filmworks[i]['rating'],
+            title=filmworks[i]['title'],
+            description=filmworks[i]['description'],
+            genres=genres[i],
+            director=directors[i],
+            actors=actors[i],
+            writers=writers[i],
+        ).dict(by_alias=True)
+
+
+def measure(
+    transform: Callable[[list[DictRow]], Iterator[dict[str, Any]]],
+    batches: list[list[DictRow]],
+) -> tuple[float, float, list[dict[str, Any]]]:
+    """Returns rows/s, peak traced MiB and the produced documents."""
+    rows = sum(len(batch) for batch in batches)
+    documents: list[dict[str, Any]] = []
+    tracemalloc.start()
+    started = time.perf_counter()
+    for batch in batches:
+        documents.extend(transform(batch))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows / elapsed, peak / 2**20, documents
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--films', type=int, default=128, help='per batch')
+    parser.add_argument('--batches', type=int, default=2)
+    parser.add_argument('--persons', type=int, default=40, help='per film')
+    parser.add_argument('--genres', type=int, default=5, help='per film')
+    args = parser.parse_args()
+
+    rows = list(
+        merged_film_rows(args.films * args.batches, args.persons, args.genres)
+    )
+    size = len(rows) // args.batches
+    batches = [rows[i : i + size] for i in range(0, len(rows), size)]
+    transformer = ElasticSearchFilmTransformer(memory_state())
+
+    results = {
+        'groupby + deepcopy': measure(legacy_transform, batches),
+        'single pass': measure(transformer.transform, batches),
+    }
+    expected = sorted(results['groupby + deepcopy'][2], key=str)
+    for name, (rows_per_second, peak_mb, documents) in results.items():
+        same = sorted(documents, key=str) == expected
+        print(
+            f'{name:<20} {rows_per_second:>12,.0f} rows/s '
+            f'peak {peak_mb:>8.1f} MiB  {len(documents)} documents'
+            f'{"" if same else "  OUTPUT DIFFERS"}'
+        )
+
+
+if __name__ == '__main__':
+    main()
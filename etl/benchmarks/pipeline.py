@@ -0,0 +1,196 @@
+"""Per-stage throughput and peak memory of the ETL pipelines, offline.
+
+Runs the film and person pipelines over a seeded synthetic catalogue with
+the in-memory stand-ins of `benchmarks.standins`, so the transformers and
+`BasePipeline` are measured without Postgres, Redis or ElasticSearch.
+
+Every stage is measured in a fresh process: extract alone, extract and
+transform, then the whole run, so the peak RSS of a stage includes the
+stages feeding it; `+MiB` is the growth over the generated catalogue.
+Stage times come from the pipeline metrics. Results can be saved with
+`--save` and compared with a saved `--baseline`.
+
+Usage (from the `etl` directory):
+    python -m benchmarks.pipeline --films 20000 --cast 12 --popularity 1
+    python -m benchmarks.pipeline --save before.json
+    python -m benchmarks.pipeline --baseline before.json
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Any
+
+from benchmarks.common import peak_rss_mb
+from benchmarks.standins import MemoryFilmPipeline, MemoryPersonPipeline
+from benchmarks.synthetic import Catalogue
+from etl_utils.pipelines import (
+    DOCUMENTS_TRANSFORMED,
+    ROWS_EXTRACTED,
+    STAGE_SECONDS,
+    BasePipeline,
+)
+
+SCENARIOS = ('films', 'films-aggregated', 'persons')
+STAGES = ('extract', 'transform', 'load')
+
+
+def build(
+    scenario: str, catalogue: Catalogue, batch_size: int, staged: bool
+) -> BasePipeline:
+    if scenario == 'persons':
+        return MemoryPersonPipeline(catalogue, batch_size, staged)
+    return MemoryFilmPipeline(
+        catalogue, batch_size, scenario == 'films-aggregated', staged
+    )
+
+
+def measure(
+    scenario: str, stage: str, options: dict[str, Any]
+) -> dict[str, Any]:
+    """Runs the pipeline up to `stage`, in a process of its own."""
+    catalogue = Catalogue(**options['catalogue'])
+    pipeline = build(
+        scenario, catalogue, options['batch_size'], options['staged']
+    )
+    baseline_mb = peak_rss_mb()
+    rows = documents = 0
+    started = time.perf_counter()
+    if stage == 'extract':
+        for batch in pipeline.extract():
+            rows += len(batch)
+        seconds = time.perf_counter() - started
+    elif stage == 'transform':
+        for _ in pipeline.transform(pipeline.extract()):
+            pass
+        seconds = STAGE_SECONDS.value(pipeline=pipeline.name, stage=stage)
+        rows = int(ROWS_EXTRACTED.value(pipeline=pipeline.name))
+        documents = int(DOCUMENTS_TRANSFORMED.value(pipeline=pipeline.name))
+    else:
+        pipeline.run()
+        seconds = STAGE_SECONDS.value(pipeline=pipeline.name, stage=stage)
+        rows = int(ROWS_EXTRACTED.value(pipeline=pipeline.name))
+        documents = pipeline.es_loader.stats.documents
+    return {
+        'scenario': scenario,
+        'stage': stage,
+        'rows': rows,
+        'documents': documents,
+        'seconds': seconds,
+        'wall_seconds': time.perf_counter() - started,
+        'bytes': pipeline.es_loader.stats.bytes,
+        'peak_rss_mb': peak_rss_mb(),
+        'baseline_rss_mb': baseline_mb,
+    }
+
+
+def rate(count: float, seconds: float) -> float:
+    return count / seconds if seconds else 0.0
+
+
+def report(
+    results: list[dict[str, Any]], baseline: list[dict[str, Any]]
+) -> None:
+    before = {(r['scenario'], r['stage']): r for r in baseline}
+    print(
+        f'{"scenario":<17} {"stage":<10} {"rows/s":>10} {"docs/s":>10} '
+        f'{"seconds":>8} {"run docs/s":>10} {"peak MiB":>9} {"+MiB":>6}'
+    )
+    for result in results:
+        # Rows are only counted up to the loader, which gets documents;
+        # the load line also shows the whole run, extract to upload.
+        seconds = result['seconds']
+        run = result['stage'] == 'load'
+        rows = '' if run else f'{rate(result["rows"], seconds):,.0f}'
+        documents = (
+            f'{rate(result["documents"], seconds):,.0f}'
+            if result['documents']
+            else ''
+        )
+        end_to_end = (
+            f'{rate(result["documents"], result["wall_seconds"]):,.0f}'
+            if run
+            else ''
+        )
+        line = (
+            f'{result["scenario"]:<17} {result["stage"]:<10} '
+            f'{rows:>10} {documents:>10} {seconds:>8.3f} {end_to_end:>10} '
+            f'{result["peak_rss_mb"]:>9.1f} '
+            f'{result["peak_rss_mb"] - result["baseline_rss_mb"]:>6.1f}'
+        )
+        previous = before.get((result['scenario'], result['stage']))
+        if previous and previous['seconds'] and result['seconds']:
+            change = previous['seconds'] / result['seconds'] - 1
+            memory = result['peak_rss_mb'] - previous['peak_rss_mb']
+            line += f'  {change:>+7.1%} speed, {memory:>+6.1f} MiB'
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--films', type=int, default=10000)
+    parser.add_argument(
+        '--persons', type=int, help='default: films * cast / 4'
+    )
+    parser.add_argument('--genres', type=int, default=30)
+    parser.add_argument('--cast', type=int, default=10, help='per film')
+    parser.add_argument(
+        '--cast-distribution',
+        choices=('fixed', 'exponential'),
+        default='fixed',
+    )
+    parser.add_argument(
+        '--popularity',
+        type=float,
+        default=0.0,
+        help='Zipf exponent of persons, 0 for uniform',
+    )
+    parser.add_argument('--genres-per-film', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument(
+        '--staged', action='store_true', help='run the stages in threads'
+    )
+    parser.add_argument(
+        '--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument('--save', help='write the results to a JSON file')
+    parser.add_argument('--baseline', help='compare with saved results')
+    args = parser.parse_args()
+
+    options = {
+        'catalogue': {
+            'films': args.films,
+            'persons': args.persons,
+            'genres': args.genres,
+            'cast': args.cast,
+            'cast_distribution': args.cast_distribution,
+            'popularity': args.popularity,
+            'genres_per_film': args.genres_per_film,
+            'seed': args.seed,
+        },
+        'batch_size': args.batch_size,
+        'staged': args.staged,
+    }
+    results = []
+    for scenario in args.scenarios:
+        for stage in STAGES:
+            # A fresh process per stage, so its peak RSS is its own.
+            with ProcessPoolExecutor(1, get_context('spawn')) as executor:
+                results.append(
+                    executor.submit(measure, scenario, stage, options).result()
+                )
+    baseline = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            saved = {'options': options, 'results': results}
+            json.dump(saved, results_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
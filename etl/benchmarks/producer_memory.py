@@ -0,0 +1,73 @@
+"""Peak memory of `PostgresProducer` with client-side and server-side cursors.
+
+Every mode runs in a fresh process, which reads the whole table from
+`datetime.min` (cold start) using an in-memory state. Requires the Postgres
+configured by `POSTGRES_*` environment variables.
+
+Usage (from the `etl` directory):
+    python -m benchmarks.producer_memory --table film_work --batch-size 128
+"""
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+
+from benchmarks.common import memory_state, peak_rss_mb
+
+
+def run_producer(
+    table: str, batch_size: int, server_side: bool, itersize: int
+) -> dict[str, Any]:
+    from etl_utils.pool import close_pool
+    from etl_utils.postgres_handlers import PostgresFilmProducer
+
+    producer = PostgresFilmProducer(
+        memory_state(), batch_size, 'benchmark', table
+    )
+    producer.server_side = server_side
+    producer.itersize = itersize
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    rows = 0
+    for batch in producer.produce_batch():
+        rows += len(batch)
+    elapsed = time.perf_counter() - started
+    close_pool()
+    return {
+        'mode': f'server-side (itersize={itersize})'
+        if server_side
+        else 'client-side',
+        'rows': rows,
+        'seconds': elapsed,
+        'peak_rss_mb': peak_rss_mb(),
+        'rss_growth_mb': peak_rss_mb() - rss_before,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--table', default='film_work')
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--itersize', type=int, default=2000)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    for server_side in (False, True):
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            result = executor.submit(
+                run_producer,
+                args.table,
+                args.batch_size,
+                server_side,
+                args.itersize,
+            ).result()
+        print(
+            '{mode:<32} {rows:>10} rows {seconds:>8.2f}s '
+            'peak RSS {peak_rss_mb:>8.1f} MiB '
+            '(+{rss_growth_mb:.1f} MiB while producing)'.format(**result)
+        )
+
+
+if __name__ == '__main__':
+    main()
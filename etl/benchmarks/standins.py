@@ -0,0 +1,149 @@
+"""In-memory stand-ins for the Postgres and ElasticSearch handlers.
+
+They let `BasePipeline` run the real transformers and stage plumbing over a
+synthetic catalogue, without Postgres, Redis or ElasticSearch.
+"""
+import time
+from collections.abc import Callable, Generator, Iterable
+from typing import Any
+
+from elasticsearch.helpers import expand_action
+from psycopg2 import sql
+from psycopg2.extras import DictRow
+
+from benchmarks.common import memory_state
+from benchmarks.synthetic import Catalogue
+from etl_utils.elastic_search_handlers import (
+    ElasticSearchAggregatedFilmTransformer,
+    ElasticSearchFilmTransformer,
+    ElasticSearchLoader,
+    ElasticSearchPersonTransformer,
+)
+from etl_utils.pipelines import BasePipeline
+from etl_utils.postgres_handlers import PostgresFilmMerger, PostgresProducer
+from etl_utils.state import State
+
+
+class MemoryProducer(PostgresProducer):
+    """Produces rows of the catalogue, all of them on every run."""
+
+    def __init__(
+        self,
+        rows: Callable[[], Iterable[DictRow]],
+        state: State,
+        batch_size: int,
+        name: str,
+        id_column: str = 'id',
+    ):
+        """
+        Args:
+            rows (Callable[[], Iterable[DictRow]]):
+                returns the rows in `(updated_at, id_column)` order.
+            id_column (str, optional):
+                id column of the rows. Defaults to 'id'.
+
+        Other arguments are described in `PostgresProducer`.
+        """
+        super().__init__(sql.SQL(''), state, batch_size, name, bootstrap=False)
+        self.rows = rows
+        self.id_column = id_column
+
+    def produce_batch(
+        self, auto_commit: bool = True
+    ) -> Generator[list[DictRow], None, None]:
+        for batch in self.split_batches(self.rows()):
+            yield batch
+            if auto_commit:
+                self.commit_batch(batch)
+
+
+class MemoryFilmMerger(PostgresFilmMerger):
+    """Returns the merged rows of the catalogue filmworks."""
+
+    def __init__(self, rows: Callable[[Iterable[Any]], list[DictRow]]):
+        """
+        Args:
+            rows (Callable[[Iterable[Any]], list[DictRow]]):
+                builds the merged rows of filmwork ids, e.g.
+                `Catalogue.merged_rows`.
+        """
+        super().__init__(stream=False)
+        self.rows = rows
+
+    def merge_batch(self, batch: list[DictRow]) -> list[DictRow]:
+        return self.rows(row['id'] for row in batch)
+
+
+class MemoryLoader(ElasticSearchLoader):
+    """Serializes the bulk actions like `streaming_bulk` does and drops
+    them, counting documents and bytes in `stats`."""
+
+    def __init__(self, batch_size: int, index_name: str):
+        super().__init__(batch_size, index_name, bulk_threads=1)
+        self.index_exists = True
+        self.dead_letters = None
+        self.fingerprints = None
+        self.serializer = self.es_client.transport.serializers.get_serializer(
+            'application/json'
+        )
+
+    def upload(
+        self, data_generator: Generator[dict[str, Any], None, None]
+    ) -> None:
+        started = time.perf_counter()
+        for action in data_generator:
+            for line in expand_action(action):
+                if line is not None:
+                    self.stats.bytes += len(self.serializer.dumps(line)) + 1
+            self.stats.documents += 1
+        self.stats.seconds += time.perf_counter() - started
+
+
+class MemoryFilmPipeline(BasePipeline):
+    """`FilmETLPipeline` over a catalogue: produces every filmwork and
+    merges it with the flat or the aggregating merger rows."""
+
+    def __init__(
+        self,
+        catalogue: Catalogue,
+        batch_size: int = 128,
+        aggregate: bool = False,
+        staged: bool = False,
+    ):
+        state = memory_state()
+        super().__init__(
+            'benchmark_films', batch_size, staged=staged, state=state
+        )
+        self._es_loader = MemoryLoader(batch_size, 'movies')
+        self._producer = MemoryProducer(
+            catalogue.film_rows, state, batch_size, 'benchmark_films'
+        )
+        if aggregate:
+            self._es_transformer = ElasticSearchAggregatedFilmTransformer(
+                state
+            )
+            self._merger = MemoryFilmMerger(catalogue.aggregated_rows)
+        else:
+            self._es_transformer = ElasticSearchFilmTransformer(state)
+            self._merger = MemoryFilmMerger(catalogue.merged_rows)
+
+
+class MemoryPersonPipeline(BasePipeline):
+    """`PersonETLPipeline` over the persons of a catalogue."""
+
+    def __init__(
+        self, catalogue: Catalogue, batch_size: int = 128, staged: bool = False
+    ):
+        state = memory_state()
+        super().__init__(
+            'benchmark_persons', batch_size, staged=staged, state=state
+        )
+        self._es_loader = MemoryLoader(batch_size, 'persons')
+        self._es_transformer = ElasticSearchPersonTransformer(state)
+        self._producer = MemoryProducer(
+            catalogue.person_rows,
+            state,
+            batch_size,
+            'benchmark_persons',
+            id_column='p_id',
+        )
@@ -0,0 +1,236 @@
+"""Seeded generators of synthetic rows shaped like the Postgres handlers output."""
+import itertools
+import random
+import uuid
+from collections import OrderedDict
+from collections.abc import Generator, Iterable
+from datetime import datetime, timedelta, timezone
+from operator import itemgetter
+from typing import Any
+
+from psycopg2.extras import DictRow
+
+MERGED_FILM_COLUMNS = (
+    'fw_id',
+    'title',
+    'description',
+    'rating',
+    'type',
+    'created_at',
+    'updated_at',
+    'p_role',
+    'p_id',
+    'p_full_name',
+    'g_name',
+    'g_id',
+)
+ROLES = ('AC', 'AC', 'AC', 'WR', 'DR')
+
+
+class RowFactory:
+    """Builds real `DictRow`s without a database cursor."""
+
+    def __init__(self, columns: tuple[str, ...]):
+        self.index = OrderedDict((name, i) for i, name in enumerate(columns))
+        self.description = columns
+
+    def __call__(self, values: tuple[Any, ...]) -> DictRow:
+        row = DictRow(self)
+        row[:] = values
+        return row
+
+
+def uuid_from(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def merged_film_rows(
+    films: int,
+    persons_per_film: int = 10,
+    genres_per_film: int = 3,
+    seed: int = 0,
+) -> Generator[DictRow, None, None]:
+    """Yields `PostgresFilmMerger` rows: persons x genres rows per filmwork.
+
+    Args:
+        films (int):
+            number of filmworks.
+        persons_per_film (int, optional):
+            persons linked to every filmwork. Defaults to 10.
+        genres_per_film (int, optional):
+            genres linked to every filmwork. Defaults to 3.
+        seed (int, optional):
+            random seed. Defaults to 0.
+    """
+    rng = random.Random(seed)
+    make_row = RowFactory(MERGED_FILM_COLUMNS)
+    genres = [(uuid_from(rng), f'Genre {i}') for i in range(30)]
+    started = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    for n in range(films):
+        fw_id = uuid_from(rng)
+        film = (
+            fw_id,
+            f'Film {n}',
+            f'Description of film {n}',
+            round(rng.uniform(1, 10), 1),
+            'movie',
+            started,
+            started + timedelta(seconds=n),
+        )
+        persons = [
+            (rng.choice(ROLES), uuid_from(rng), f'Person {rng.randrange(10**6)}')
+            for _ in range(persons_per_film)
+        ]
+        for person in persons:
+            for genre_id, genre_name in rng.sample(genres, genres_per_film):
+                yield make_row(film + person + (genre_name, genre_id))
+
+
+class Catalogue:
+    """Seeded synthetic catalogue of filmworks, persons and genres.
+
+    Persons are shared between filmworks, so persons have film lists and
+    merged rows repeat names like the real tables do. Rows are built on
+    demand in the shapes of the Postgres handlers, so large catalogues take
+    little memory until a stage holds its rows.
+    """
+
+    def __init__(
+        self,
+        films: int,
+        persons: int | None = None,
+        genres: int = 30,
+        cast: int = 10,
+        cast_distribution: str = 'fixed',
+        popularity: float = 0.0,
+        genres_per_film: int = 3,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            films (int):
+                number of filmworks.
+            persons (int | None, optional):
+                number of persons. Defaults to `films * cast // 4`, i.e.
+                persons play in 4 films on average.
+            genres (int, optional):
+                number of genres. Defaults to 30.
+            cast (int, optional):
+                persons per filmwork, the mean if not fixed. Defaults to 10.
+            cast_distribution (str, optional):
+                'fixed' or 'exponential' cast sizes. Defaults to 'fixed'.
+            popularity (float, optional):
+                Zipf exponent of the person choice: 0 picks persons
+                uniformly, 1 makes a few persons play in many filmworks.
+                Defaults to 0.
+            genres_per_film (int, optional):
+                genres linked to every filmwork. Defaults to 3.
+            seed (int, optional):
+                random seed. Defaults to 0.
+        """
+        if cast_distribution not in ('fixed', 'exponential'):
+            raise ValueError(f'Unknown cast distribution {cast_distribution}')
+        rng = random.Random(seed)
+        persons = persons or max(films * cast // 4, 1)
+        self.started = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.film_ids = [uuid_from(rng) for _ in range(films)]
+        self.person_ids = [uuid_from(rng) for _ in range(persons)]
+        self.person_names = [f'Person {i}' for i in range(persons)]
+        self.genres = [(uuid_from(rng), f'Genre {i}') for i in range(genres)]
+        self.ratings = [round(rng.uniform(1, 10), 1) for _ in range(films)]
+        weights = list(
+            itertools.accumulate(
+                1 / (rank + 1) ** popularity for rank in range(persons)
+            )
+        )
+        # Per filmwork: (role, person index) pairs and genre indices.
+        self.casts: list[list[tuple[str, int]]] = []
+        self.film_genres: list[list[int]] = []
+        for _ in range(films):
+            size = cast
+            if cast_distribution == 'exponential':
+                size = max(1, round(rng.expovariate(1 / cast)))
+            chosen = set(
+                rng.choices(range(persons), cum_weights=weights, k=size)
+            )
+            self.casts.append([(rng.choice(ROLES), i) for i in sorted(chosen)])
+            self.film_genres.append(
+                rng.sample(range(genres), min(genres_per_film, genres))
+            )
+        self.film_index = {id_: n for n, id_ in enumerate(self.film_ids)}
+
+    def updated_at(self, n: int) -> datetime:
+        return self.started + timedelta(seconds=n)
+
+    def film_rows(self) -> Generator[DictRow, None, None]:
+        """`PostgresFilmProducer` rows: (id, updated_at) of every filmwork."""
+        make_row = RowFactory(('id', 'updated_at'))
+        for n, fw_id in enumerate(self.film_ids):
+            yield make_row((fw_id, self.updated_at(n)))
+
+    def film(self, n: int) -> tuple[Any, ...]:
+        return (
+            self.film_ids[n],
+            f'Film {n}',
+            f'Description of film {n}',
+            self.ratings[n],
+            'movie',
+            self.started,
+            self.updated_at(n),
+        )
+
+    def merged_rows(self, film_ids: Iterable[Any]) -> list[DictRow]:
+        """`PostgresFilmMerger` rows: persons x genres rows per filmwork."""
+        make_row = RowFactory(MERGED_FILM_COLUMNS)
+        rows = []
+        for fw_id in film_ids:
+            n = self.film_index[str(fw_id)]
+            film = self.film(n)
+            for role, i in self.casts[n]:
+                person = (role, self.person_ids[i], self.person_names[i])
+                for g in self.film_genres[n]:
+                    rows.append(make_row(film + person + self.genres[g][::-1]))
+        return rows
+
+    def aggregated_rows(self, film_ids: Iterable[Any]) -> list[DictRow]:
+        """`PostgresFilmAggregateMerger` rows: one per filmwork, entities as
+        lists of `{"id", "name"}` sorted by name and id."""
+        make_row = RowFactory(
+            MERGED_FILM_COLUMNS[:7]
+            + ('genres', 'actors', 'writers', 'director')
+        )
+        rows = []
+        for fw_id in film_ids:
+            n = self.film_index[str(fw_id)]
+            genres = [
+                {'id': self.genres[g][0], 'name': self.genres[g][1]}
+                for g in self.film_genres[n]
+            ]
+            persons: dict[str, list[dict[str, str]]] = {
+                role: [] for role in ('AC', 'WR', 'DR')
+            }
+            for role, i in self.casts[n]:
+                persons[role].append(
+                    {'id': self.person_ids[i], 'name': self.person_names[i]}
+                )
+            entities = [
+                sorted(group, key=itemgetter('name', 'id'))
+                for group in (genres, *persons.values())
+            ]
+            rows.append(make_row(self.film(n) + tuple(entities)))
+        return rows
+
+    def person_rows(self) -> Generator[DictRow, None, None]:
+        """`PostgresPersonProducer` rows: one per person and filmwork.
+        Persons cast in no filmwork are left out, as in the movies data."""
+        films: list[list[int]] = [[] for _ in self.person_ids]
+        for n, cast in enumerate(self.casts):
+            for _, i in cast:
+                films[i].append(n)
+        make_row = RowFactory(('p_id', 'p_full_name', 'f_id', 'updated_at'))
+        for i, person_id in enumerate(self.person_ids):
+            person = (person_id, self.person_names[i])
+            for n in films[i]:
+                yield make_row(
+                    person + (self.film_ids[n], self.updated_at(i))
+                )
@@ -18,6 +18,139 @@ POSTGRES_DSL: dict[str, str | int] = {
     'port': os.environ.get('POSTGRES_PORT', 5432),
 }
 
+# Пул соединений Postgres
+POSTGRES_POOL_MIN_SIZE = int(os.getenv('POSTGRES_POOL_MIN_SIZE', 1))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv('POSTGRES_POOL_MAX_SIZE', 10))
+POSTGRES_POOL_MAX_IDLE = float(os.getenv('POSTGRES_POOL_MAX_IDLE', 300))
+POSTGRES_POOL_CHECKOUT_TIMEOUT = float(
+    os.getenv('POSTGRES_POOL_CHECKOUT_TIMEOUT', 30)
+)
+POSTGRES_POOL_HEALTH_CHECK = (
+    os.getenv('POSTGRES_POOL_HEALTH_CHECK', '1') == '1'
+)
+
+# Потоковое чтение продюсерами через именованные серверные курсоры
+POSTGRES_SERVER_SIDE_CURSORS = (
+    os.getenv('POSTGRES_SERVER_SIDE_CURSORS', '0') == '1'
+)
+POSTGRES_CURSOR_ITERSIZE = int(os.getenv('POSTGRES_CURSOR_ITERSIZE', 2000))
+
+# Пакеты id больше порога передаются через временную таблицу, а не массив
+POSTGRES_ID_TEMP_TABLE_THRESHOLD = int(
+    os.getenv('POSTGRES_ID_TEMP_TABLE_THRESHOLD', 10000)
+)
+
+# Первичная загрузка (пустой чекпоинт) через COPY ... TO STDOUT
+POSTGRES_COPY_BOOTSTRAP = os.getenv('POSTGRES_COPY_BOOTSTRAP', '1') == '1'
+POSTGRES_COPY_CHUNK_BYTES = int(
+    os.getenv('POSTGRES_COPY_CHUNK_BYTES', 2**20)
+)
+
+# Параллельный запуск пайплайнов
+ETL_MAX_WORKERS = int(os.getenv('ETL_MAX_WORKERS', 5))
+ETL_SERIALIZE_SAME_INDEX = os.getenv('ETL_SERIALIZE_SAME_INDEX', '1') == '1'
+
+# Движок запуска пайплайнов: threads (psycopg2) или async (asyncpg)
+ETL_ENGINE = os.getenv('ETL_ENGINE', 'threads')
+ETL_ASYNC_MERGE_CONCURRENCY = int(
+    os.getenv('ETL_ASYNC_MERGE_CONCURRENCY', 4)
+)
+
+# Одно чтение таблиц персон и жанров за цикл для всех пайплайнов,
+# которые их отслеживают, с отдельными чекпоинтами у каждого
+ETL_FAN_OUT = os.getenv('ETL_FAN_OUT', '0') == '1'
+
+# Источник изменений: polling (опрос по updated_at) или cdc
+# (логическая репликация pgoutput, нужен wal_level = logical)
+ETL_SOURCE = os.getenv('ETL_SOURCE', 'polling')
+ETL_CDC_SLOT = os.getenv('ETL_CDC_SLOT', 'etl_cdc')
+ETL_CDC_PUBLICATION = os.getenv('ETL_CDC_PUBLICATION', 'etl_cdc')
+ETL_CDC_BATCH_SIZE = int(os.getenv('ETL_CDC_BATCH_SIZE', 1000))
+ETL_CDC_IDLE_TIMEOUT = float(os.getenv('ETL_CDC_IDLE_TIMEOUT', 1))
+
+# Режим демона: пробуждение по LISTEN/NOTIFY и опрос по таймауту
+ETL_NOTIFY_CHANNEL = os.getenv('ETL_NOTIFY_CHANNEL', 'etl_changes')
+ETL_POLL_INTERVAL = float(os.getenv('ETL_POLL_INTERVAL', 60))
+ETL_NOTIFY_DEBOUNCE = float(os.getenv('ETL_NOTIFY_DEBOUNCE', 0.2))
+
+# Параллельное выполнение стадий extract/transform/load внутри пайплайна
+ETL_STAGED_PIPELINES = os.getenv('ETL_STAGED_PIPELINES', '0') == '1'
+ETL_STAGE_QUEUE_SIZE = int(os.getenv('ETL_STAGE_QUEUE_SIZE', 4))
+
+# Сборка документов фильмов в Postgres (json_agg, одна строка на фильм)
+POSTGRES_AGGREGATE_FILMS = os.getenv('POSTGRES_AGGREGATE_FILMS', '0') == '1'
+
+# Потоковое слияние фильмов: строки читаются по фильмам, а не целым пакетом
+POSTGRES_STREAM_MERGE = os.getenv('POSTGRES_STREAM_MERGE', '0') == '1'
+
+# Дедупликация фильмов между пайплайнами: memory, redis или off
+ETL_FILM_DEDUP = os.getenv('ETL_FILM_DEDUP', 'memory')
+ETL_FILM_DEDUP_TTL = float(os.getenv('ETL_FILM_DEDUP_TTL', 600))
+
+# Накопление записей чекпоинтов: сброс каждые N изменений или T секунд
+ETL_CHECKPOINT_FLUSH_EVERY = int(os.getenv('ETL_CHECKPOINT_FLUSH_EVERY', 10))
+ETL_CHECKPOINT_FLUSH_INTERVAL = float(
+    os.getenv('ETL_CHECKPOINT_FLUSH_INTERVAL', 5)
+)
+
+# Параллельная загрузка в ElasticSearch с адаптивным размером пачки
+ELASTIC_BULK_THREADS = int(os.getenv('ELASTIC_BULK_THREADS', 1))
+ELASTIC_BULK_MAX_CHUNK_BYTES = int(
+    os.getenv('ELASTIC_BULK_MAX_CHUNK_BYTES', 10 * 2**20)
+)
+ELASTIC_BULK_MIN_CHUNK = int(os.getenv('ELASTIC_BULK_MIN_CHUNK', 16))
+ELASTIC_BULK_MAX_CHUNK = int(os.getenv('ELASTIC_BULK_MAX_CHUNK', 4096))
+ELASTIC_BULK_TARGET_LATENCY = float(
+    os.getenv('ELASTIC_BULK_TARGET_LATENCY', 1.0)
+)
+ELASTIC_BULK_MAX_RETRIES = int(os.getenv('ELASTIC_BULK_MAX_RETRIES', 5))
+
+# Документы, не загруженные после повторов: redis, file или off
+ETL_DEAD_LETTERS = os.getenv('ETL_DEAD_LETTERS', 'redis')
+ETL_DEAD_LETTERS_FILE = os.getenv(
+    'ETL_DEAD_LETTERS_FILE', 'states/dead_letters.json'
+)
+
+# Пропуск документов, не изменившихся с последней загрузки:
+# redis, sqlite или off
+ETL_FINGERPRINTS = os.getenv('ETL_FINGERPRINTS', 'redis')
+ETL_FINGERPRINTS_FILE = os.getenv(
+    'ETL_FINGERPRINTS_FILE', 'states/fingerprints.sqlite3'
+)
+
+# Переименования персон и жанров: скриптовые обновления фильмов
+# вместо полной пересборки (нужно хранилище ETL_FINGERPRINTS)
+ETL_PARTIAL_UPDATES = os.getenv('ETL_PARTIAL_UPDATES', '1') == '1'
+
+# Полная переиндексация ElasticSearch с переключением алиаса
+ELASTIC_KEEP_INDEX_VERSIONS = int(os.getenv('ELASTIC_KEEP_INDEX_VERSIONS', 1))
+ELASTIC_MAINTENANCE_TIMEOUT = float(
+    os.getenv('ELASTIC_MAINTENANCE_TIMEOUT', 3600)
+)
+
+# Переиндексация фильмов по диапазонам id в отдельных процессах
+ETL_REINDEX_PARTITIONS = int(os.getenv('ETL_REINDEX_PARTITIONS', 1))
+ETL_REINDEX_PROCESSES = int(
+    os.getenv('ETL_REINDEX_PROCESSES', os.cpu_count() or 1)
+)
+ETL_REINDEX_PARTITION_RETRIES = int(
+    os.getenv('ETL_REINDEX_PARTITION_RETRIES', 3)
+)
+
+# Снимки документов ElasticSearch: сжатые NDJSON-файлы по частям,
+# готовые для bulk API, и их загрузка без обращения к Postgres
+ETL_SNAPSHOT_DIR = os.getenv('ETL_SNAPSHOT_DIR', 'snapshots')
+ETL_SNAPSHOT_CHUNK_DOCS = int(os.getenv('ETL_SNAPSHOT_CHUNK_DOCS', 5000))
+ETL_SNAPSHOT_CHUNK_BYTES = int(
+    os.getenv('ETL_SNAPSHOT_CHUNK_BYTES', 10 * 2**20)
+)
+ETL_SNAPSHOT_COMPRESSLEVEL = int(os.getenv('ETL_SNAPSHOT_COMPRESSLEVEL', 6))
+
+# Метрики Prometheus: HTTP-порт в режиме демона (0 - выключено)
+# и файл для textfile-коллектора node exporter при запуске из cron
+ETL_METRICS_PORT = int(os.getenv('ETL_METRICS_PORT', 8001))
+ETL_METRICS_FILE = os.getenv('ETL_METRICS_FILE', 'states/etl_metrics.prom')
+
 # Корень проекта
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
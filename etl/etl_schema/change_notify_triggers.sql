@@ -0,0 +1,32 @@
+-- Statement-level triggers which wake the ETL daemon (`run_etl.py daemon`)
+-- with `NOTIFY <channel>, '<table name>'` on every change of the tables
+-- indexed into ElasticSearch. Postgres folds identical notifications sent in
+-- one transaction into one, so bulk edits produce a single wake-up.
+-- `install_triggers` renders the channel placeholder as the
+-- `ETL_NOTIFY_CHANNEL` literal.
+CREATE OR REPLACE FUNCTION content.etl_notify_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify({channel}, TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    table_name text;
+BEGIN
+    FOREACH table_name IN ARRAY ARRAY[
+        'film_work', 'person', 'genre', 'person_film_work', 'genre_film_work'
+    ] LOOP
+        EXECUTE format(
+            'DROP TRIGGER IF EXISTS etl_notify_change ON content.%I', table_name
+        );
+        EXECUTE format(
+            'CREATE TRIGGER etl_notify_change '
+            'AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON content.%I '
+            'FOR EACH STATEMENT EXECUTE FUNCTION content.etl_notify_change()',
+            table_name
+        );
+    END LOOP;
+END;
+$$;
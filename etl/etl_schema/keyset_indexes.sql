@@ -0,0 +1,13 @@
+-- Indexes backing the (updated_at, id) keyset pagination of the ETL producers
+-- and the enricher. Without them every batch query sorts the whole table.
+-- Applied by `run_etl.py install-indexes`.
+CREATE INDEX IF NOT EXISTS film_work_updated_at_id_idx
+    ON content.film_work (updated_at, id);
+CREATE INDEX IF NOT EXISTS person_updated_at_id_idx
+    ON content.person (updated_at, id);
+CREATE INDEX IF NOT EXISTS genre_updated_at_id_idx
+    ON content.genre (updated_at, id);
+CREATE INDEX IF NOT EXISTS person_film_work_person_id_idx
+    ON content.person_film_work (person_id);
+CREATE INDEX IF NOT EXISTS genre_film_work_genre_id_idx
+    ON content.genre_film_work (genre_id);
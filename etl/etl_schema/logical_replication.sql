@@ -0,0 +1,23 @@
+-- Publication of the tables indexed into ElasticSearch, streamed by the CDC
+-- source (`ETL_SOURCE=cdc`, installed by `run_etl.py install-cdc`) through a
+-- `pgoutput` logical replication slot. The server must run with
+-- `wal_level = logical`, e.g. `postgres -c wal_level=logical`.
+-- `install_replication` renders the publication placeholders as the
+-- `ETL_CDC_PUBLICATION` identifier and literal.
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT FROM pg_publication WHERE pubname = {name}) THEN
+        CREATE PUBLICATION {publication} FOR TABLE
+            content.film_work,
+            content.person,
+            content.genre,
+            content.person_film_work,
+            content.genre_film_work;
+    END IF;
+END;
+$$;
+
+-- Deleted links must carry the filmwork and the person they joined, not
+-- only their primary key, so the films and persons can be indexed again.
+ALTER TABLE content.person_film_work REPLICA IDENTITY FULL;
+ALTER TABLE content.genre_film_work REPLICA IDENTITY FULL;
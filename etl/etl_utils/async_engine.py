@@ -0,0 +1,745 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import re
+import time
+from collections import deque
+from collections.abc import AsyncGenerator, Awaitable, Callable, Iterable
+from datetime import datetime
+from functools import partial
+from types import TracebackType
+from typing import Any
+
+import asyncpg  # type: ignore
+from config import (
+    ELASTIC_HOST,
+    ELASTIC_PORT,
+    ETL_ASYNC_MERGE_CONCURRENCY,
+    ETL_SERIALIZE_SAME_INDEX,
+    POSTGRES_DSL,
+    POSTGRES_POOL_MAX_SIZE,
+    POSTGRES_POOL_MIN_SIZE,
+)
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import async_streaming_bulk
+from psycopg2 import sql
+
+from etl_utils.backoff import (
+    async_backoff_function,
+    async_backoff_generator,
+    backoff_log,
+    exponential_backoff_timings,
+)
+from etl_utils.dedup import FilmDedup
+from etl_utils.elastic_search_handlers import (
+    DOCUMENTS_LOADED,
+    DOCUMENTS_RETRIED,
+    ElasticSearchLoader,
+    PendingActions,
+    retryable,
+)
+from etl_utils.fingerprints import fingerprint
+from etl_utils.loggers import setup_logger
+from etl_utils.metrics import get_metrics
+from etl_utils.pipelines import STAGE_SECONDS, BasePipeline, Unit, _chain
+from etl_utils.postgres_handlers import (
+    CUSTOM_PLAN,
+    MIN_UUID,
+    IdBatchQuery,
+    PostgresFilmEnricher,
+    PostgresFilmMerger,
+    PostgresProducer,
+)
+from etl_utils.scheduler import (
+    CycleReport,
+    PipelineRun,
+    collect_checkpoint_lags,
+    record_run,
+    report_cycle,
+)
+
+logger = setup_logger(__name__)
+
+# Failures of the connection rather than of the query, worth a retry.
+POSTGRES_ERRORS = (
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    OSError,
+)
+
+
+def sql_text(query: sql.Composable) -> str:
+    """Renders a psycopg2 composition to text without a connection.
+
+    The handlers compose their queries of SQL, identifiers and a few string
+    literals; `%(name)s` parameters are kept.
+    """
+    if isinstance(query, sql.Composed):
+        return ''.join(sql_text(part) for part in query.seq)
+    if isinstance(query, sql.SQL):
+        return query.string
+    if isinstance(query, sql.Identifier):
+        return '.'.join(
+            '"{}"'.format(part.replace('"', '""')) for part in query.strings
+        )
+    if isinstance(query, sql.Literal) and isinstance(query.wrapped, str):
+        return "'{}'".format(query.wrapped.replace("'", "''"))
+    raise TypeError(f'Can not render {query!r} without a connection')
+
+
+class AsyncQuery:
+    """A query of the psycopg2 handlers in the asyncpg form: `%(name)s`
+    parameters become positional `$n` ones."""
+
+    def __init__(self, query: sql.Composable):
+        self.names: list[str] = []
+
+        def number(match: re.Match[str]) -> str:
+            if match.group(1) not in self.names:
+                self.names.append(match.group(1))
+            return f'${self.names.index(match.group(1)) + 1}'
+
+        self.text = IdBatchQuery.PARAMETER.sub(number, sql_text(query))
+        self.text = self.text.replace('%%', '%')
+
+    def args(self, params: dict[str, Any]) -> list[Any]:
+        return [params[name] for name in self.names]
+
+    async def fetch(
+        self, conn: asyncpg.Connection, params: dict[str, Any]
+    ) -> list[asyncpg.Record]:
+        # asyncpg prepares the statement once per connection and decodes
+        # the rows from the binary protocol.
+        return list(await conn.fetch(self.text, *self.args(params)))
+
+
+class AsyncIdBatchQuery:
+    """`IdBatchQuery` on asyncpg: the ids are passed as an array, or in
+    the `etl_lookup_ids` temporary table above the same threshold."""
+
+    def __init__(self, query: IdBatchQuery):
+        self.threshold = query.threshold
+        self.custom_plan = query.custom_plan
+        self.array_query = AsyncQuery(query.array_query)
+        self.temp_table_query = AsyncQuery(query.temp_table_query)
+
+    async def fetch(
+        self,
+        conn: asyncpg.Connection,
+        ids: Iterable[Any],
+        params: dict[str, Any],
+    ) -> list[asyncpg.Record]:
+        unique_ids = list(dict.fromkeys(str(id_) for id_ in ids))
+        if len(unique_ids) <= self.threshold:
+            if not self.custom_plan:
+                return await self.array_query.fetch(
+                    conn, {'ids': unique_ids, **params}
+                )
+            async with conn.transaction():
+                await conn.execute(CUSTOM_PLAN)
+                return await self.array_query.fetch(
+                    conn, {'ids': unique_ids, **params}
+                )
+        async with conn.transaction():
+            await conn.execute(
+                'DROP TABLE IF EXISTS pg_temp.etl_lookup_ids;'
+                'CREATE TEMP TABLE etl_lookup_ids (id uuid) ON COMMIT DROP;'
+            )
+            await conn.copy_records_to_table(
+                'etl_lookup_ids', records=[(id_,) for id_ in unique_ids]
+            )
+            await conn.execute('ANALYZE etl_lookup_ids;')
+            return await self.temp_table_query.fetch(conn, params)
+
+
+async def create_async_pool(
+    min_size: int = POSTGRES_POOL_MIN_SIZE,
+    max_size: int = POSTGRES_POOL_MAX_SIZE,
+) -> asyncpg.Pool:
+    """Connects an asyncpg pool to the Postgres of `POSTGRES_DSL`, with
+    `json` columns decoded."""
+
+    async def init(conn: asyncpg.Connection) -> None:
+        await conn.set_type_codec(
+            'json', encoder=json.dumps, decoder=json.loads, schema='pg_catalog'
+        )
+
+    return await asyncpg.create_pool(
+        host=POSTGRES_DSL['host'],
+        port=int(POSTGRES_DSL['port']),
+        user=POSTGRES_DSL['user'],
+        password=POSTGRES_DSL['password'] or None,
+        database=POSTGRES_DSL['dbname'],
+        min_size=min_size,
+        max_size=max_size,
+        init=init,
+    )
+
+
+class AsyncPostgresProducer:
+    """`PostgresProducer.produce_batch` on asyncpg: the same keyset pages,
+    batches and checkpoints of the wrapped producer."""
+
+    def __init__(self, producer: PostgresProducer, pool: asyncpg.Pool):
+        self.producer = producer
+        self.pool = pool
+        self.query = AsyncQuery(producer.query)
+
+    @async_backoff_generator(*POSTGRES_ERRORS)
+    async def produce_batch(self) -> AsyncGenerator[list[Any], None]:
+        """Extracts all entities updated after the `(updated_at, id)`
+        position saved in the state. The position is saved by the caller
+        with `PostgresProducer.commit_batch` once a batch is loaded.
+
+        Yields:
+            list[asyncpg.Record]:
+                batch of (id, updated_at) records from arbitary table.
+        """
+        producer = self.producer
+        updated_at, last_id = (
+            producer.get_last_modified(),
+            producer.get_last_id(),
+        )
+        while True:
+            async with self.pool.acquire() as conn:
+                rows = await self.query.fetch(
+                    conn,
+                    producer.keyset_params(
+                        updated_at, last_id, producer.batch_size
+                    ),
+                )
+            if not rows:
+                return
+            updated_at = rows[-1]['updated_at']
+            last_id = str(rows[-1][producer.id_column])
+            for batch in producer.split_batches(rows):
+                yield batch
+
+
+class AsyncPostgresFilmEnricher:
+    """`PostgresFilmEnricher.enrich_batch` on asyncpg, without checkpoints
+    inside the batch."""
+
+    def __init__(self, enricher: PostgresFilmEnricher, pool: asyncpg.Pool):
+        self.batch_size = enricher.batch_size
+        self.pool = pool
+        self.query = AsyncIdBatchQuery(enricher.query)
+
+    @async_backoff_generator(*POSTGRES_ERRORS)
+    async def enrich_batch(
+        self, batch: list[Any]
+    ) -> AsyncGenerator[list[Any], None]:
+        """Extracts all filmworks associated with entities in the batch,
+            one bounded keyset query per yielded batch.
+
+        Yields:
+            list[asyncpg.Record]:
+                batch of (id, updated_at) records from `film_work` table.
+        """
+        ids = [row['id'] for row in batch]
+        updated_at, last_id = datetime.min, MIN_UUID
+        while True:
+            async with self.pool.acquire() as conn:
+                films = await self.query.fetch(
+                    conn,
+                    ids,
+                    {
+                        'updated_at': updated_at,
+                        'id': last_id,
+                        'limit': self.batch_size,
+                    },
+                )
+            if not films:
+                return
+            updated_at, last_id = films[-1]['updated_at'], str(films[-1]['id'])
+            yield films
+
+
+class AsyncPostgresFilmMerger:
+    """`PostgresFilmMerger.merge_batch` on asyncpg, flat or aggregating."""
+
+    def __init__(self, merger: PostgresFilmMerger, pool: asyncpg.Pool):
+        self.pool = pool
+        self.query = AsyncIdBatchQuery(merger.query)
+
+    @async_backoff_function(*POSTGRES_ERRORS)
+    async def merge_batch(self, batch: list[Any]) -> list[Any]:
+        async with self.pool.acquire() as conn:
+            return await self.query.fetch(
+                conn, (row['id'] for row in batch), {}
+            )
+
+
+class AsyncElasticSearchLoader:
+    """`ElasticSearchLoader.upload` on `AsyncElasticsearch`, with
+    `async_streaming_bulk`.
+
+    The index, its schema and the fingerprint and dead letter stores are
+    those of the wrapped loader. The stores are synchronous, so they are
+    called in threads to keep the event loop free.
+    """
+
+    def __init__(
+        self,
+        loader: ElasticSearchLoader,
+        es_client: AsyncElasticsearch,
+        index_lock: asyncio.Lock,
+    ):
+        """
+        Args:
+            loader (ElasticSearchLoader):
+                loader of the pipeline.
+            es_client (AsyncElasticsearch):
+                client shared by the pipelines.
+            index_lock (asyncio.Lock):
+                lock of the loaders of the index, held while the index is
+                checked and created.
+        """
+        self.loader = loader
+        self.es_client = es_client
+        self.index_lock = index_lock
+
+    async def create_index(self) -> None:
+        """Creates the index like `ElasticSearchLoader.create_index` if it
+        does not exist."""
+        loader = self.loader
+        async with self.index_lock:
+            if loader.index_exists:
+                return
+            if not await self.es_client.indices.exists(
+                index=loader.index_name
+            ):
+                mappings, settings = loader.index_schema()
+                if loader.fingerprints:
+                    await asyncio.to_thread(
+                        loader.fingerprints.clear, loader.index_name
+                    )
+                response = await self.es_client.indices.create(
+                    index=f'{loader.index_name}_v1',
+                    mappings=mappings,
+                    settings=settings,
+                    aliases={loader.index_name: {}},
+                )
+                logger.info('Index created. %s', response.body)
+            loader.index_exists = True
+
+    async def upload(self, documents: list[dict[str, Any]]) -> None:
+        """Uploads the documents like `ElasticSearchLoader.upload`:
+        unchanged documents are skipped, failed ones are retried and then
+        saved as dead letters.
+
+        Raises:
+            BulkIndexError: if documents failed and there is no dead letter
+                store.
+        """
+        loader = self.loader
+        if not loader.index_exists:
+            await self.create_index()
+        store = loader.fingerprints
+        if loader.write_index != loader.index_name:
+            store = None
+        ids = [str(document['_id']) for document in documents]
+        sent: dict[str, bytes] = {}
+        skipped = 0
+        if store:
+            known = await asyncio.to_thread(store.get, loader.index_name, ids)
+            changed = []
+            for id_, document, previous in zip(ids, documents, known):
+                current = fingerprint(document)
+                if current == previous:
+                    skipped += 1
+                    continue
+                sent[id_] = current
+                changed.append(document)
+            documents = changed
+        errors = await self.upload_streaming(documents, loader.max_retries)
+        errors = await self.retry_failed(errors)
+        await asyncio.to_thread(
+            loader.settle, store, ids, sent, skipped, errors
+        )
+
+    async def upload_streaming(
+        self, actions: list[dict[str, Any]], max_retries: int = 0
+    ) -> list[dict[str, Any]]:
+        """Uploads the actions with `async_streaming_bulk`; if a request
+        doesn't reach ElasticSearch, the unacknowledged actions are sent
+        again after a backoff.
+
+        Returns:
+            list[dict[str, Any]]: failed items, as in `BulkStats.errors`.
+        """
+        loader = self.loader
+        pending = PendingActions(actions)
+        successes = 0
+        errors: list[dict[str, Any]] = []
+        timings = exponential_backoff_timings()
+        while pending:
+            try:
+                async for ok, item in async_streaming_bulk(
+                    client=self.es_client,
+                    actions=pending.values(),
+                    chunk_size=loader.batch_size,
+                    index=loader.write_index,
+                    max_retries=max_retries,
+                    raise_on_error=False,
+                    raise_on_exception=False,
+                ):
+                    ((op, result),) = item.items()
+                    action = pending.pop(str(result['_id']))
+                    if ok:
+                        successes += 1
+                    else:
+                        errors.append({op: {**result, 'data': action}})
+                    timings = exponential_backoff_timings()
+                break
+            except TransportError as e:
+                sleep_time = next(timings)
+                backoff_log(
+                    self.__class__.__name__, 'upload', sleep_time, e
+                )
+                await asyncio.sleep(sleep_time)
+        loader.stats.documents += successes
+        DOCUMENTS_LOADED.inc(successes, index=loader.index_name)
+        logger.info(
+            '%d documents uploaded to ES. %d errors.', successes, len(errors)
+        )
+        return errors
+
+    async def retry_failed(
+        self, errors: list[dict[str, Any]]
+    ) -> list[dict[str, Any]]:
+        """Sends the failed documents which may succeed again, alone, like
+        `ElasticSearchLoader.retry_failed`."""
+        timings = exponential_backoff_timings()
+        for _ in range(self.loader.max_retries):
+            retry = [error for error in errors if retryable(error)]
+            if not retry:
+                break
+            await asyncio.sleep(next(timings))
+            DOCUMENTS_RETRIED.inc(len(retry), index=self.loader.index_name)
+            logger.warning(
+                'Retrying %d failed document(s) of %s.',
+                len(retry),
+                self.loader.index_name,
+            )
+            errors = [
+                error for error in errors if not retryable(error)
+            ] + await self.upload_streaming(
+                [next(iter(error.values()))['data'] for error in retry]
+            )
+        return errors
+
+
+async def _ready(unit: Unit) -> Unit:
+    return unit
+
+
+class AsyncPipeline:
+    """Runs a `BasePipeline` on asyncio.
+
+    The pipeline keeps its queries, checkpoints, transformer and stores;
+    only the Postgres and ElasticSearch round trips go through asyncpg and
+    `AsyncElasticsearch`. As in a staged run, the producer checkpoints are
+    saved once ElasticSearch acknowledged their batches. Up to
+    `concurrency` merger queries of one pipeline run at the same time over
+    the pool, while batches are loaded in order.
+
+    Streaming merges and rename propagation need the psycopg2 handlers and
+    are left to the threaded engine.
+    """
+
+    def __init__(
+        self,
+        pipeline: BasePipeline,
+        pool: asyncpg.Pool,
+        es_client: AsyncElasticsearch,
+        index_lock: asyncio.Lock,
+        concurrency: int = ETL_ASYNC_MERGE_CONCURRENCY,
+    ):
+        """
+        Args:
+            pipeline (BasePipeline):
+                pipeline to run.
+            pool (asyncpg.Pool):
+                Postgres pool shared by the pipelines.
+            es_client (AsyncElasticsearch):
+                ElasticSearch client shared by the pipelines.
+            index_lock (asyncio.Lock):
+                lock of the loaders of the pipeline index.
+            concurrency (int, optional):
+                merger queries of the pipeline running at the same time.
+                Defaults to `ETL_ASYNC_MERGE_CONCURRENCY`.
+        """
+        self.pipeline = pipeline
+        self.pool = pool
+        self.concurrency = concurrency
+        self.producer = AsyncPostgresProducer(pipeline.producer, pool)
+        self.enricher = None
+        if pipeline.enricher:
+            self.enricher = AsyncPostgresFilmEnricher(pipeline.enricher, pool)
+        self.merger = None
+        if pipeline.merger:
+            self.merger = AsyncPostgresFilmMerger(pipeline.merger, pool)
+        self.es_loader = AsyncElasticSearchLoader(
+            pipeline.es_loader, es_client, index_lock
+        )
+
+    async def merge(
+        self,
+        films: list[Any],
+        changed_at: datetime | None = None,
+        commit: Callable[[], None] | None = None,
+    ) -> Unit:
+        """Merges the filmworks which no pipeline merged since their change,
+        like `BasePipeline.merge`.
+
+        Returns:
+            Unit:
+                merged rows and the callbacks recording the merge in `dedup`
+                and saving `commit`.
+        """
+        assert self.merger is not None
+        dedup = self.pipeline.dedup
+        record = None
+        if dedup is not None:
+            fresh = set(
+                await asyncio.to_thread(
+                    dedup.select,
+                    {
+                        str(film['id']): changed_at or film['updated_at']
+                        for film in films
+                    },
+                )
+            )
+            films = [film for film in films if str(film['id']) in fresh]
+            if not films:
+                return [], commit
+            async with self.pool.acquire() as conn:
+                merged_at = await conn.fetchval('SELECT now()')
+            record = partial(dedup.record, list(fresh), merged_at)
+        rows = await self.merger.merge_batch(films)
+        return rows, _chain(record, commit) if record or commit else None
+
+    async def extract_units(self) -> AsyncGenerator[Awaitable[Unit], None]:
+        """Extracts data like `BasePipeline.extract_units`, with the merges
+        left to await, so several of them can run at once.
+
+        Yields:
+            Awaitable[Unit]:
+                batch of rows and the producer checkpoint commit to run
+                after the batch is loaded, if the batch finishes one.
+        """
+        producer = self.pipeline.producer
+        async for batch in self.producer.produce_batch():
+            commit = partial(producer.commit_batch, batch)
+            if self.enricher and self.merger:
+                async for films in self.enricher.enrich_batch(batch):
+                    yield self.merge(films, batch[-1]['updated_at'])
+                yield _ready(([], commit))
+            elif self.merger:
+                yield self.merge(batch, commit=commit)
+            else:
+                yield _ready((batch, commit))
+
+    async def extract(self) -> AsyncGenerator[Unit, None]:
+        """Yields the units of `extract_units` in order, with up to
+        `concurrency` of them being merged ahead."""
+        pending: deque[asyncio.Future[Unit]] = deque()
+        try:
+            async for unit in self.extract_units():
+                pending.append(asyncio.ensure_future(unit))
+                while len(pending) > self.concurrency or (
+                    pending and pending[0].done()
+                ):
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def load(
+        self,
+        documents: list[dict[str, Any]],
+        commits: list[Callable[[], None]],
+    ) -> None:
+        """Uploads the documents, then runs the commits of their units."""
+        started = time.perf_counter()
+        if documents:
+            await self.es_loader.upload(documents)
+        for commit in commits:
+            commit()
+        STAGE_SECONDS.inc(
+            time.perf_counter() - started,
+            pipeline=self.pipeline.name,
+            stage='load',
+        )
+
+    async def run(self) -> None:
+        """Runs the whole ETL pipeline.
+
+        Documents of small units are gathered up to the loader batch size
+        before they are uploaded. Checkpoint writes are coalesced by
+        `State`; all of them are saved when the run ends, even if it fails.
+        """
+        pipeline = self.pipeline
+        units = self.extract()
+        documents: list[dict[str, Any]] = []
+        commits: list[Callable[[], None]] = []
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    rows, commit = await units.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    STAGE_SECONDS.inc(
+                        time.perf_counter() - started,
+                        pipeline=pipeline.name,
+                        stage='extract',
+                    )
+                documents.extend(pipeline.transform_batch(rows))
+                if commit:
+                    commits.append(commit)
+                if len(documents) >= pipeline.es_loader.batch_size:
+                    await self.load(documents, commits)
+                    documents, commits = [], []
+            await self.load(documents, commits)
+        finally:
+            await units.aclose()
+            await asyncio.to_thread(pipeline.state.flush)
+
+
+class AsyncPipelineScheduler:
+    """Runs ETL pipelines concurrently in one event loop, the asyncio
+    counterpart of `PipelineScheduler`.
+
+    The pipelines share one asyncpg pool and one `AsyncElasticsearch`
+    client, which are opened and closed with `async with`.
+    """
+
+    def __init__(
+        self,
+        serialize_same_index: bool = ETL_SERIALIZE_SAME_INDEX,
+        dedup: FilmDedup | None = None,
+        concurrency: int = ETL_ASYNC_MERGE_CONCURRENCY,
+    ):
+        """
+        Args:
+            serialize_same_index (bool, optional):
+                if True, pipelines writing to the same ElasticSearch index
+                never run at the same time.
+                Defaults to `ETL_SERIALIZE_SAME_INDEX`.
+            dedup (FilmDedup | None, optional):
+                film dedup window of the pipelines, started anew and
+                reported with every cycle. Defaults to None.
+            concurrency (int, optional):
+                merger queries of one pipeline running at the same time.
+                Defaults to `ETL_ASYNC_MERGE_CONCURRENCY`.
+        """
+        self.serialize_same_index = serialize_same_index
+        self.dedup = dedup
+        self.concurrency = concurrency
+        self.pipelines: dict[str, BasePipeline] = {}
+        self.pool: asyncpg.Pool | None = None
+        self.es_client: AsyncElasticsearch | None = None
+        get_metrics().add_collector(
+            partial(collect_checkpoint_lags, self.pipelines)
+        )
+
+    def add(self, name: str, pipeline: BasePipeline) -> None:
+        """Registers a pipeline under the name used in reports."""
+        pipeline.name = name
+        self.pipelines[name] = pipeline
+
+    async def __aenter__(self) -> AsyncPipelineScheduler:
+        self.pool = await create_async_pool()
+        self.es_client = AsyncElasticsearch(
+            f'http://{ELASTIC_HOST}:{ELASTIC_PORT}'
+        )
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        if self.es_client:
+            await self.es_client.close()
+        if self.pool:
+            await self.pool.close()
+
+    async def _run(
+        self,
+        name: str,
+        pipeline: AsyncPipeline,
+        index_lock: asyncio.Lock | None,
+    ) -> PipelineRun:
+        stats = pipeline.es_loader.loader.stats
+        if index_lock:
+            await index_lock.acquire()
+        try:
+            started = time.perf_counter()
+            documents, skipped = stats.documents, stats.skipped
+            try:
+                await pipeline.run()
+            except Exception as e:
+                logger.exception('Pipeline %s failed', name)
+                return record_run(name, time.perf_counter() - started, e)
+            return record_run(
+                name,
+                time.perf_counter() - started,
+                documents=stats.documents - documents,
+                skipped=stats.skipped - skipped,
+            )
+        finally:
+            if index_lock:
+                index_lock.release()
+
+    async def run_cycle(self, names: list[str] | None = None) -> CycleReport:
+        """Runs each pipeline once and waits for all of them.
+
+        Args:
+            names (list[str] | None, optional):
+                pipelines to run. Defaults to all registered pipelines.
+
+        Returns:
+            CycleReport: wall-clock time of every run and of the whole cycle.
+        """
+        assert self.pool is not None and self.es_client is not None
+        if self.dedup:
+            self.dedup.start_cycle()
+        # Loaders of one index create it under one lock, pipelines of one
+        # index run under another one if `serialize_same_index`.
+        create_locks: dict[str, asyncio.Lock] = {}
+        run_locks: dict[str, asyncio.Lock] = {}
+        runs = []
+        for name in names or self.pipelines:
+            pipeline = self.pipelines[name]
+            index_name = pipeline.es_loader.index_name
+            runs.append(
+                self._run(
+                    name,
+                    AsyncPipeline(
+                        pipeline,
+                        self.pool,
+                        self.es_client,
+                        create_locks.setdefault(index_name, asyncio.Lock()),
+                        self.concurrency,
+                    ),
+                    run_locks.setdefault(index_name, asyncio.Lock())
+                    if self.serialize_same_index
+                    else None,
+                )
+            )
+        started = time.perf_counter()
+        report = CycleReport(
+            runs=list(await asyncio.gather(*runs)),
+            seconds=time.perf_counter() - started,
+        )
+        report_cycle(report, self.dedup)
+        return report
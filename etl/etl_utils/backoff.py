@@ -1,12 +1,20 @@
-from collections.abc import Callable, Generator
+import asyncio
+from collections.abc import AsyncGenerator, Callable, Generator
 from functools import wraps
 from time import sleep
 from typing import Any, TypeVar, cast
 
 from etl_utils.loggers import setup_logger
+from etl_utils.metrics import get_metrics
 
 logger = setup_logger(__name__)
 
+BACKOFFS = get_metrics().counter(
+    'etl_backoff_total',
+    'Retries after a failure, by the retried function.',
+    ['function'],
+)
+
 
 def exponential_backoff_timings(
     start_sleeping_time: float = 0.1,
@@ -71,6 +79,7 @@ def backoff_log(
         sleep_time,
         exception,
     )
+    BACKOFFS.inc(function=f'{parent_class_name}.{func_name}')
 
 
 F_type = TypeVar('F_type', bound=Callable[..., Any])
@@ -179,3 +188,98 @@ def backoff_generator(
         return inner
 
     return func_wrapper
+
+
+def async_backoff_function(
+    *exceptions: type[Exception],
+    start_sleeping_time: float = 0.1,
+    factor: float = 2,
+    border_sleep_time: float = 10,
+) -> Callable[[F_type], F_type]:
+
+    """`backoff_function` for coroutine functions: awaits the function
+        again if an exception was raised, sleeping without blocking the
+        event loop.
+
+    Args are described in `backoff_function`.
+
+    Returns:
+        Callable[[Callable[..., Any]], Callable[..., Any]]:
+            decorated coroutine function with backoff.
+    """
+
+    def func_wrapper(func: F_type) -> F_type:
+        @wraps(func)
+        async def inner(*args: Any, **kwargs: Any) -> Any:
+            for t in exponential_backoff_timings(
+                start_sleeping_time, factor, border_sleep_time
+            ):
+                try:
+                    return await func(*args, **kwargs)
+                except exceptions as e:
+                    backoff_log(
+                        parent_class_name=args[0].__class__.__name__,
+                        func_name=func.__name__,
+                        sleep_time=t,
+                        exception=e,
+                    )
+                    await asyncio.sleep(t)
+            return None
+
+        return cast(F_type, inner)
+
+    return func_wrapper
+
+
+def async_backoff_generator(
+    *exceptions: type[Exception],
+    start_sleeping_time: float = 0.1,
+    factor: float = 2,
+    border_sleep_time: float = 10,
+) -> Callable[
+    [Callable[..., Any]], Callable[..., AsyncGenerator[Any, None]]
+]:
+
+    """`backoff_generator` for async generators: runs the generator again
+        if an exception was raised, so the values yielded before the
+        failure are yielded again. The timings restart after every value.
+
+    Args are described in `backoff_generator`.
+
+    Returns:
+        Callable[[Callable[..., Any]], Callable[..., AsyncGenerator[Any, None]]]:
+            decorated async generator function with backoff.
+    """
+
+    def set_timings() -> Generator[float, None, None]:
+        return exponential_backoff_timings(
+            start_sleeping_time, factor, border_sleep_time
+        )
+
+    def func_wrapper(
+        func: Callable[..., Any]
+    ) -> Callable[..., AsyncGenerator[Any, None]]:
+        @wraps(func)
+        async def inner(
+            *args: Any, **kwargs: Any
+        ) -> AsyncGenerator[Any, None]:
+            timings = set_timings()
+            while True:
+                try:
+                    async for v in func(*args, **kwargs):
+                        yield v
+                        timings = set_timings()
+                    return
+                except exceptions as e:
+                    t = next(timings)
+                    backoff_log(
+                        parent_class_name=args[0].__class__.__name__,
+                        func_name=func.__name__,
+                        sleep_time=t,
+                        exception=e,
+                    )
+                    await asyncio.sleep(t)
+
+        return inner
+
+    return func_wrapper
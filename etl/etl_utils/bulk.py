@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections.abc import Generator, Iterable
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+from typing import Any
+
+from config import (
+    ELASTIC_BULK_MAX_CHUNK,
+    ELASTIC_BULK_MAX_CHUNK_BYTES,
+    ELASTIC_BULK_MAX_RETRIES,
+    ELASTIC_BULK_MIN_CHUNK,
+    ELASTIC_BULK_TARGET_LATENCY,
+    ELASTIC_BULK_THREADS,
+)
+from elasticsearch import ApiError, Elasticsearch
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import expand_action
+
+from etl_utils.backoff import backoff_function, exponential_backoff_timings
+from etl_utils.loggers import setup_logger
+
+logger = setup_logger(__name__)
+
+
+@dataclass
+class BulkStats:
+    """Totals of bulk uploads to one index."""
+
+    documents: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    requests: int = 0
+    rejected: int = 0
+    skipped: int = 0
+    errors: list[dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def docs_per_second(self) -> float:
+        return self.documents / self.seconds if self.seconds else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def add(self, other: BulkStats) -> None:
+        self.documents += other.documents
+        self.bytes += other.bytes
+        self.seconds += other.seconds
+        self.requests += other.requests
+        self.rejected += other.rejected
+        self.skipped += other.skipped
+        self.errors.extend(other.errors)
+
+
+@dataclass
+class Chunk:
+    """Serialized actions of one bulk request."""
+
+    lines: list[bytes] = field(default_factory=list)
+    actions: list[dict[str, Any]] = field(default_factory=list)
+    offsets: list[int] = field(default_factory=list)
+    ids: set[str] = field(default_factory=set)
+    size: int = 0
+
+    def append(self, lines: list[bytes], action: dict[str, Any]) -> None:
+        self.offsets.append(len(self.lines))
+        self.lines.extend(lines)
+        self.actions.append(action)
+        if '_id' in action:
+            self.ids.add(str(action['_id']))
+        self.size += sum(len(line) + 1 for line in lines)
+
+    def select(self, positions: list[int]) -> Chunk:
+        """Builds a chunk of the actions at `positions`, e.g. for a retry."""
+        chunk = Chunk()
+        ends = self.offsets[1:] + [len(self.lines)]
+        for i in positions:
+            chunk.append(
+                self.lines[self.offsets[i] : ends[i]], self.actions[i]
+            )
+        return chunk
+
+
+class AdaptiveChunkSize:
+    """Number of documents per bulk request, tuned by AIMD.
+
+    The size grows by `increase` documents while requests complete within
+    `target_latency`, and is cut by `decrease` when a request is slower or
+    ElasticSearch rejects documents with 429 (write queue full).
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int = ELASTIC_BULK_MIN_CHUNK,
+        maximum: int = ELASTIC_BULK_MAX_CHUNK,
+        target_latency: float = ELASTIC_BULK_TARGET_LATENCY,
+        increase: int | None = None,
+        decrease: float = 0.5,
+    ):
+        """
+        Args:
+            initial (int):
+                documents in the first request.
+            minimum (int, optional):
+                lower bound. Defaults to `ELASTIC_BULK_MIN_CHUNK`.
+            maximum (int, optional):
+                upper bound. Defaults to `ELASTIC_BULK_MAX_CHUNK`.
+            target_latency (float, optional):
+                seconds a bulk request is expected to take.
+                Defaults to `ELASTIC_BULK_TARGET_LATENCY`.
+            increase (int | None, optional):
+                additive step. Defaults to a quarter of `initial`.
+            decrease (float, optional):
+                multiplicative step. Defaults to 0.5.
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.increase = increase or max(initial // 4, 1)
+        self.decrease = decrease
+        self.value = min(max(initial, minimum), maximum)
+        self._lock = threading.Lock()
+
+    def observe(self, latency: float, rejected: bool) -> None:
+        """Adjusts the size after a bulk request."""
+        with self._lock:
+            if rejected or latency > self.target_latency:
+                self.value = max(int(self.value * self.decrease), self.minimum)
+            else:
+                self.value = min(self.value + self.increase, self.maximum)
+
+
+class ParallelBulkUploader:
+    """Sends bulk requests from several threads at once.
+
+    Requests are bounded by the adaptive number of documents and by
+    `max_chunk_bytes`, so documents of any size make requests of a similar
+    weight. Documents rejected with 429 are sent again after a backoff,
+    the rest of the request is never repeated.
+    """
+
+    def __init__(
+        self,
+        client: Elasticsearch,
+        chunk_size: AdaptiveChunkSize,
+        threads: int = ELASTIC_BULK_THREADS,
+        max_chunk_bytes: int = ELASTIC_BULK_MAX_CHUNK_BYTES,
+        max_retries: int = ELASTIC_BULK_MAX_RETRIES,
+    ):
+        """
+        Args:
+            client (Elasticsearch):
+                ElasticSearch client, shared by the threads.
+            chunk_size (AdaptiveChunkSize):
+                documents per request.
+            threads (int, optional):
+                bulk requests in flight. Defaults to `ELASTIC_BULK_THREADS`.
+            max_chunk_bytes (int, optional):
+                maximum size of a request body.
+                Defaults to `ELASTIC_BULK_MAX_CHUNK_BYTES`.
+            max_retries (int, optional):
+                retries of documents rejected with 429.
+                Defaults to `ELASTIC_BULK_MAX_RETRIES`.
+        """
+        self.client = client
+        self.chunk_size = chunk_size
+        self.threads = threads
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.serializer = client.transport.serializers.get_serializer(
+            'application/json'
+        )
+
+    def chunks(
+        self, actions: Iterable[dict[str, Any]]
+    ) -> Generator[Chunk, None, None]:
+        chunk = Chunk()
+        for action in actions:
+            header, body = expand_action(action)
+            lines = [self.serializer.dumps(header)]
+            if body is not None:
+                lines.append(self.serializer.dumps(body))
+            size = sum(len(line) + 1 for line in lines)
+            if chunk.actions and (
+                len(chunk.actions) >= self.chunk_size.value
+                or chunk.size + size > self.max_chunk_bytes
+            ):
+                yield chunk
+                chunk = Chunk()
+            chunk.append(lines, action)
+        if chunk.actions:
+            yield chunk
+
+    @backoff_function(TransportError)
+    def request(self, chunk: Chunk, index: str) -> list[dict[str, Any]]:
+        """Sends one bulk request and returns its result items.
+
+        A request which didn't reach ElasticSearch is sent again, as nothing
+        of it was acknowledged. If the request is refused, every document
+        of it fails with the status of the response.
+        """
+        try:
+            # Lines are sent pre-serialized, like `streaming_bulk` does.
+            response = self.client.bulk(
+                operations=chunk.lines, index=index  # type: ignore
+            )
+        except ApiError as e:
+            error = {'status': e.meta.status, 'error': str(e)}
+            return [{'index': error}] * len(chunk.actions)
+        items: list[dict[str, Any]] = response.body['items']
+        return items
+
+    def send(self, chunk: Chunk, index: str) -> BulkStats:
+        """Sends one chunk, retrying the documents rejected with 429.
+
+        Documents which failed otherwise are returned in `errors`.
+        """
+        stats = BulkStats(documents=len(chunk.actions))
+        timings = exponential_backoff_timings()
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            items = self.request(chunk, index)
+            latency = time.perf_counter() - started
+            stats.requests += 1
+            stats.bytes += chunk.size
+
+            rejected = []
+            for i, item in enumerate(items):
+                (op, result), = item.items()
+                if result['status'] == 429:
+                    rejected.append(i)
+                elif result['status'] >= 300:
+                    stats.errors.append(
+                        {op: {**result, 'data': chunk.actions[i]}}
+                    )
+            self.chunk_size.observe(latency, bool(rejected))
+            if not rejected:
+                break
+            stats.rejected += len(rejected)
+            chunk = chunk.select(rejected)
+            if attempt < self.max_retries:
+                time.sleep(next(timings))
+        else:
+            stats.errors.extend(
+                {'index': {'status': 429, 'data': action}}
+                for action in chunk.actions
+            )
+        stats.documents -= len(stats.errors)
+        return stats
+
+    def upload(
+        self, actions: Iterable[dict[str, Any]], index: str
+    ) -> BulkStats:
+        """Uploads all the actions, with at most `threads` requests in flight.
+
+        Requests in flight may be applied in any order, so a chunk waits
+        for the requests carrying any of its ids: the actions of a document
+        are applied in the order they come.
+
+        Returns:
+            BulkStats: totals of the upload, `seconds` is its wall-clock time.
+        """
+        stats = BulkStats()
+        started = time.perf_counter()
+        # Ids of the documents of each request in flight.
+        in_flight: dict[Future[BulkStats], set[str]] = {}
+        with ThreadPoolExecutor(
+            max_workers=self.threads, thread_name_prefix=f'bulk_{index}'
+        ) as executor:
+            try:
+                for chunk in self.chunks(actions):
+                    overlapping = [
+                        future
+                        for future, ids in in_flight.items()
+                        if not ids.isdisjoint(chunk.ids)
+                    ]
+                    if overlapping:
+                        wait(overlapping)
+                    if len(in_flight) >= self.threads:
+                        wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in [f for f in in_flight if f.done()]:
+                        stats.add(future.result())
+                        del in_flight[future]
+                    in_flight[executor.submit(self.send, chunk, index)] = (
+                        chunk.ids
+                    )
+                for future in in_flight:
+                    stats.add(future.result())
+            finally:
+                for future in in_flight:
+                    future.cancel()
+        stats.seconds = time.perf_counter() - started
+        return stats
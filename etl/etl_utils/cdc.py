@@ -0,0 +1,670 @@
+"""Change data capture from Postgres logical replication.
+
+`LogicalReplicationSource` streams the changes of the tables published by
+`etl_schema/logical_replication.sql` from a `pgoutput` replication slot,
+and `CdcPipeline` indexes the filmworks, persons and genres they touch,
+deleting the documents of the deleted rows. The position in the WAL is
+saved in `State` once a batch is loaded, then confirmed to the slot, so a
+restart replays the unconfirmed transactions at most.
+"""
+from __future__ import annotations
+
+import select
+import struct
+import time
+from collections.abc import Generator, Iterable
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, cast
+
+import psycopg2
+import psycopg2.extras
+from config import (
+    ETL_CDC_BATCH_SIZE,
+    ETL_CDC_IDLE_TIMEOUT,
+    ETL_CDC_PUBLICATION,
+    ETL_CDC_SLOT,
+    ETL_CHECKPOINT_FLUSH_EVERY,
+    ETL_CHECKPOINT_FLUSH_INTERVAL,
+    POSTGRES_AGGREGATE_FILMS,
+    POSTGRES_DSL,
+    REDIS_HOST,
+    REDIS_PORT,
+    SCHEMA_FOLDER,
+)
+from psycopg2 import sql
+from psycopg2.extras import DictRow
+from redis import Redis
+
+from etl_utils.backoff import backoff_function
+from etl_utils.elastic_search_handlers import (
+    ElasticSearchAggregatedFilmTransformer,
+    ElasticSearchFilmTransformer,
+    ElasticSearchGenreTransformer,
+    ElasticSearchLoader,
+    ElasticSearchPersonTransformer,
+)
+from etl_utils.loggers import setup_logger
+from etl_utils.pipelines import (
+    DOCUMENTS_TRANSFORMED,
+    ROWS_EXTRACTED,
+    STAGE_SECONDS,
+)
+from etl_utils.pool import PostgresConnectionPool, get_pool
+from etl_utils.postgres_handlers import (
+    PostgresEntityRows,
+    PostgresFilmAggregateMerger,
+    PostgresFilmEnricher,
+    PostgresFilmMerger,
+)
+from etl_utils.state import RedisHashStorage, State
+
+logger = setup_logger(__name__)
+
+REPLICATION_FILE = SCHEMA_FOLDER / 'logical_replication.sql'
+
+# `pgoutput` timestamps are microseconds since the Postgres epoch.
+POSTGRES_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+# Key columns of the published tables, by the id sets of `ChangeBatch`
+# they go to: films, persons and genres to index again.
+KEY_COLUMNS = {
+    'film_work': {'films': 'id'},
+    'person': {'persons': 'id'},
+    'genre': {'genres': 'id'},
+    'person_film_work': {'films': 'film_work_id', 'persons': 'person_id'},
+    'genre_film_work': {'films': 'film_work_id'},
+}
+
+
+def parse_lsn(lsn: str) -> int:
+    """Converts an `X/Y` LSN to its integer position."""
+    high, low = lsn.split('/')
+    return int(high, 16) << 32 | int(low, 16)
+
+
+def format_lsn(lsn: int) -> str:
+    return f'{lsn >> 32:X}/{lsn & 0xFFFFFFFF:X}'
+
+
+def install_replication(
+    pool: PostgresConnectionPool,
+    slot: str = ETL_CDC_SLOT,
+    publication: str = ETL_CDC_PUBLICATION,
+) -> None:
+    """Creates the publication of the indexed tables and the replication
+    slot of the CDC source, if they don't exist.
+
+    Args:
+        pool (PostgresConnectionPool): connection pool.
+        slot (str, optional):
+            replication slot. Defaults to `ETL_CDC_SLOT`.
+        publication (str, optional):
+            publication of the indexed tables.
+            Defaults to `ETL_CDC_PUBLICATION`.
+
+    Raises:
+        RuntimeError: if the server doesn't run with `wal_level = logical`.
+    """
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SHOW wal_level;')
+            row = cur.fetchone()
+            if row is None or row[0] != 'logical':
+                raise RuntimeError(
+                    'Logical replication requires wal_level = logical, '
+                    f'the server runs with {row and row[0]}.'
+                )
+            cur.execute(
+                sql.SQL(REPLICATION_FILE.read_text()).format(
+                    publication=sql.Identifier(publication),
+                    name=sql.Literal(publication),
+                )
+            )
+        conn.commit()
+        # A slot can't be created in a transaction which wrote anything.
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT pg_create_logical_replication_slot(%(slot)s, 'pgoutput')
+                WHERE NOT EXISTS (
+                    SELECT FROM pg_replication_slots
+                    WHERE slot_name = %(slot)s
+                );""",
+                {'slot': slot},
+            )
+        conn.commit()
+    logger.info('Logical replication slot "%s" installed.', slot)
+
+
+@dataclass
+class Relation:
+    namespace: str
+    name: str
+    columns: list[str]
+
+
+@dataclass
+class RowChange:
+    """Row of an insert, update or delete.
+
+    `old` holds the replica identity of a deleted row, or of an updated
+    row whose key changed; the columns of `new` missing from an update
+    are unchanged TOAST values.
+    """
+
+    relation: Relation
+    operation: str
+    new: dict[str, str | None] = field(default_factory=dict)
+    old: dict[str, str | None] = field(default_factory=dict)
+
+
+@dataclass
+class Begin:
+    final_lsn: int
+    committed_at: datetime
+    xid: int
+
+
+@dataclass
+class Commit:
+    lsn: int
+    end_lsn: int
+    committed_at: datetime
+
+
+class PgOutputDecoder:
+    """Decodes the messages of the `pgoutput` plugin, protocol version 1.
+
+    Relations are described once per session before their first change,
+    so one decoder must read the whole stream of a replication connection.
+    """
+
+    def __init__(self) -> None:
+        self.relations: dict[int, Relation] = {}
+
+    @staticmethod
+    def timestamp(microseconds: int) -> datetime:
+        return POSTGRES_EPOCH + timedelta(microseconds=microseconds)
+
+    def decode(
+        self, payload: bytes
+    ) -> Begin | Commit | RowChange | list[Relation] | None:
+        """Decodes one message.
+
+        Returns:
+            Begin | Commit | RowChange | list[Relation] | None:
+                the transaction boundaries, the changed rows, the truncated
+                relations, or None for the messages without data (relation
+                and type descriptions, origins).
+        """
+        kind = payload[:1]
+        if kind == b'B':
+            final_lsn, ts, xid = struct.unpack_from('!QqI', payload, 1)
+            return Begin(final_lsn, self.timestamp(ts), xid)
+        if kind == b'C':
+            lsn, end_lsn, ts = struct.unpack_from('!QQq', payload, 2)
+            return Commit(lsn, end_lsn, self.timestamp(ts))
+        if kind == b'R':
+            self.relation(payload)
+            return None
+        if kind in (b'I', b'U', b'D'):
+            return self.row_change(payload)
+        if kind == b'T':
+            (count,) = struct.unpack_from('!I', payload, 1)
+            relids = struct.unpack_from(f'!{count}I', payload, 6)
+            return [self.relations[relid] for relid in relids]
+        return None
+
+    @staticmethod
+    def string(payload: bytes, offset: int) -> tuple[str, int]:
+        end = payload.index(b'\0', offset)
+        return payload[offset:end].decode(), end + 1
+
+    def relation(self, payload: bytes) -> None:
+        (relid,) = struct.unpack_from('!I', payload, 1)
+        namespace, offset = self.string(payload, 5)
+        name, offset = self.string(payload, offset)
+        # Replica identity setting, then the number of columns.
+        (count,) = struct.unpack_from('!H', payload, offset + 1)
+        offset += 3
+        columns = []
+        for _ in range(count):
+            # Flags, then the name, type oid and modifier.
+            column, offset = self.string(payload, offset + 1)
+            columns.append(column)
+            offset += 8
+        self.relations[relid] = Relation(namespace, name, columns)
+
+    def tuple_data(
+        self, payload: bytes, offset: int, relation: Relation
+    ) -> tuple[dict[str, str | None], int]:
+        (count,) = struct.unpack_from('!H', payload, offset)
+        offset += 2
+        values: dict[str, str | None] = {}
+        for column in relation.columns[:count]:
+            kind = payload[offset : offset + 1]
+            offset += 1
+            if kind == b'n':
+                values[column] = None
+            elif kind == b't':
+                (length,) = struct.unpack_from('!I', payload, offset)
+                offset += 4
+                values[column] = payload[offset : offset + length].decode()
+                offset += length
+            # 'u' is an unchanged TOAST value, sent without data.
+        return values, offset
+
+    def row_change(self, payload: bytes) -> RowChange:
+        operation = payload[:1].decode()
+        (relid,) = struct.unpack_from('!I', payload, 1)
+        change = RowChange(self.relations[relid], operation)
+        offset = 5
+        kind = payload[offset : offset + 1]
+        if kind in (b'K', b'O'):
+            change.old, offset = self.tuple_data(
+                payload, offset + 1, change.relation
+            )
+            kind = payload[offset : offset + 1]
+        if kind == b'N':
+            change.new, offset = self.tuple_data(
+                payload, offset + 1, change.relation
+            )
+        return change
+
+
+@dataclass
+class ChangeBatch:
+    """Ids touched by the transactions of a batch, up to the commit at
+    `lsn`.
+
+    `enrich` holds the changed persons and genres which may still be in
+    films: those films are indexed again with their new names.
+    """
+
+    films: set[str] = field(default_factory=set)
+    persons: set[str] = field(default_factory=set)
+    genres: set[str] = field(default_factory=set)
+    enrich: dict[str, set[str]] = field(
+        default_factory=lambda: {'person': set(), 'genre': set()}
+    )
+    lsn: int = 0
+    committed_at: datetime | None = None
+    changes: int = 0
+
+    def add(self, change: RowChange) -> None:
+        """Collects the ids of a row change of a published table."""
+        table = change.relation.name
+        for ids, column in KEY_COLUMNS.get(table, {}).items():
+            for row in (change.old, change.new):
+                if row.get(column):
+                    getattr(self, ids).add(row[column])
+        # Films gain and lose entities with their links, an update of the
+        # entity itself may rename it in its films.
+        if table in self.enrich and change.operation == 'U':
+            self.enrich[table].add(str(change.new['id']))
+        self.changes += 1
+
+
+class LogicalReplicationSource:
+    """Reads batches of changes from a `pgoutput` replication slot.
+
+    The slot and the checkpoint advance together: `commit` saves the
+    position of a loaded batch in `State` and only then confirms it to the
+    slot, which may recycle the WAL before it. A batch ends at a commit,
+    so a transaction is never split between two batches.
+    """
+
+    state_key = 'cdc_lsn'
+
+    def __init__(
+        self,
+        state: State,
+        dsl: dict[str, str | int] = POSTGRES_DSL,
+        slot: str = ETL_CDC_SLOT,
+        publication: str = ETL_CDC_PUBLICATION,
+        batch_size: int = ETL_CDC_BATCH_SIZE,
+        idle_timeout: float = ETL_CDC_IDLE_TIMEOUT,
+    ):
+        """
+        Args:
+            state (State):
+                state keeping the last loaded position under `cdc_lsn`.
+            dsl (dict[str, str | int], optional):
+                connection parameters. Defaults to `POSTGRES_DSL`.
+            slot (str, optional):
+                replication slot, see `install_replication`.
+                Defaults to `ETL_CDC_SLOT`.
+            publication (str, optional):
+                publication of the indexed tables.
+                Defaults to `ETL_CDC_PUBLICATION`.
+            batch_size (int, optional):
+                row changes after which a batch ends at the next commit.
+                Defaults to `ETL_CDC_BATCH_SIZE`.
+            idle_timeout (float, optional):
+                seconds without changes after which `batches` returns.
+                Defaults to `ETL_CDC_IDLE_TIMEOUT`.
+        """
+        self.state = state
+        self.dsl = dsl
+        self.slot = slot
+        self.publication = publication
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self.conn: psycopg2.extras.LogicalReplicationConnection | None = None
+        self.cursor: psycopg2.extras.ReplicationCursor | None = None
+        self.caught_up = False
+        saved = self.state.get_state(self.state_key) or {}
+        self.lsn = parse_lsn(saved['lsn']) if 'lsn' in saved else 0
+        self.committed_at: datetime | None = None
+        if saved.get('committed_at'):
+            self.committed_at = datetime.fromisoformat(saved['committed_at'])
+
+    @backoff_function(psycopg2.OperationalError)
+    def connect(self) -> psycopg2.extras.ReplicationCursor:
+        self.close()
+        self.conn = psycopg2.connect(  # type: ignore
+            **self.dsl,
+            connection_factory=psycopg2.extras.LogicalReplicationConnection,
+        )
+        assert self.conn is not None
+        cursor = cast(psycopg2.extras.ReplicationCursor, self.conn.cursor())
+        cursor.start_replication(
+            slot_name=self.slot,
+            decode=False,
+            start_lsn=self.lsn,
+            options={
+                'proto_version': '1',
+                'publication_names': self.publication,
+            },
+        )
+        logger.info(
+            'Streaming slot "%s" from %s.', self.slot, format_lsn(self.lsn)
+        )
+        self.cursor = cursor
+        return cursor
+
+    def close(self) -> None:
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = self.cursor = None
+
+    def batches(self) -> Generator[ChangeBatch, None, None]:
+        """Reads the changes until none arrives for `idle_timeout` seconds.
+
+        Transactions up to the saved position are skipped, they may be
+        sent again after a restart. Once the slot is drained, a batch
+        without changes moves the position to the end of the WAL read, so
+        the slot doesn't hold the WAL of the unpublished tables.
+
+        Yields:
+            ChangeBatch:
+                ids of the changed rows; the next batch is read once
+                the previous one is committed.
+        """
+        cursor = self.connect()
+        decoder = PgOutputDecoder()
+        batch = ChangeBatch()
+        skipped = False
+        in_transaction = False
+        self.caught_up = False
+        deadline = time.monotonic() + self.idle_timeout
+        while True:
+            message = cursor.read_message()  # type: ignore
+            if message is None:
+                remaining = deadline - time.monotonic()
+                if not in_transaction and remaining <= 0:
+                    break
+                select.select([cursor], [], [], max(remaining, 0.1))
+                continue
+            deadline = time.monotonic() + self.idle_timeout
+            event = decoder.decode(message.payload)
+            if isinstance(event, Begin):
+                in_transaction = True
+                skipped = event.final_lsn < self.lsn
+            elif isinstance(event, Commit):
+                in_transaction = False
+                if skipped:
+                    continue
+                batch.lsn = event.end_lsn
+                batch.committed_at = event.committed_at
+                if batch.changes >= self.batch_size:
+                    yield batch
+                    batch = ChangeBatch()
+            elif skipped:
+                continue
+            elif isinstance(event, RowChange):
+                batch.add(event)
+            elif isinstance(event, list):
+                logger.error(
+                    'Tables %s were truncated, their documents stay in the '
+                    'indices until they are rebuilt with `run_etl.py '
+                    'reindex`.',
+                    ', '.join(relation.name for relation in event),
+                )
+        self.caught_up = True
+        if batch.lsn or cursor.wal_end > max(batch.lsn, self.lsn):
+            batch.lsn = max(batch.lsn, cursor.wal_end)
+            yield batch
+
+    def commit(self, batch: ChangeBatch) -> None:
+        """Saves the position of a loaded batch, then confirms it to the
+        slot."""
+        if batch.lsn <= self.lsn:
+            return
+        self.lsn = batch.lsn
+        self.committed_at = batch.committed_at or self.committed_at
+        committed_at = None
+        if self.committed_at is not None:
+            committed_at = self.committed_at.isoformat()
+        self.state.set_state(
+            self.state_key,
+            {'lsn': format_lsn(self.lsn), 'committed_at': committed_at},
+        )
+        self.state.flush()
+        if self.cursor is not None and not self.cursor.closed:
+            self.cursor.send_feedback(  # type: ignore
+                flush_lsn=self.lsn, force=True
+            )
+
+
+class CdcPipeline:
+    """Indexes the changes read from a `LogicalReplicationSource`, instead
+    of the pipelines polling `updated_at`.
+
+    Every batch of changes selects the touched filmworks, persons and
+    genres again with the merger and the queries of the producers, and
+    transforms them with the transformers of the pipelines. Ids which are
+    no longer in Postgres are deleted from their index. Films of changed
+    persons and genres are found with the enrichers.
+    """
+
+    def __init__(
+        self,
+        redis_key: str = 'cdc_etl',
+        loader_batch_size: int = 128,
+        pool: PostgresConnectionPool | None = None,
+        source: LogicalReplicationSource | None = None,
+        aggregate: bool = POSTGRES_AGGREGATE_FILMS,
+        state: State | None = None,
+    ):
+        """
+        Args:
+            redis_key (str, optional):
+                key for Redis state storage. Defaults to 'cdc_etl'.
+            loader_batch_size (int, optional):
+                batch size for object uploading to ElasticSearch, and of
+                the filmworks merged together. Defaults to 128.
+            pool (PostgresConnectionPool | None, optional):
+                Postgres connection pool. Defaults to the process-wide pool.
+            source (LogicalReplicationSource | None, optional):
+                source of the changes. Defaults to one on the configured
+                slot, with the pipeline state.
+            aggregate (bool, optional):
+                if True, filmworks are merged by
+                `PostgresFilmAggregateMerger`.
+                Defaults to `POSTGRES_AGGREGATE_FILMS`.
+            state (State | None, optional):
+                checkpoint state. Defaults to the Redis hash
+                `<redis_key>:checkpoints`.
+        """
+        self.state = state or State(
+            RedisHashStorage(
+                Redis(REDIS_HOST, REDIS_PORT), f'{redis_key}:checkpoints'
+            ),
+            flush_every=ETL_CHECKPOINT_FLUSH_EVERY,
+            flush_interval=ETL_CHECKPOINT_FLUSH_INTERVAL,
+        )
+        self.name = redis_key
+        self.batch_size = loader_batch_size
+        self.pool = pool or get_pool()
+        self.source = source or LogicalReplicationSource(self.state)
+        self.movies = ElasticSearchLoader(loader_batch_size, 'movies')
+        self.persons = ElasticSearchLoader(loader_batch_size, 'persons')
+        self.genres = ElasticSearchLoader(loader_batch_size, 'genres')
+        self.film_transformer: (
+            ElasticSearchFilmTransformer
+            | ElasticSearchAggregatedFilmTransformer
+        )
+        # The batches are small and merged whole, a stream gains nothing.
+        if aggregate:
+            self.film_transformer = ElasticSearchAggregatedFilmTransformer(
+                self.state
+            )
+            self.merger: PostgresFilmMerger = PostgresFilmAggregateMerger(
+                self.pool, stream=False
+            )
+        else:
+            self.film_transformer = ElasticSearchFilmTransformer(self.state)
+            self.merger = PostgresFilmMerger(self.pool, stream=False)
+        self.person_transformer = ElasticSearchPersonTransformer(self.state)
+        self.genre_transformer = ElasticSearchGenreTransformer(self.state)
+        self.person_rows = PostgresEntityRows('person', self.pool)
+        self.genre_rows = PostgresEntityRows('genre', self.pool)
+        self.enrichers = {
+            table: PostgresFilmEnricher(
+                self.state, loader_batch_size, table, self.pool
+            )
+            for table in ('person', 'genre')
+        }
+
+    @property
+    def loaders(self) -> list[ElasticSearchLoader]:
+        """Loaders of the indices the pipeline writes to."""
+        return [self.movies, self.persons, self.genres]
+
+    @property
+    def checkpoint_lag(self) -> float | None:
+        """Seconds from the last loaded commit until now, 0 once the slot
+        was drained, None before the first checkpoint."""
+        if self.source.caught_up:
+            return 0.0
+        if self.source.committed_at is None:
+            return None
+        committed_at = self.source.committed_at
+        return (datetime.now(timezone.utc) - committed_at).total_seconds()
+
+    def load(
+        self,
+        loader: ElasticSearchLoader,
+        rows: list[DictRow],
+        documents: list[dict[str, Any]],
+        ids: Iterable[str],
+    ) -> None:
+        """Uploads the documents and deletes the ids without one."""
+        found = {str(document['_id']) for document in documents}
+        deleted = [
+            {'_op_type': 'delete', '_id': id_}
+            for id_ in ids
+            if id_ not in found
+        ]
+        ROWS_EXTRACTED.inc(len(rows), pipeline=self.name)
+        DOCUMENTS_TRANSFORMED.inc(len(documents), pipeline=self.name)
+        started = time.perf_counter()
+        if documents or deleted:
+            loader.upload(action for action in documents + deleted)
+        STAGE_SECONDS.inc(
+            time.perf_counter() - started, pipeline=self.name, stage='load'
+        )
+
+    def enriched(self, batch: ChangeBatch) -> set[str]:
+        """Filmworks of the batch and of its changed persons and genres."""
+        films = set(batch.films)
+        for table, ids in batch.enrich.items():
+            if not ids:
+                continue
+            rows = cast(list[DictRow], [{'id': id_} for id_ in ids])
+            for enriched in self.enrichers[table].enrich_batch(
+                rows, checkpoint=False
+            ):
+                films.update(str(row['id']) for row in enriched)
+        return films
+
+    def load_batch(self, batch: ChangeBatch) -> None:
+        """Indexes the filmworks, persons and genres touched by a batch."""
+        started = time.perf_counter()
+        films = sorted(self.enriched(batch))
+        STAGE_SECONDS.inc(
+            time.perf_counter() - started, pipeline=self.name, stage='extract'
+        )
+        for start in range(0, len(films), self.batch_size):
+            ids = films[start : start + self.batch_size]
+            started = time.perf_counter()
+            rows = self.merger.merge_batch(
+                cast(list[DictRow], [{'id': id_} for id_ in ids])
+            )
+            documents = list(self.film_transformer.transform(rows))
+            STAGE_SECONDS.inc(
+                time.perf_counter() - started,
+                pipeline=self.name,
+                stage='transform',
+            )
+            self.load(self.movies, rows, documents, ids)
+        self.load_entities(
+            batch.persons,
+            self.person_rows,
+            self.person_transformer,
+            self.persons,
+        )
+        self.load_entities(
+            batch.genres, self.genre_rows, self.genre_transformer, self.genres
+        )
+
+    def load_entities(
+        self,
+        ids: set[str],
+        reader: PostgresEntityRows,
+        transformer: (
+            ElasticSearchPersonTransformer | ElasticSearchGenreTransformer
+        ),
+        loader: ElasticSearchLoader,
+    ) -> None:
+        """Indexes the changed persons or genres."""
+        if not ids:
+            return
+        started = time.perf_counter()
+        rows = reader.fetch(ids)
+        documents = list(transformer.transform(rows))
+        STAGE_SECONDS.inc(
+            time.perf_counter() - started,
+            pipeline=self.name,
+            stage='transform',
+        )
+        self.load(loader, rows, documents, ids)
+
+    def run(self) -> None:
+        """Loads the changes until the slot is drained."""
+        try:
+            for batch in self.source.batches():
+                if batch.changes:
+                    self.load_batch(batch)
+                    logger.info(
+                        '%s: %d changes up to %s loaded.',
+                        self.name,
+                        batch.changes,
+                        format_lsn(batch.lsn),
+                    )
+                self.source.commit(batch)
+        finally:
+            self.state.flush()
+            self.source.close()
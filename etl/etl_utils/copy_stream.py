@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import queue
+import re
+import threading
+from collections.abc import Callable, Generator, Mapping
+from contextlib import closing
+from typing import Any, ClassVar
+
+import psycopg2.extensions
+from config import POSTGRES_COPY_CHUNK_BYTES
+from psycopg2 import sql
+
+from etl_utils.pool import PooledConnection
+
+# Text format escapes written by `COPY ... TO`, other escaped characters
+# stand for themselves (e.g. `\\`).
+ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+ESCAPE = re.compile(r'\\(.)')
+NULL = '\\N'
+# Types psycopg2 returns as the text itself.
+TEXT_TYPECASTERS = {'STRING', 'UNICODE'}
+
+
+class CopyStopped(Exception):
+    """The reader of a COPY stream went away."""
+
+
+class CopyRow(tuple):  # type: ignore[type-arg]
+    """Row parsed from `COPY` output.
+
+    Values are read by position or by column name like `DictRow`, but a row
+    is a plain tuple: nothing is built per row beyond the values themselves.
+    Every query gets its own subclass from `row_class`, holding the
+    positions of its columns.
+    """
+
+    __slots__ = ()
+    positions: ClassVar[dict[str, int]] = {}
+
+    def __getitem__(self, key: Any) -> Any:
+        if key.__class__ is str:
+            key = self.positions[key]
+        return tuple.__getitem__(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        position = self.positions.get(key)
+        return default if position is None else self[position]
+
+    def keys(self) -> list[str]:
+        return list(self.positions)
+
+
+def row_class(columns: list[str]) -> type[CopyRow]:
+    """Builds the `CopyRow` subclass of a query with the given columns."""
+    positions = {name: position for position, name in enumerate(columns)}
+    return type(
+        'CopyRow', (CopyRow,), {'__slots__': (), 'positions': positions}
+    )
+
+
+class _ChunkWriter:
+    """File-like target of `copy_expert`: psycopg2 writes one row per call,
+    rows are joined into chunks of about `chunk_bytes` and queued."""
+
+    def __init__(
+        self,
+        chunks: queue.Queue[bytes | BaseException | None],
+        stop: threading.Event,
+        chunk_bytes: int,
+    ):
+        self.chunks = chunks
+        self.stop = stop
+        self.chunk_bytes = chunk_bytes
+        self.buffer: list[bytes] = []
+        self.size = 0
+
+    def put(self, item: bytes | BaseException | None) -> None:
+        while not self.stop.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise CopyStopped
+
+    def write(self, data: bytes) -> None:
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_bytes:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.put(b''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+
+def _unescape(value: str) -> str:
+    return ESCAPE.sub(
+        lambda match: ESCAPES.get(match.group(1), match.group(1)), value
+    )
+
+
+def _parse_field(field: str) -> str | None:
+    if field == NULL:
+        return None
+    return _unescape(field) if '\\' in field else field
+
+
+def _parse_fields(line: str) -> list[Any]:
+    """Splits a text format line; only lines with escapes or NULLs (both
+    contain a backslash) are parsed field by field."""
+    if '\\' in line:
+        return [_parse_field(field) for field in line.split('\t')]
+    return line.split('\t')
+
+
+def copy_rows(
+    conn: PooledConnection,
+    query: sql.Composable,
+    params: Mapping[str, Any],
+    chunk_bytes: int = POSTGRES_COPY_CHUNK_BYTES,
+    queue_size: int = 4,
+) -> Generator[CopyRow, None, None]:
+    """Streams the rows of a query with `COPY (...) TO STDOUT`.
+
+    The COPY runs in a thread which hands chunks of the text format output
+    to the parser through a queue of `queue_size` chunks, so Postgres keeps
+    sending while rows are parsed and at most about
+    `queue_size * chunk_bytes` of output is buffered. Values are converted
+    by the psycopg2 typecasters of the column types, so they are the same
+    as `DictRow` values. Consecutive equal values of a column (e.g. film
+    fields repeated on every joined row) are converted once.
+
+    Args:
+        conn (PooledConnection):
+            connection, busy until the generator is exhausted or closed.
+        query (sql.Composable):
+            SELECT query, with `%(name)s` placeholders for `params`.
+        params (Mapping[str, Any]):
+            query parameters.
+        chunk_bytes (int, optional):
+            size of the chunks passed to the parser.
+            Defaults to `POSTGRES_COPY_CHUNK_BYTES`.
+        queue_size (int, optional):
+            chunks buffered between the COPY and the parser. Defaults to 4.
+
+    Yields:
+        CopyRow: rows of the query.
+    """
+    select = query.as_string(conn).strip().rstrip(';')
+    with closing(conn.cursor()) as cur:
+        cur.execute(f'SELECT * FROM ({select}) q LIMIT 0', params)
+        description = cur.description or ()
+        copy = cur.mogrify(  # type: ignore
+            f'COPY ({select}) TO STDOUT', params
+        )
+    columns = [column.name for column in description]
+    casters: list[tuple[int, Callable[..., Any]]] = []
+    for position, column in enumerate(description):
+        caster = psycopg2.extensions.string_types.get(column.type_code)
+        if caster is not None and caster.name not in TEXT_TYPECASTERS:
+            casters.append((position, caster))
+    row = row_class(columns)
+    encoding = psycopg2.extensions.encodings[conn.encoding]
+
+    chunks: queue.Queue[bytes | BaseException | None]
+    chunks = queue.Queue(queue_size)
+    stop = threading.Event()
+    writer = _ChunkWriter(chunks, stop, chunk_bytes)
+    with closing(conn.cursor()) as cur:
+
+        def run_copy() -> None:
+            try:
+                cur.copy_expert(copy, writer)
+                writer.flush()
+                writer.put(None)
+            except CopyStopped:
+                pass
+            except BaseException as e:
+                try:
+                    writer.put(e)
+                except CopyStopped:
+                    pass
+
+        thread = threading.Thread(target=run_copy, name='copy', daemon=True)
+        thread.start()
+        last: list[list[Any]] = [[None, None] for _ in casters]
+        try:
+            while (chunk := chunks.get()) is not None:
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                # psycopg2 writes whole rows, so chunks end with a newline.
+                for line in chunk.decode(encoding).split('\n')[:-1]:
+                    fields = _parse_fields(line)
+                    for (position, caster), cached in zip(casters, last):
+                        value = fields[position]
+                        if value is None:
+                            continue
+                        if value != cached[0]:
+                            cached[0], cached[1] = value, caster(value, cur)
+                        fields[position] = cached[1]
+                    yield row(fields)
+        finally:
+            if thread.is_alive():
+                stop.set()
+                conn.cancel()
+            thread.join()
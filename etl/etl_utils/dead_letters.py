@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import abc
+import json
+import threading
+from collections.abc import Iterable
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+from config import (
+    ETL_DEAD_LETTERS,
+    ETL_DEAD_LETTERS_FILE,
+    REDIS_HOST,
+    REDIS_PORT,
+)
+from redis import Redis
+from redis.exceptions import ConnectionError
+
+from etl_utils.backoff import backoff_function
+
+
+@dataclass
+class DeadLetter:
+    """Bulk action ElasticSearch refused, with its last error."""
+
+    action: dict[str, Any]
+    status: int | None
+    error: Any
+    failed_at: str
+    attempts: int = 1
+
+    @property
+    def id(self) -> str:
+        return str(self.action['_id'])
+
+    @classmethod
+    def from_error(cls, item: dict[str, Any]) -> DeadLetter:
+        """Builds a letter from a failed item of `BulkStats.errors`."""
+        ((_, result),) = item.items()
+        return cls(
+            action=result['data'],
+            status=result.get('status'),
+            error=result.get('error'),
+            failed_at=datetime.now(timezone.utc).isoformat(),
+        )
+
+    def dumps(self) -> str:
+        # Documents hold UUIDs, ElasticSearch reads them back as strings.
+        return json.dumps(asdict(self), separators=(',', ':'), default=str)
+
+    @classmethod
+    def loads(cls, value: str | bytes) -> DeadLetter:
+        return cls(**json.loads(value))
+
+
+class DeadLetterStore:
+    """Documents which failed to index after all the retries.
+
+    The checkpoints of a pipeline move past failed documents, so they are
+    kept here until `run_etl.py dlq-replay` sends them again. There is one
+    letter per index and document id: a new failure replaces the letter and
+    a later successful upload of the document drops it, so a replay never
+    overwrites a newer version of a document.
+    """
+
+    @abc.abstractmethod
+    def add(self, index: str, letters: Iterable[DeadLetter]) -> None:
+        """Saves letters, counting the attempts of documents failed before."""
+
+    @abc.abstractmethod
+    def discard(self, index: str, ids: list[str]) -> None:
+        """Drops the letters of documents indexed successfully."""
+
+    @abc.abstractmethod
+    def letters(self, index: str) -> list[DeadLetter]:
+        """All the letters of the index."""
+
+    @abc.abstractmethod
+    def indices(self) -> list[str]:
+        """Indices with letters."""
+
+
+class RedisDeadLetterStore(DeadLetterStore):
+    """Keeps the letters of every index in a Redis hash by document id, so
+    pipelines running as separate processes share them."""
+
+    def __init__(self, redis_adapter: Redis[Any], name: str = 'dead_letters'):
+        """
+        Args:
+            redis_adapter (Redis[Any]):
+                Redis client.
+            name (str, optional):
+                prefix of the hash keys. Defaults to 'dead_letters'.
+        """
+        self.redis_adapter = redis_adapter
+        self.name = name
+
+    def key(self, index: str) -> str:
+        return f'{self.name}:{index}'
+
+    @backoff_function(ConnectionError)
+    def add(self, index: str, letters: Iterable[DeadLetter]) -> None:
+        by_id = {letter.id: letter for letter in letters}
+        if not by_id:
+            return
+        key = self.key(index)
+        ids = list(by_id)
+        for id_, previous in zip(ids, self.redis_adapter.hmget(key, ids)):
+            if previous:
+                by_id[id_].attempts += DeadLetter.loads(previous).attempts
+        self.redis_adapter.hset(
+            key, mapping={id_: letter.dumps() for id_, letter in by_id.items()}
+        )
+
+    @backoff_function(ConnectionError)
+    def discard(self, index: str, ids: list[str]) -> None:
+        if ids:
+            self.redis_adapter.hdel(self.key(index), *ids)
+
+    @backoff_function(ConnectionError)
+    def letters(self, index: str) -> list[DeadLetter]:
+        return [
+            DeadLetter.loads(value)
+            for value in self.redis_adapter.hvals(self.key(index))
+        ]
+
+    @backoff_function(ConnectionError)
+    def indices(self) -> list[str]:
+        prefix = f'{self.name}:'
+        return sorted(
+            key.decode()[len(prefix) :]
+            for key in self.redis_adapter.scan_iter(match=f'{prefix}*')
+        )
+
+
+class JsonFileDeadLetterStore(DeadLetterStore):
+    """Keeps the letters in a local JSON file, for setups without Redis.
+
+    The file is read once and rewritten on every change of the letters, so
+    it is meant for few letters and a single process.
+    """
+
+    def __init__(self, file_path: Path | str = ETL_DEAD_LETTERS_FILE):
+        self.file_path = Path(file_path)
+        self._lock = threading.Lock()
+        self._letters: dict[str, dict[str, DeadLetter]] = {}
+        if self.file_path.exists():
+            with self.file_path.open() as letters_file:
+                self._letters = {
+                    index: {
+                        id_: DeadLetter(**letter)
+                        for id_, letter in letters.items()
+                    }
+                    for index, letters in json.load(letters_file).items()
+                }
+
+    def save(self) -> None:
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.file_path.open('w') as letters_file:
+            json.dump(
+                {
+                    index: {
+                        id_: asdict(letter) for id_, letter in letters.items()
+                    }
+                    for index, letters in self._letters.items()
+                    if letters
+                },
+                letters_file,
+                indent=4,
+                sort_keys=True,
+                default=str,
+            )
+
+    def add(self, index: str, letters: Iterable[DeadLetter]) -> None:
+        with self._lock:
+            stored = self._letters.setdefault(index, {})
+            changed = False
+            for letter in letters:
+                previous = stored.get(letter.id)
+                if previous:
+                    letter.attempts += previous.attempts
+                stored[letter.id] = letter
+                changed = True
+            if changed:
+                self.save()
+
+    def discard(self, index: str, ids: list[str]) -> None:
+        with self._lock:
+            stored = self._letters.get(index)
+            if not stored:
+                return
+            removed = [stored.pop(id_) for id_ in ids if id_ in stored]
+            if removed:
+                self.save()
+
+    def letters(self, index: str) -> list[DeadLetter]:
+        with self._lock:
+            return list(self._letters.get(index, {}).values())
+
+    def indices(self) -> list[str]:
+        with self._lock:
+            return sorted(
+                index for index, letters in self._letters.items() if letters
+            )
+
+
+_shared_store: DeadLetterStore | None = None
+_shared_store_lock = threading.Lock()
+
+
+def get_dead_letters(mode: str = ETL_DEAD_LETTERS) -> DeadLetterStore | None:
+    """Returns the process-wide store configured by `ETL_DEAD_LETTERS`.
+
+    Args:
+        mode (str, optional):
+            'redis', 'file' or 'off'. Defaults to `ETL_DEAD_LETTERS`.
+    """
+    global _shared_store
+    if mode not in ('redis', 'file'):
+        return None
+    with _shared_store_lock:
+        if _shared_store is None:
+            if mode == 'redis':
+                _shared_store = RedisDeadLetterStore(
+                    Redis(REDIS_HOST, REDIS_PORT)
+                )
+            else:
+                _shared_store = JsonFileDeadLetterStore()
+        return _shared_store
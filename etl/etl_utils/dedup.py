@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import abc
+import threading
+import time
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Any
+
+from config import (
+    ETL_FILM_DEDUP,
+    ETL_FILM_DEDUP_TTL,
+    REDIS_HOST,
+    REDIS_PORT,
+)
+from redis import Redis
+from redis.exceptions import ConnectionError
+
+from etl_utils.backoff import backoff_function
+
+
+class FilmDedup:
+    """Remembers when filmworks were merged, so the film pipelines merge and
+    index a filmwork once per cycle even if several of them see its changes.
+
+    A filmwork is skipped only if it was merged at or after the change which
+    made a pipeline select it: a later change is never lost. Merge times come
+    from the Postgres clock, like the `updated_at` of the changes.
+    """
+
+    def __init__(self) -> None:
+        self.checked = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def merged_at(self, ids: list[str]) -> list[datetime | None]:
+        """Last merge times of the filmworks, None if unknown."""
+
+    @abc.abstractmethod
+    def record(self, ids: list[str], merged_at: datetime) -> None:
+        """Saves the merge time of indexed filmworks."""
+
+    def start_cycle(self) -> None:
+        """Resets the hit counters at the start of a cycle."""
+        with self._lock:
+            self.checked = self.hits = 0
+
+    def select(self, changed_at: Mapping[str, datetime]) -> list[str]:
+        """Filters out filmworks merged since they were changed.
+
+        Args:
+            changed_at (Mapping[str, datetime]):
+                time of the change which selected each filmwork, by id.
+
+        Returns:
+            list[str]: ids of the filmworks to merge.
+        """
+        ids = list(changed_at)
+        fresh = [
+            id_
+            for id_, merged_at in zip(ids, self.merged_at(ids))
+            if merged_at is None or merged_at < changed_at[id_]
+        ]
+        with self._lock:
+            self.checked += len(ids)
+            self.hits += len(ids) - len(fresh)
+        return fresh
+
+
+class MemoryFilmDedup(FilmDedup):
+    """Dedup window of one process, cleared at the start of every cycle."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.merges: dict[str, datetime] = {}
+
+    def merged_at(self, ids: list[str]) -> list[datetime | None]:
+        with self._lock:
+            return [self.merges.get(id_) for id_ in ids]
+
+    def record(self, ids: list[str], merged_at: datetime) -> None:
+        with self._lock:
+            for id_ in ids:
+                previous = self.merges.get(id_, merged_at)
+                self.merges[id_] = max(previous, merged_at)
+
+    def start_cycle(self) -> None:
+        super().start_cycle()
+        with self._lock:
+            self.merges.clear()
+
+
+class RedisFilmDedup(FilmDedup):
+    """Dedup window shared by pipelines running as separate processes.
+
+    Merge times are kept in Redis hashes of `ttl` seconds time buckets, so
+    the window covers the last `ttl` to `2 * ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        redis_adapter: Redis[Any],
+        name: str = 'film_dedup',
+        ttl: float = ETL_FILM_DEDUP_TTL,
+    ):
+        """
+        Args:
+            redis_adapter (Redis[Any]):
+                Redis client.
+            name (str, optional):
+                prefix of the hash keys. Defaults to 'film_dedup'.
+            ttl (float, optional):
+                seconds a merge is remembered at least.
+                Defaults to `ETL_FILM_DEDUP_TTL`.
+        """
+        super().__init__()
+        self.redis_adapter = redis_adapter
+        self.name = name
+        self.ttl = ttl
+
+    def keys(self) -> tuple[str, str]:
+        """Keys of the current and the previous time bucket."""
+        bucket = int(time.time() // self.ttl)
+        return f'{self.name}:{bucket}', f'{self.name}:{bucket - 1}'
+
+    @backoff_function(ConnectionError)
+    def merged_at(self, ids: list[str]) -> list[datetime | None]:
+        if not ids:
+            return []
+        pipeline = self.redis_adapter.pipeline(transaction=False)
+        for key in self.keys():
+            pipeline.hmget(key, ids)
+        current, previous = pipeline.execute()
+        values = [new or old for new, old in zip(current, previous)]
+        return [
+            datetime.fromisoformat(value.decode()) if value else None
+            for value in values
+        ]
+
+    @backoff_function(ConnectionError)
+    def record(self, ids: list[str], merged_at: datetime) -> None:
+        if not ids:
+            return
+        key, _ = self.keys()
+        pipeline = self.redis_adapter.pipeline(transaction=False)
+        pipeline.hset(key, mapping={id_: merged_at.isoformat() for id_ in ids})
+        pipeline.expire(key, int(2 * self.ttl) + 1)
+        pipeline.execute()
+
+
+def get_film_dedup(mode: str = ETL_FILM_DEDUP) -> FilmDedup | None:
+    """Builds the dedup window configured by `ETL_FILM_DEDUP`.
+
+    Args:
+        mode (str, optional):
+            'memory', 'redis' or 'off'. Defaults to `ETL_FILM_DEDUP`.
+    """
+    if mode == 'memory':
+        return MemoryFilmDedup()
+    if mode == 'redis':
+        return RedisFilmDedup(Redis(REDIS_HOST, REDIS_PORT))
+    return None
@@ -1,65 +1,462 @@
 import json
-from collections.abc import Generator, Iterator
-from copy import deepcopy
-from itertools import groupby
+import time
+from collections.abc import Generator, Iterable, Iterator
+from collections import defaultdict, deque
+from itertools import chain, count, groupby, islice
 from operator import attrgetter
 from typing import Any, cast
 from uuid import UUID
 
-from config import ELASTIC_HOST, ELASTIC_PORT, SCHEMA_FOLDER
+from config import (
+    ELASTIC_BULK_MAX_RETRIES,
+    ELASTIC_BULK_THREADS,
+    ELASTIC_HOST,
+    ELASTIC_PORT,
+    SCHEMA_FOLDER,
+)
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import TransportError
-from elasticsearch.helpers import streaming_bulk
+from elasticsearch.helpers import BulkIndexError, streaming_bulk
 from psycopg2.extras import DictRow
 
-from etl_utils.backoff import backoff_function
+from etl_utils.backoff import backoff_log, exponential_backoff_timings
+from etl_utils.bulk import AdaptiveChunkSize, BulkStats, ParallelBulkUploader
+from etl_utils.dead_letters import (
+    DeadLetter,
+    DeadLetterStore,
+    get_dead_letters,
+)
+from etl_utils.fingerprints import (
+    FingerprintStore,
+    fingerprint,
+    get_fingerprints,
+)
 from etl_utils.loggers import setup_logger
+from etl_utils.metrics import get_metrics
 from etl_utils.models import Filmwork, Genre, NamedEntity, Person
 from etl_utils.state import State, StatefulMixin
 
 logger = setup_logger(__name__)
 
+metrics = get_metrics()
+DOCUMENTS_LOADED = metrics.counter(
+    'etl_documents_loaded_total',
+    'Documents acknowledged by ElasticSearch.',
+    ['index'],
+)
+DOCUMENTS_SKIPPED = metrics.counter(
+    'etl_documents_skipped_total',
+    'Documents not uploaded again as their fingerprint did not change.',
+    ['index'],
+)
+DOCUMENTS_FAILED = metrics.counter(
+    'etl_documents_failed_total',
+    'Documents which failed to index after all the retries.',
+    ['index'],
+)
+DOCUMENTS_RETRIED = metrics.counter(
+    'etl_documents_retried_total',
+    'Rejected or failed documents sent again.',
+    ['index'],
+)
+BULK_REQUESTS = metrics.counter(
+    'etl_bulk_requests_total',
+    'Bulk requests sent by the parallel uploader.',
+    ['index'],
+)
+BULK_BYTES = metrics.counter(
+    'etl_bulk_bytes_total',
+    'Bytes of the bulk requests sent by the parallel uploader.',
+    ['index'],
+)
+
+
+class PendingActions:
+    """Actions sent to ElasticSearch and not acknowledged yet, in order.
+
+    A bulk result is matched with the oldest pending action of its `_id`,
+    so an upload may carry several actions of one document.
+    """
+
+    def __init__(self, actions: Iterable[dict[str, Any]] = ()) -> None:
+        self.actions: dict[int, dict[str, Any]] = {}
+        self.by_id: defaultdict[str, deque[int]] = defaultdict(deque)
+        self.sequence = count()
+        for action in actions:
+            self.add(action)
+
+    def __len__(self) -> int:
+        return len(self.actions)
+
+    def add(self, action: dict[str, Any]) -> None:
+        number = next(self.sequence)
+        self.actions[number] = action
+        self.by_id[str(action['_id'])].append(number)
+
+    def pop(self, id_: str) -> dict[str, Any]:
+        """Removes the oldest pending action of the document."""
+        numbers = self.by_id[id_]
+        number = numbers.popleft()
+        if not numbers:
+            del self.by_id[id_]
+        return self.actions.pop(number)
+
+    def values(self) -> list[dict[str, Any]]:
+        return list(self.actions.values())
+
+    def drain(self) -> list[dict[str, Any]]:
+        """Removes all the pending actions, in the order they were sent."""
+        actions = self.values()
+        self.actions.clear()
+        self.by_id.clear()
+        return actions
+
+
+def missing_document(error: dict[str, Any]) -> bool:
+    """Whether a failed bulk item is the delete or the partial update of
+    a missing document.
+
+    The delete leaves the index as intended. The update only patches
+    documents already indexed, a document indexed later is built from
+    the current rows, so sending it again would fail forever.
+    """
+    ((op, result),) = error.items()
+    return op in ('delete', 'update') and result.get('status') == 404
+
+
+def retryable(error: dict[str, Any]) -> bool:
+    """Whether a failed bulk item may succeed if sent again: rejections
+    (429), server errors and failures without a response."""
+    ((_, result),) = error.items()
+    status = result.get('status')
+    return not isinstance(status, int) or status == 429 or status >= 500
+
 
 class ElasticSearchLoader:
-    def __init__(self, batch_size: int, index_name: str):
+    def __init__(
+        self,
+        batch_size: int,
+        index_name: str,
+        bulk_threads: int = ELASTIC_BULK_THREADS,
+        dead_letters: DeadLetterStore | None = None,
+        max_retries: int = ELASTIC_BULK_MAX_RETRIES,
+        fingerprints: FingerprintStore | None = None,
+    ):
+        """
+        Args:
+            batch_size (int):
+                documents per bulk request; the initial size when
+                `bulk_threads` > 1.
+            index_name (str):
+                index alias, also the prefix of the schema files.
+            bulk_threads (int, optional):
+                if greater than 1, bulk requests are sent by
+                `ParallelBulkUploader` with that many requests in flight
+                and an adaptive chunk size. Defaults to `ELASTIC_BULK_THREADS`.
+            dead_letters (DeadLetterStore | None, optional):
+                store of the documents which failed to index.
+                Defaults to the store configured by `ETL_DEAD_LETTERS`;
+                without one, failures raise `BulkIndexError`.
+            max_retries (int, optional):
+                retries of documents failed with 429 or a server error.
+                Defaults to `ELASTIC_BULK_MAX_RETRIES`.
+            fingerprints (FingerprintStore | None, optional):
+                fingerprints of the indexed documents, unchanged documents
+                are not uploaded again. Defaults to the store configured by
+                `ETL_FINGERPRINTS`.
+        """
         self.index_name = index_name
+        # Documents go through the `index_name` alias, except while
+        # `IndexRebuilder` fills a new version of the index.
+        self.write_index = index_name
         self.batch_size = batch_size
+        self.index_exists = False
         self.es_client = Elasticsearch(f'http://{ELASTIC_HOST}:{ELASTIC_PORT}')
         logger.info(
             'Connecting to ElasticSearch...\nHost: http://%s:%s',
             ELASTIC_HOST,
             ELASTIC_PORT,
         )
+        self.stats = BulkStats()
+        self.dead_letters = dead_letters or get_dead_letters()
+        self.fingerprints = fingerprints or get_fingerprints()
+        self.max_retries = max_retries
+        self.bulk_uploader: ParallelBulkUploader | None = None
+        if bulk_threads > 1:
+            self.bulk_uploader = ParallelBulkUploader(
+                self.es_client,
+                AdaptiveChunkSize(batch_size),
+                bulk_threads,
+                max_retries=max_retries,
+            )
 
-    @backoff_function(TransportError)
     def upload(
         self, data_generator: Generator[dict[str, Any], None, None]
     ) -> None:
-        """Uploads data to ElasticSearch using `streaming_bulk`.
+        """Uploads data to ElasticSearch using `streaming_bulk`,
+            or `ParallelBulkUploader` if it is configured.
+
+        Only failed documents are sent again: those rejected with 429 or
+        failed with a server error up to `max_retries` times after a
+        backoff, whole requests only if they didn't reach ElasticSearch.
+        Documents still failing and those refused for good (e.g. by the
+        mapping) are saved to `dead_letters`, and the letters of the
+        uploaded documents are dropped.
+
+        Documents with the same fingerprint as when they were last uploaded
+        are skipped, except while a new version of the index is loaded.
+        Other actions than `index`, e.g. the scripted updates of
+        `RenamePropagator`, are always sent and forget the fingerprint.
 
         Args:
             data_generator (Generator[dict[str, Any], None, None]):
                 generator of dicts with data as in index scheme of ElasticSearch.
+
+        Raises:
+            BulkIndexError: if documents failed and there is no dead letter
+                store.
+        """
+        if not self.index_exists:
+            if not self.es_client.indices.exists(index=self.index_name):
+                self.create_index()
+            self.index_exists = True
+        store = self.fingerprints
+        if self.write_index != self.index_name:
+            store = None
+        ids: list[str] = []
+        sent: dict[str, bytes] = {}
+        skipped = 0
+
+        def actions() -> Generator[dict[str, Any], None, None]:
+            nonlocal skipped
+            source = iter(data_generator)
+            while batch := list(islice(source, self.batch_size)):
+                batch_ids = [str(action['_id']) for action in batch]
+                ids.extend(batch_ids)
+                if not store:
+                    yield from batch
+                    continue
+                # Updates change documents in place, their fingerprints
+                # are dropped before the documents change.
+                store.discard(
+                    self.index_name,
+                    [
+                        id_
+                        for id_, action in zip(batch_ids, batch)
+                        if action.get('_op_type', 'index') != 'index'
+                    ],
+                )
+                known = store.get(self.index_name, batch_ids)
+                for id_, action, previous in zip(batch_ids, batch, known):
+                    if action.get('_op_type', 'index') != 'index':
+                        # A document sent earlier in the upload is changed
+                        # after it, its fingerprint is not kept either.
+                        sent.pop(id_, None)
+                        yield action
+                        continue
+                    current = fingerprint(action)
+                    if current == previous:
+                        skipped += 1
+                        continue
+                    sent[id_] = current
+                    yield action
+
+        if self.bulk_uploader:
+            errors = self.upload_parallel(self.bulk_uploader, actions())
+        else:
+            errors = self.upload_streaming(actions(), self.max_retries)
+        errors = self.retry_failed(
+            [error for error in errors if not missing_document(error)]
+        )
+        self.settle(store, ids, sent, skipped, errors)
+
+    def settle(
+        self,
+        store: FingerprintStore | None,
+        ids: list[str],
+        sent: dict[str, bytes],
+        skipped: int,
+        errors: list[dict[str, Any]],
+    ) -> None:
+        """Records the outcome of an upload: fingerprints of the indexed
+        documents, and dead letters of the failed ones.
+
+        Args:
+            store (FingerprintStore | None):
+                fingerprint store of the upload, None if it skipped none.
+            ids (list[str]):
+                ids of all the actions of the upload, skipped ones too.
+            sent (dict[str, bytes]):
+                fingerprints of the uploaded documents by id.
+            skipped (int):
+                number of unchanged documents left out.
+            errors (list[dict[str, Any]]):
+                items of the documents which failed for good.
+
+        Raises:
+            BulkIndexError: if documents failed and there is no dead letter
+                store.
         """
-        if not self.es_client.indices.exists(index=self.index_name):
-            self.create_index()
-        successes: int = 0
-        errors = []
-        for ok, action in streaming_bulk(
-            client=self.es_client,
-            chunk_size=self.batch_size,
-            index=self.index_name,
-            actions=data_generator,
-        ):
-            successes += ok
-            if not ok:
-                errors.append(action)
+        letters = [DeadLetter.from_error(error) for error in errors]
+        failed = {letter.id for letter in letters}
+        if store:
+            store.save(
+                self.index_name,
+                {id_: fp for id_, fp in sent.items() if id_ not in failed},
+            )
+            self.stats.skipped += skipped
+            DOCUMENTS_SKIPPED.inc(skipped, index=self.index_name)
+            logger.info(
+                '%d of %d documents of %s unchanged, not uploaded.',
+                skipped,
+                len(ids),
+                self.index_name,
+            )
+        DOCUMENTS_FAILED.inc(len(errors), index=self.index_name)
+        if not self.dead_letters:
+            if errors:
+                raise BulkIndexError(
+                    f'{len(errors)} document(s) failed to index.', errors
+                )
+            return
+        self.dead_letters.discard(
+            self.index_name, [id_ for id_ in ids if id_ not in failed]
+        )
+        if letters:
+            self.dead_letters.add(self.index_name, letters)
+            logger.error(
+                '%d document(s) failed to index into %s, '
+                'saved as dead letters: %s',
+                len(letters),
+                self.index_name,
+                ', '.join(sorted(failed)),
+            )
+
+    def upload_streaming(
+        self, actions: Iterable[dict[str, Any]], max_retries: int = 0
+    ) -> list[dict[str, Any]]:
+        """Uploads the actions with `streaming_bulk`.
+
+        Actions are kept until ElasticSearch acknowledges them, so if a
+        request doesn't reach it only the unacknowledged actions are sent
+        again, after a backoff.
+
+        Args:
+            actions (Iterable[dict[str, Any]]):
+                actions to upload.
+            max_retries (int, optional):
+                retries of documents rejected with 429 by `streaming_bulk`.
+                Defaults to 0.
+
+        Returns:
+            list[dict[str, Any]]: failed items, as in `BulkStats.errors`.
+        """
+        pending = PendingActions()
+
+        def remember(
+            actions: Iterable[dict[str, Any]],
+        ) -> Generator[dict[str, Any], None, None]:
+            for action in actions:
+                pending.add(action)
+                yield action
+
+        successes = 0
+        errors: list[dict[str, Any]] = []
+        source = iter(actions)
+        timings = exponential_backoff_timings()
+        while True:
+            try:
+                for ok, item in streaming_bulk(
+                    client=self.es_client,
+                    chunk_size=self.batch_size,
+                    index=self.write_index,
+                    actions=remember(chain(pending.drain(), source)),
+                    max_retries=max_retries,
+                    raise_on_error=False,
+                    raise_on_exception=False,
+                ):
+                    ((op, result),) = item.items()
+                    action = pending.pop(str(result['_id']))
+                    if ok:
+                        successes += 1
+                    else:
+                        errors.append({op: {**result, 'data': action}})
+                    timings = exponential_backoff_timings()
+                break
+            except TransportError as e:
+                sleep_time = next(timings)
+                backoff_log(
+                    self.__class__.__name__, 'upload', sleep_time, e
+                )
+                time.sleep(sleep_time)
+        self.stats.documents += successes
+        DOCUMENTS_LOADED.inc(successes, index=self.index_name)
         logger.info(
             '%d documents uploaded to ES. %d errors.', successes, len(errors)
         )
+        return errors
+
+    def upload_parallel(
+        self,
+        uploader: ParallelBulkUploader,
+        data_generator: Iterable[dict[str, Any]],
+    ) -> list[dict[str, Any]]:
+        stats = uploader.upload(data_generator, self.write_index)
+        self.stats.add(stats)
+        DOCUMENTS_LOADED.inc(stats.documents, index=self.index_name)
+        DOCUMENTS_RETRIED.inc(stats.rejected, index=self.index_name)
+        BULK_REQUESTS.inc(stats.requests, index=self.index_name)
+        BULK_BYTES.inc(stats.bytes, index=self.index_name)
+        logger.info(
+            '%d documents (%.2f MiB) uploaded to ES index %s in %.3fs: '
+            '%.0f docs/s, %.2f MiB/s, %d requests, %d rejections retried, '
+            'chunk size %d. %d errors.',
+            stats.documents,
+            stats.bytes / 2**20,
+            self.write_index,
+            stats.seconds,
+            stats.docs_per_second,
+            stats.bytes_per_second / 2**20,
+            stats.requests,
+            stats.rejected,
+            uploader.chunk_size.value,
+            len(stats.errors),
+        )
+        return stats.errors
 
-    def create_index(self) -> None:
-        """Creates an index in ElasticSearch if one isn't already there."""
+    def retry_failed(
+        self, errors: list[dict[str, Any]]
+    ) -> list[dict[str, Any]]:
+        """Sends the failed documents which may succeed again, alone.
+
+        Returns:
+            list[dict[str, Any]]: items of the documents still failing.
+        """
+        timings = exponential_backoff_timings()
+        for _ in range(self.max_retries):
+            retry = [error for error in errors if retryable(error)]
+            if not retry:
+                break
+            time.sleep(next(timings))
+            DOCUMENTS_RETRIED.inc(len(retry), index=self.index_name)
+            logger.warning(
+                'Retrying %d failed document(s) of %s.',
+                len(retry),
+                self.index_name,
+            )
+            errors = [
+                error for error in errors if not retryable(error)
+            ] + self.upload_streaming(
+                next(iter(error.values()))['data'] for error in retry
+            )
+        return errors
+
+    def index_schema(self) -> tuple[dict[str, Any], dict[str, Any]]:
+        """Reads the mappings and the settings of the index from `SCHEMA_FOLDER`.
+
+        Returns:
+            tuple[dict[str, Any], dict[str, Any]]: mappings and settings.
+        """
         with open(
             SCHEMA_FOLDER / f'{self.index_name}_index_mappings.json'
         ) as mappings_file:
@@ -68,13 +465,77 @@ class ElasticSearchLoader:
             SCHEMA_FOLDER / f'{self.index_name}_index_settings.json'
         ) as settings_file:
             settings = json.load(settings_file)
+        return mappings, settings
 
+    def create_index(self) -> None:
+        """Creates the first version of the index in ElasticSearch,
+        `<index_name>_v1`, behind the `index_name` alias.
+
+        Later versions are built by `IndexRebuilder`, which moves the alias
+        without downtime.
+        """
+        mappings, settings = self.index_schema()
+        if self.fingerprints:
+            self.fingerprints.clear(self.index_name)
         response = self.es_client.indices.create(
-            index=self.index_name, mappings=mappings, settings=settings
+            index=f'{self.index_name}_v1',
+            mappings=mappings,
+            settings=settings,
+            aliases={self.index_name: {}},
         )
         logger.info('Index created. %s', response.body)
 
 
+class FilmAggregate:
+    """Accumulates merged Postgres rows of one filmwork into its document.
+
+    Genres and persons of every role are kept in dicts keyed by id, so the
+    cartesian persons x genres rows collapse into unique entities without
+    building intermediate sets of models.
+    """
+
+    __slots__ = ('row', 'genres', 'persons')
+
+    ROLES = {'AC': 'actors', 'WR': 'writers', 'DR': 'director'}
+
+    def __init__(self, row: DictRow):
+        self.row = row
+        self.genres: dict[UUID, str] = {}
+        self.persons: dict[str, dict[UUID, str]] = {
+            role: {} for role in self.ROLES
+        }
+
+    def add(self, row: DictRow) -> None:
+        if row['g_id'] is not None:
+            self.genres[row['g_id']] = row['g_name']
+        persons = self.persons.get(row['p_role'])
+        if persons is not None:
+            persons[row['p_id']] = row['p_full_name']
+
+    @staticmethod
+    def entities(names: dict[UUID, str]) -> list[NamedEntity]:
+        return sorted(
+            (NamedEntity(id=id_, name=name) for id_, name in names.items()),
+            key=attrgetter('name', 'id'),
+        )
+
+    def document(self) -> dict[str, Any]:
+        """Validates the filmwork and returns its `movies` index document."""
+        fields: dict[str, Any] = {
+            field: self.entities(self.persons[role])
+            for role, field in self.ROLES.items()
+        }
+        return Filmwork(
+            id=self.row['fw_id'],
+            _id=self.row['fw_id'],
+            imdb_rating=self.row['rating'],
+            title=self.row['title'],
+            description=self.row['description'],
+            genres=self.entities(self.genres),
+            **fields,
+        ).dict(by_alias=True)
+
+
 class ElasticSearchFilmTransformer(StatefulMixin):
     def __init__(self, state: State):
         super().__init__(state, 'es_loader_last_updated_films')
@@ -86,6 +547,9 @@ class ElasticSearchFilmTransformer(StatefulMixin):
         """Transforms raw merged filmwork data from Postgres into dicts
         which could be loaded to ElasticSearch.
 
+        All the documents are built in a single pass over the rows, which may
+        come in any order.
+
         Args:
             merged_data (list[DictRow]):
                 merged data from Postgres.
@@ -94,68 +558,47 @@ class ElasticSearchFilmTransformer(StatefulMixin):
             dict[str, Any]:
                 dict in the format of Elastic Search `movies` index.
         """
+        films: dict[UUID, FilmAggregate] = {}
+        for row in merged_data:
+            film = films.get(row['fw_id'])
+            if film is None:
+                film = films[row['fw_id']] = FilmAggregate(row)
+            film.add(row)
 
-        groups: Iterator[tuple[UUID, Iterator[DictRow]]] = groupby(
-            sorted(merged_data, key=lambda row: cast(UUID, row['fw_id'])),
-            lambda row: cast(UUID, row['fw_id']),
-        )
-        filmworks = [
-            dict(list(next(group).items())[:5])  # type: ignore
-            for fw_id, group in deepcopy(groups)
-        ]
-
-        def get_unique_persons(
-            groups: Iterator[tuple[UUID, Iterator[DictRow]]], role: str
-        ) -> list[list[NamedEntity]]:
-            """Extracts and groups all persons of the same `role` for each film in `groups`.
-
-            Args:
-                groups (Iterator[tuple[UUID, Iterator[DictRow]]]):
-                    result of groupby on raw merged data from Postgres.
-                role (str):
-                    role to extract.
-
-            Returns:
-                list[list[NamedEntity]]:
-                    list containing lists of persons with the `role` for each film in `groups`.
-            """
-            return [
-                sorted(
-                    {
-                        NamedEntity(name=row['p_full_name'], id=row['p_id'])
-                        for row in group
-                        if row['p_role'] == role
-                    },
-                    key=attrgetter('name'),
-                )
-                for fw_id, group in deepcopy(groups)
-            ]
-
-        genres = [
-            sorted(
-                {
-                    NamedEntity(id=row['g_id'], name=row['g_name'])
-                    for row in group
-                },
-                key=attrgetter('name'),
-            )
-            for fw_id, group in deepcopy(groups)
-        ]
-        actors = get_unique_persons(groups, 'AC')
-        writers = get_unique_persons(groups, 'WR')
-        directors = get_unique_persons(groups, 'DR')
+        for film in films.values():
+            yield film.document()
+
+
+class ElasticSearchAggregatedFilmTransformer(StatefulMixin):
+    def __init__(self, state: State):
+        super().__init__(state, 'es_loader_last_updated_films')
+
+    def transform(
+        self, merged_data: list[DictRow]
+    ) -> Generator[dict[str, Any], None, None]:
 
-        for i in range(len(filmworks)):
+        """Transforms filmwork rows aggregated by `PostgresFilmAggregateMerger`
+        into dicts which could be loaded to ElasticSearch.
+
+        Args:
+            merged_data (list[DictRow]):
+                one row per filmwork, genres and persons as JSON arrays.
+
+        Yields:
+            dict[str, Any]:
+                dict in the format of Elastic Search `movies` index.
+        """
+        for row in merged_data:
             yield Filmwork(
-                id=filmworks[i]['fw_id'],
-                _id=filmworks[i]['fw_id'],
-                imdb_rating=filmworks[i]['rating'],
-                title=filmworks[i]['title'],
-                description=filmworks[i]['description'],
-                genres=genres[i],
-                director=directors[i],
-                actors=actors[i],
-                writers=writers[i],
+                id=row['fw_id'],
+                _id=row['fw_id'],
+                imdb_rating=row['rating'],
+                title=row['title'],
+                description=row['description'],
+                genres=row['genres'],
+                director=row['director'],
+                actors=row['actors'],
+                writers=row['writers'],
             ).dict(by_alias=True)
 
 
@@ -213,12 +656,14 @@ class ElasticSearchPersonTransformer(StatefulMixin):
         for p_id, group in groups:
             film_ids = []
             for person_row in group:
-                film_ids.append(person_row['f_id'])
+                # A person without films is joined with a NULL film.
+                if person_row['f_id'] is not None:
+                    film_ids.append(person_row['f_id'])
             full_name = person_row['p_full_name']
             action = Person(
                 id=str(p_id),
                 _id=str(p_id),
                 name=full_name,
-                film_ids=[str(i) for i in film_ids],
+                film_ids=sorted(str(i) for i in film_ids),
             ).dict(by_alias=True)
             yield action
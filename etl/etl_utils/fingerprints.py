@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import abc
+import hashlib
+import json
+import sqlite3
+import threading
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any
+
+from config import (
+    ETL_FINGERPRINTS,
+    ETL_FINGERPRINTS_FILE,
+    REDIS_HOST,
+    REDIS_PORT,
+)
+from redis import Redis
+from redis.exceptions import ConnectionError
+
+from etl_utils.backoff import backoff_function
+
+
+def fingerprint(document: Mapping[str, Any]) -> bytes:
+    """Hash of a document, equal for documents with equal JSON."""
+    return hashlib.blake2b(
+        json.dumps(
+            document, sort_keys=True, separators=(',', ':'), default=str
+        ).encode(),
+        digest_size=16,
+    ).digest()
+
+
+class FingerprintStore:
+    """Fingerprints of the documents last acknowledged by ElasticSearch.
+
+    `ElasticSearchLoader` drops documents whose fingerprint didn't change,
+    e.g. films selected by the enrich pipelines because a person was
+    touched without any change of the film document. A fingerprint is only
+    saved once the upload of the document succeeded, and the fingerprints
+    of an index are cleared when it is created or replaced, so a skipped
+    document is always in the index as it is.
+    """
+
+    @abc.abstractmethod
+    def get(self, index: str, ids: list[str]) -> list[bytes | None]:
+        """Fingerprints of the documents, None if unknown."""
+
+    @abc.abstractmethod
+    def save(self, index: str, fingerprints: Mapping[str, bytes]) -> None:
+        """Saves the fingerprints of uploaded documents by id."""
+
+    @abc.abstractmethod
+    def discard(self, index: str, ids: list[str]) -> None:
+        """Forgets the fingerprints of documents changed in place."""
+
+    @abc.abstractmethod
+    def clear(self, index: str) -> None:
+        """Forgets all the fingerprints of the index, and those kept for it
+        under `<index>:<name>`, e.g. by `RenamePropagator`."""
+
+
+class RedisFingerprintStore(FingerprintStore):
+    """Keeps the fingerprints of every index in a Redis hash by document
+    id, 16 bytes per document."""
+
+    def __init__(self, redis_adapter: Redis[Any], name: str = 'fingerprints'):
+        """
+        Args:
+            redis_adapter (Redis[Any]):
+                Redis client.
+            name (str, optional):
+                prefix of the hash keys. Defaults to 'fingerprints'.
+        """
+        self.redis_adapter = redis_adapter
+        self.name = name
+
+    def key(self, index: str) -> str:
+        return f'{self.name}:{index}'
+
+    @backoff_function(ConnectionError)
+    def get(self, index: str, ids: list[str]) -> list[bytes | None]:
+        if not ids:
+            return []
+        return list(self.redis_adapter.hmget(self.key(index), ids))
+
+    @backoff_function(ConnectionError)
+    def save(self, index: str, fingerprints: Mapping[str, bytes]) -> None:
+        mapping: dict[str | bytes, bytes] = {
+            id_: value for id_, value in fingerprints.items()
+        }
+        if mapping:
+            self.redis_adapter.hset(self.key(index), mapping=mapping)
+
+    @backoff_function(ConnectionError)
+    def discard(self, index: str, ids: list[str]) -> None:
+        if ids:
+            self.redis_adapter.hdel(self.key(index), *ids)
+
+    @backoff_function(ConnectionError)
+    def clear(self, index: str) -> None:
+        self.redis_adapter.delete(
+            self.key(index),
+            *self.redis_adapter.scan_iter(match=f'{self.key(index)}:*'),
+        )
+
+
+class SqliteFingerprintStore(FingerprintStore):
+    """Keeps the fingerprints in a local SQLite file, for setups without
+    Redis. The pipelines of one process share the connection."""
+
+    def __init__(self, file_path: Path | str = ETL_FINGERPRINTS_FILE):
+        self.file_path = Path(file_path)
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            self.file_path, check_same_thread=False, isolation_level=None
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprints ('
+            ' index_name TEXT, id TEXT, fingerprint BLOB,'
+            ' PRIMARY KEY (index_name, id)'
+            ') WITHOUT ROWID'
+        )
+
+    def get(self, index: str, ids: list[str]) -> list[bytes | None]:
+        found: dict[str, bytes] = {}
+        with self._lock:
+            # Stay below the default limit of 999 query parameters.
+            for start in range(0, len(ids), 900):
+                part = ids[start : start + 900]
+                found.update(
+                    self.connection.execute(
+                        'SELECT id, fingerprint FROM fingerprints '
+                        'WHERE index_name = ? AND id IN (%s)'
+                        % ','.join('?' * len(part)),
+                        [index, *part],
+                    )
+                )
+        return [found.get(id_) for id_ in ids]
+
+    def save(self, index: str, fingerprints: Mapping[str, bytes]) -> None:
+        with self._lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)',
+                [(index, id_, value) for id_, value in fingerprints.items()],
+            )
+
+    def discard(self, index: str, ids: list[str]) -> None:
+        with self._lock:
+            self.connection.executemany(
+                'DELETE FROM fingerprints WHERE index_name = ? AND id = ?',
+                [(index, id_) for id_ in ids],
+            )
+
+    def clear(self, index: str) -> None:
+        with self._lock:
+            self.connection.execute(
+                'DELETE FROM fingerprints '
+                'WHERE index_name = ? OR index_name GLOB ?',
+                [index, f'{index}:*'],
+            )
+
+
+_shared_store: FingerprintStore | None = None
+_shared_store_lock = threading.Lock()
+
+
+def get_fingerprints(mode: str = ETL_FINGERPRINTS) -> FingerprintStore | None:
+    """Returns the process-wide store configured by `ETL_FINGERPRINTS`.
+
+    Args:
+        mode (str, optional):
+            'redis', 'sqlite' or 'off'. Defaults to `ETL_FINGERPRINTS`.
+    """
+    global _shared_store
+    if mode not in ('redis', 'sqlite'):
+        return None
+    with _shared_store_lock:
+        if _shared_store is None:
+            if mode == 'redis':
+                _shared_store = RedisFingerprintStore(
+                    Redis(REDIS_HOST, REDIS_PORT)
+                )
+            else:
+                _shared_store = SqliteFingerprintStore()
+        return _shared_store
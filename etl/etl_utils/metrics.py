@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+import math
+import os
+import threading
+import time
+from collections.abc import Callable, Generator, Iterable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, TypeVar
+
+from etl_utils.loggers import setup_logger
+
+logger = setup_logger(__name__)
+
+T = TypeVar('T')
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value))
+
+
+def escape(value: str) -> str:
+    return (
+        value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+    )
+
+
+class Metric:
+    """Values of one metric by label values, in Prometheus text format."""
+
+    type = 'untyped'
+
+    def __init__(
+        self, name: str, documentation: str, labels: Iterable[str] = ()
+    ):
+        """
+        Args:
+            name (str):
+                metric name.
+            documentation (str):
+                `# HELP` text.
+            labels (Iterable[str], optional):
+                label names, every update gives a value for each of them.
+                Defaults to none.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def key(self, labels: dict[str, Any]) -> tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(
+                f'{self.name} expects labels {self.labels}, '
+                f'got {tuple(labels)}'
+            )
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], float]]:
+        with self._lock:
+            return [
+                (self.name, key, value) for key, value in self._values.items()
+            ]
+
+    def value(self, **labels: Any) -> float:
+        with self._lock:
+            return self._values.get(self.key(labels), 0.0)
+
+    def render(self) -> list[str]:
+        lines = [
+            f'# HELP {self.name} {escape(self.documentation)}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for name, key, value in self.samples():
+            labels = ','.join(
+                f'{label}="{escape(value)}"'
+                for label, value in zip(self.labels, key)
+            )
+            lines.append(
+                f'{name}{{{labels}}} {format_value(value)}'
+                if labels
+                else f'{name} {format_value(value)}'
+            )
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def remove(self, **labels: Any) -> None:
+        key = self.key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+
+
+class Summary(Metric):
+    """Sum and count of observations, e.g. durations."""
+
+    type = 'summary'
+
+    def __init__(
+        self, name: str, documentation: str, labels: Iterable[str] = ()
+    ):
+        super().__init__(name, documentation, labels)
+        self._counts: dict[tuple[str, ...], int] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], float]]:
+        with self._lock:
+            return [
+                sample
+                for key, value in self._values.items()
+                for sample in (
+                    (f'{self.name}_sum', key, value),
+                    (f'{self.name}_count', key, float(self._counts[key])),
+                )
+            ]
+
+
+class Stopwatch:
+    """Measures the time spent producing the items of wrapped iterables,
+    e.g. the part of an upload spent waiting for its documents."""
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+
+    def wrap(self, items: Iterable[T]) -> Generator[T, None, None]:
+        iterator = iter(items)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.seconds += time.perf_counter() - started
+                yield item
+        finally:
+            # Release e.g. the connection of a generator left unfinished.
+            close = getattr(iterator, 'close', None)
+            if close:
+                close()
+
+
+M = TypeVar('M', bound=Metric)
+
+
+class MetricsRegistry:
+    """Metrics of the ETL process.
+
+    In daemon mode they are served in the Prometheus text format by
+    `serve`; a cron run writes them to a file with `write`, for the
+    textfile collector of the node exporter. Collectors registered with
+    `add_collector` refresh computed values, like checkpoint lags, right
+    before the metrics are rendered.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._collectors: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def _register(
+        self,
+        metric_class: type[M],
+        name: str,
+        documentation: str,
+        labels: Iterable[str],
+    ) -> M:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, documentation, labels)
+                self._metrics[name] = metric
+            if not isinstance(metric, metric_class):
+                raise ValueError(f'{name} is already a {metric.type}')
+            return metric
+
+    def counter(
+        self, name: str, documentation: str, labels: Iterable[str] = ()
+    ) -> Counter:
+        return self._register(Counter, name, documentation, labels)
+
+    def gauge(
+        self, name: str, documentation: str, labels: Iterable[str] = ()
+    ) -> Gauge:
+        return self._register(Gauge, name, documentation, labels)
+
+    def summary(
+        self, name: str, documentation: str, labels: Iterable[str] = ()
+    ) -> Summary:
+        return self._register(Summary, name, documentation, labels)
+
+    def add_collector(self, collect: Callable[[], None]) -> None:
+        with self._lock:
+            self._collectors.append(collect)
+
+    def render(self) -> str:
+        """All the metrics in the Prometheus text format."""
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for collect in collectors:
+            try:
+                collect()
+            except Exception:
+                logger.exception('Metrics collector failed')
+        return ''.join(
+            f'{line}\n' for metric in metrics for line in metric.render()
+        )
+
+    def write(self, file_path: Path | str) -> None:
+        """Replaces the file with the metrics at once, so the collector
+        never reads a partial file."""
+        file_path = Path(file_path)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = file_path.with_name(f'.{file_path.name}.{os.getpid()}')
+        temp_path.write_text(self.render())
+        os.replace(temp_path, file_path)
+
+    def serve(self, port: int, host: str = '') -> ThreadingHTTPServer:
+        """Serves the metrics over HTTP from a daemon thread.
+
+        Returns:
+            ThreadingHTTPServer: the server, to `shutdown` when done.
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4; charset=utf-8'
+                )
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                logger.debug(format, *args)
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(
+            target=server.serve_forever, name='metrics', daemon=True
+        ).start()
+        logger.info('Serving metrics on port %d.', port)
+        return server
+
+
+_shared_registry = MetricsRegistry()
+
+
+def get_metrics() -> MetricsRegistry:
+    """Returns the process-wide metrics registry."""
+    return _shared_registry
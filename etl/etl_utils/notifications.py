@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from config import (
+    ETL_NOTIFY_CHANNEL,
+    ETL_NOTIFY_DEBOUNCE,
+    POSTGRES_DSL,
+    SCHEMA_FOLDER,
+)
+from psycopg2 import sql
+
+from etl_utils.backoff import backoff_function
+from etl_utils.loggers import setup_logger
+from etl_utils.pool import PostgresConnectionPool
+
+logger = setup_logger(__name__)
+
+TRIGGERS_FILE = SCHEMA_FOLDER / 'change_notify_triggers.sql'
+
+
+def install_triggers(
+    pool: PostgresConnectionPool, channel: str = ETL_NOTIFY_CHANNEL
+) -> None:
+    """Creates the triggers which send change notifications to the daemon.
+
+    Args:
+        pool (PostgresConnectionPool): connection pool.
+        channel (str, optional):
+            notification channel. Defaults to `ETL_NOTIFY_CHANNEL`.
+    """
+    query = sql.SQL(TRIGGERS_FILE.read_text()).format(
+        channel=sql.Literal(channel)
+    )
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query)
+        conn.commit()
+    logger.info('Change notification triggers installed.')
+
+
+class PostgresChangeListener:
+    """Waits for `NOTIFY` events sent by `etl_notify_change` triggers.
+
+    LISTEN is bound to a session, so the listener keeps its own autocommit
+    connection outside of the pool.
+    """
+
+    def __init__(
+        self,
+        dsl: dict[str, str | int] = POSTGRES_DSL,
+        channel: str = ETL_NOTIFY_CHANNEL,
+        debounce: float = ETL_NOTIFY_DEBOUNCE,
+    ):
+        """
+        Args:
+            dsl (dict[str, str | int], optional):
+                connection parameters. Defaults to `POSTGRES_DSL`.
+            channel (str, optional):
+                notification channel. Defaults to `ETL_NOTIFY_CHANNEL`.
+            debounce (float, optional):
+                seconds to keep collecting notifications after the first one,
+                so a burst of changes wakes the daemon once.
+                Defaults to `ETL_NOTIFY_DEBOUNCE`.
+        """
+        self.dsl = dsl
+        self.channel = channel
+        self.debounce = debounce
+        self.conn: psycopg2.extensions.connection | None = None
+
+    @backoff_function(psycopg2.OperationalError)
+    def connect(self) -> None:
+        self.close()
+        conn = psycopg2.connect(**self.dsl)  # type: ignore
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL('LISTEN {}').format(sql.Identifier(self.channel)))
+        self.conn = conn
+        logger.info('Listening for changes on channel "%s".', self.channel)
+
+    def close(self) -> None:
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = None
+
+    def _poll(self, timeout: float) -> set[str]:
+        assert self.conn is not None
+        if not self.conn.notifies:
+            readable, _, _ = select.select([self.conn], [], [], timeout)
+            if readable:
+                self.conn.poll()
+        tables = {notify.payload for notify in self.conn.notifies}
+        self.conn.notifies.clear()
+        return tables
+
+    def wait(
+        self, timeout: float, stop: threading.Event | None = None
+    ) -> set[str] | None:
+        """Blocks until some tables change or `timeout` expires.
+
+        Args:
+            timeout (float):
+                seconds to wait for notifications.
+            stop (threading.Event | None, optional):
+                event which interrupts waiting. Defaults to None.
+
+        Returns:
+            set[str] | None:
+                names of changed tables, or None if the timeout expired or the
+                connection was re-established and notifications may have been
+                missed; the caller should then poll every table.
+        """
+        if self.conn is None or self.conn.closed:
+            self.connect()
+            return None
+        deadline = time.monotonic() + timeout
+        try:
+            tables: set[str] = set()
+            while not tables:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (stop is not None and stop.is_set()):
+                    return None
+                tables = self._poll(min(remaining, 1.0))
+            debounce_deadline = time.monotonic() + self.debounce
+            while (remaining := debounce_deadline - time.monotonic()) > 0:
+                tables |= self._poll(remaining)
+        except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
+            logger.error('Change listener connection lost: %s', e)
+            self.connect()
+            return None
+        return tables
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from uuid import UUID
+
+from psycopg2 import sql
+
+UUID_SPACE = 2**128
+
+
+@dataclass(frozen=True)
+class IdPartition:
+    """One of `count` equal ranges of the UUID space.
+
+    Postgres compares UUIDs bytewise, i.e. in the order of their 128-bit
+    numbers, so the ranges are disjoint, cover every id and hold about the
+    same number of random (v4) ids.
+    """
+
+    index: int
+    count: int
+
+    @property
+    def name(self) -> str:
+        return f'p{self.index + 1}of{self.count}'
+
+    @property
+    def lower(self) -> str | None:
+        """First id of the range, None for the first partition."""
+        if self.index == 0:
+            return None
+        return str(UUID(int=UUID_SPACE * self.index // self.count))
+
+    @property
+    def upper(self) -> str | None:
+        """First id after the range, None for the last partition."""
+        if self.index == self.count - 1:
+            return None
+        return str(UUID(int=UUID_SPACE * (self.index + 1) // self.count))
+
+    def condition(self, column: sql.Composable) -> sql.Composable:
+        """SQL condition selecting the ids of the partition from `column`."""
+        conditions: list[sql.Composable] = []
+        if self.lower:
+            conditions.append(
+                sql.SQL('{} >= {}::uuid').format(
+                    column, sql.Literal(self.lower)
+                )
+            )
+        if self.upper:
+            conditions.append(
+                sql.SQL('{} < {}::uuid').format(
+                    column, sql.Literal(self.upper)
+                )
+            )
+        if not conditions:
+            return sql.SQL('TRUE')
+        return sql.SQL(' AND ').join(conditions)
+
+
+def id_partitions(count: int) -> list[IdPartition]:
+    """Splits the UUID space into `count` partitions."""
+    return [IdPartition(index, count) for index in range(count)]
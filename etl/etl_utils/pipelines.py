@@ -1,33 +1,157 @@
-from collections.abc import Generator
-from typing import Any, TypeVar
+import queue
+import threading
+import time
+from collections.abc import Callable, Generator
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, TypeVar, cast
 
-from config import REDIS_HOST, REDIS_PORT
+from config import (
+    ETL_CHECKPOINT_FLUSH_EVERY,
+    ETL_CHECKPOINT_FLUSH_INTERVAL,
+    ETL_PARTIAL_UPDATES,
+    ETL_STAGE_QUEUE_SIZE,
+    ETL_STAGED_PIPELINES,
+    POSTGRES_AGGREGATE_FILMS,
+    REDIS_HOST,
+    REDIS_PORT,
+)
 from psycopg2.extras import DictRow
 from redis import Redis
 
 from etl_utils.elastic_search_handlers import (
+    ElasticSearchAggregatedFilmTransformer,
     ElasticSearchFilmTransformer,
     ElasticSearchGenreTransformer,
     ElasticSearchLoader,
     ElasticSearchPersonTransformer,
 )
+from etl_utils.dedup import FilmDedup
+from etl_utils.loggers import setup_logger
+from etl_utils.metrics import Stopwatch, get_metrics
+from etl_utils.partitions import IdPartition
+from etl_utils.pool import PostgresConnectionPool, get_pool
 from etl_utils.postgres_handlers import (
+    MIN_UUID,
+    PostgresFilmAggregateMerger,
     PostgresFilmEnricher,
     PostgresFilmMerger,
     PostgresFilmProducer,
     PostgresGenreProducer,
     PostgresPersonProducer,
     PostgresProducer,
+    database_now,
 )
-from etl_utils.state import RedisStorage, State
+from etl_utils.renames import Propagation, RenamePropagator
+from etl_utils.state import RedisHashStorage, State
 
 ElasticSearchTransformer = TypeVar(
     'ElasticSearchTransformer',
     ElasticSearchGenreTransformer,
     ElasticSearchFilmTransformer,
+    ElasticSearchAggregatedFilmTransformer,
     ElasticSearchPersonTransformer,
 )
 
+logger = setup_logger(__name__)
+
+metrics = get_metrics()
+STAGE_SECONDS = metrics.counter(
+    'etl_stage_seconds_total',
+    'Seconds spent in the extract, transform and load stages.',
+    ['pipeline', 'stage'],
+)
+ROWS_EXTRACTED = metrics.counter(
+    'etl_rows_extracted_total',
+    'Rows extracted from Postgres and handed to the transformers.',
+    ['pipeline'],
+)
+DOCUMENTS_TRANSFORMED = metrics.counter(
+    'etl_documents_transformed_total',
+    'Documents built by the transformers.',
+    ['pipeline'],
+)
+QUEUE_DEPTH = metrics.gauge(
+    'etl_stage_queue_depth',
+    'Batches waiting between two stages of a staged run.',
+    ['pipeline', 'queue'],
+)
+
+# Data of one extracted batch, with the checkpoint commit to run once the
+# batch is loaded to ElasticSearch (None if it does not finish a batch).
+Unit = tuple[list[Any], Callable[[], None] | None]
+
+
+class BulkActions(list[dict[str, Any]]):
+    """Ready ElasticSearch actions extracted among the rows, e.g. the
+    scripted updates of `RenamePropagator`. The transform stage passes them
+    through, so they are loaded in order with the documents."""
+
+
+class _Stage(threading.Thread):
+    """Worker thread of a staged pipeline run, connected by bounded queues."""
+
+    def __init__(
+        self,
+        name: str,
+        target: Callable[[], None],
+        stop: threading.Event,
+        errors: list[BaseException],
+    ):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.stop = stop
+        self.errors = errors
+
+    def run(self) -> None:
+        try:
+            self.target()
+        except BaseException as e:
+            self.errors.append(e)
+            self.stop.set()
+
+
+def _put(
+    channel: queue.Queue[Unit | None],
+    item: Unit | None,
+    stop: threading.Event,
+) -> bool:
+    """Puts an item, blocking while the queue is full (backpressure).
+
+    Returns:
+        bool: False if the run was stopped while waiting.
+    """
+    while not stop.is_set():
+        try:
+            channel.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(
+    channel: queue.Queue[Unit | None], stop: threading.Event
+) -> Unit | None:
+    """Gets an item; None marks the end of the data or a stopped run."""
+    while not stop.is_set():
+        try:
+            return channel.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+
+def _chain(*callbacks: Callable[[], None] | None) -> Callable[[], None]:
+    """Joins callbacks of one unit, skipping the missing ones."""
+
+    def run() -> None:
+        for callback in callbacks:
+            if callback:
+                callback()
+
+    return run
+
 
 class BasePipeline:
     """Base ETL pipeline class.
@@ -42,6 +166,10 @@ class BasePipeline:
         self,
         redis_key: str,
         loader_batch_size: int = 128,
+        pool: PostgresConnectionPool | None = None,
+        staged: bool = ETL_STAGED_PIPELINES,
+        queue_size: int = ETL_STAGE_QUEUE_SIZE,
+        state: State | None = None,
     ):
         """
         Args:
@@ -49,15 +177,41 @@ class BasePipeline:
                 key for Redis state storage.
             loader_batch_size (int, optional):
                 batch size for object uploading to ElasticSearch. Defaults to 128.
+            pool (PostgresConnectionPool | None, optional):
+                Postgres connection pool shared by the handlers.
+                Defaults to the process-wide pool.
+            staged (bool, optional):
+                if True, `run` executes extract, transform and load in separate
+                threads (see `run_staged`). Defaults to `ETL_STAGED_PIPELINES`.
+            queue_size (int, optional):
+                batches buffered between two stages in staged mode.
+                Defaults to `ETL_STAGE_QUEUE_SIZE`.
+            state (State | None, optional):
+                checkpoint state, e.g. an in-memory one for benchmarks.
+                Defaults to the Redis hash `<redis_key>:checkpoints`.
         """
-        self.state = State(
-            RedisStorage(Redis(REDIS_HOST, REDIS_PORT), redis_key)
+        self.state = state or State(
+            RedisHashStorage(
+                Redis(REDIS_HOST, REDIS_PORT),
+                f'{redis_key}:checkpoints',
+                legacy_name=redis_key,
+            ),
+            flush_every=ETL_CHECKPOINT_FLUSH_EVERY,
+            flush_interval=ETL_CHECKPOINT_FLUSH_INTERVAL,
         )
+        # Label of the pipeline metrics, set to the scheduler name by
+        # `PipelineScheduler.add`.
+        self.name = redis_key
+        self.pool = pool or get_pool()
+        self.staged = staged
+        self.queue_size = queue_size
         self._es_transformer: ElasticSearchTransformer = None  # type: ignore
         self._es_loader: ElasticSearchLoader | None = None
         self._producer: PostgresProducer | None = None
         self._merger: PostgresFilmMerger | None = None
         self._enricher: PostgresFilmEnricher | None = None
+        self.dedup: FilmDedup | None = None
+        self.renames: RenamePropagator | None = None
 
     @property
     def es_transformer(self) -> ElasticSearchTransformer:
@@ -85,29 +239,167 @@ class BasePipeline:
     def enricher(self) -> PostgresFilmEnricher | None:
         return self._enricher
 
-    def extract(self) -> Generator[list[DictRow], None, None]:
+    @property
+    def loaders(self) -> list[ElasticSearchLoader]:
+        """Loaders of the indices the pipeline writes to."""
+        return [self.es_loader]
+
+    @property
+    def checkpoint_lag(self) -> float | None:
+        """Seconds from the `updated_at` of the last row behind the producer
+        checkpoint until now, None before the first checkpoint."""
+        last_modified = self.producer.get_last_modified()
+        if last_modified == datetime.min:
+            return None
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - last_modified).total_seconds()
+
+    def merge(
+        self,
+        films: list[DictRow],
+        changed_at: datetime | None = None,
+        commit: Callable[[], None] | None = None,
+    ) -> Generator[Unit, None, None]:
+        """Merges the filmworks which no pipeline merged since their change.
+
+        A streaming merger (see `PostgresFilmMerger.stream_batch`) yields
+        the rows in several groups of complete filmworks, followed by an
+        empty unit with the callbacks.
+
+        Args:
+            films (list[DictRow]):
+                (id, updated_at) DictRows of filmworks.
+            changed_at (datetime | None, optional):
+                time of the change which selected the filmworks. Defaults to
+                None, i.e. the `updated_at` of every filmwork.
+            commit (Callable[[], None] | None, optional):
+                checkpoint commit to run once all the rows are loaded.
+                Defaults to None.
+
+        Yields:
+            Unit:
+                merged rows; the last unit carries `commit` and the callback
+                recording the merge in `dedup`.
+        """
+        assert self.merger is not None
+        record = None
+        if self.dedup is not None:
+            fresh = set(
+                self.dedup.select(
+                    {
+                        str(film['id']): changed_at or film['updated_at']
+                        for film in films
+                    }
+                )
+            )
+            films = [film for film in films if str(film['id']) in fresh]
+            if not films:
+                yield [], commit
+                return
+            record = partial(
+                self.dedup.record, list(fresh), database_now(self.pool)
+            )
+        done = _chain(record, commit) if record or commit else None
+        if not self.merger.stream:
+            yield self.merger.merge_batch(films), done
+            return
+        for rows in self.merger.stream_batch(films):
+            yield rows, None
+        yield [], done
+
+    @property
+    def bootstraps(self) -> bool:
+        """True if the next run is the cold start of a film pipeline which
+        merges the filmworks it produces (see `bootstrap_units`)."""
+        return bool(
+            self.merger
+            and not self.enricher
+            and self.producer.bootstrap
+            and self.producer.cold
+        )
+
+    def bootstrap_units(self) -> Generator[Unit, None, None]:
+        """Extracts merged rows of all the filmworks with one `COPY` of the
+        merger's `keyset_query`, instead of producing pages of ids and
+        merging them batch by batch.
+
+        Batches end at filmwork keyset positions and move the producer
+        checkpoint, so an interrupted bootstrap resumes incrementally.
+
+        Yields:
+            Unit:
+                merged rows and the callback saving the producer checkpoint
+                and recording the merge in `dedup`.
+        """
+        assert self.merger is not None
+        merged_at = database_now(self.pool) if self.dedup else None
+        for rows in self.producer.copy_batches(
+            self.merger.keyset_query, 'fw_id'
+        ):
+            record = None
+            if self.dedup and merged_at:
+                ids = list(dict.fromkeys(str(row['fw_id']) for row in rows))
+                record = partial(self.dedup.record, ids, merged_at)
+            commit = partial(self.producer.commit_batch, rows, 'fw_id')
+            yield rows, _chain(record, commit)
+
+    def renamed(self, batch: list[DictRow]) -> Propagation:
+        """Propagates the renames of the batch with `renames`, if any.
+
+        Returns:
+            Propagation:
+                rows to enrich, the updates of the films of the renamed
+                entities and the callback to run once both are loaded.
+        """
+        if self.renames is None:
+            return batch, [], None
+        return self.renames.propagate(batch)
+
+    def extract(self) -> Generator[list[Any], None, None]:
         """Extracts all the data required by ElasticSearch scheme from Postgres.
 
         Yields:
-            list[DictRow]:
-                batch of Postgres DictRows with all the data required in ElasticSearch.
+            list[Any]:
+                batch of Postgres DictRows with all the data required in ElasticSearch,
+                or `BulkActions`.
         """
+        if self.bootstraps:
+            for rows, commit in self.bootstrap_units():
+                yield rows
+                if commit:
+                    commit()
+            return
         for batch in self.producer.produce_batch():
             if self.enricher and self.merger:
-                for enriched_batch in self.enricher.enrich_batch(batch):
-                    yield self.merger.merge_batch(enriched_batch)
+                rows, updates, save = self.renamed(batch)
+                if updates:
+                    yield BulkActions(updates)
+                if rows:
+                    for enriched_batch in self.enricher.enrich_batch(rows):
+                        for merged, record in self.merge(
+                            enriched_batch, batch[-1]['updated_at']
+                        ):
+                            yield merged
+                            if record:
+                                record()
+                if save:
+                    save()
             elif self.merger:
-                yield self.merger.merge_batch(batch)
+                for merged, record in self.merge(batch):
+                    yield merged
+                    if record:
+                        record()
             else:
                 yield batch
 
     def transform(
-        self, producer_data_generator: Generator[list[DictRow], None, None]
+        self, producer_data_generator: Generator[list[Any], None, None]
     ) -> Generator[dict[str, Any], None, None]:
         """Transforms raw data from Postgres Producer into ElasticSearch format.
 
         Args:
-            producer_data_generator (Generator[list[DictRow], None, None]):
+            producer_data_generator (Generator[list[Any], None, None]):
                 generator of Postgres DictRows with producer data
 
         Yields:
@@ -115,7 +407,22 @@ class BasePipeline:
                 dict with fields from ElasticSearch index mapping.
         """
         for producer_data_batch in producer_data_generator:
-            yield from self.es_transformer.transform(producer_data_batch)
+            yield from self.transform_batch(producer_data_batch)
+
+    def transform_batch(self, rows: list[Any]) -> list[dict[str, Any]]:
+        """Transforms one extracted batch, counted in the metrics."""
+        if isinstance(rows, BulkActions):
+            return rows
+        started = time.perf_counter()
+        documents = list(self.es_transformer.transform(rows))
+        STAGE_SECONDS.inc(
+            time.perf_counter() - started,
+            pipeline=self.name,
+            stage='transform',
+        )
+        ROWS_EXTRACTED.inc(len(rows), pipeline=self.name)
+        DOCUMENTS_TRANSFORMED.inc(len(documents), pipeline=self.name)
+        return documents
 
     def load(
         self, prepared_data: Generator[dict[str, Any], None, None]
@@ -126,11 +433,153 @@ class BasePipeline:
             prepared_data (Generator[dict[str, Any], None, None]):
                 generator of dicts from `transform` function in ElasticSearch index format.
         """
-        self.es_loader.upload(prepared_data)
+        # The upload pulls the documents through the previous stages, their
+        # time is measured apart and left out of the load stage.
+        source = Stopwatch()
+        started = time.perf_counter()
+        self.es_loader.upload(source.wrap(prepared_data))
+        STAGE_SECONDS.inc(
+            time.perf_counter() - started - source.seconds,
+            pipeline=self.name,
+            stage='load',
+        )
+
+    def extract_units(self) -> Generator[Unit, None, None]:
+        """Extracts data like `extract`, but leaves producer checkpoints
+        to the caller.
+
+        Yields:
+            Unit:
+                batch of Postgres DictRows and the producer checkpoint commit
+                to run after the batch is loaded, if the batch finishes one.
+        """
+        if self.bootstraps:
+            yield from self.bootstrap_units()
+            return
+        for batch in self.producer.produce_batch(auto_commit=False):
+            yield from self.batch_units(batch)
+
+    def batch_units(self, batch: list[DictRow]) -> Generator[Unit, None, None]:
+        """Extracts the data of one produced batch.
+
+        Args:
+            batch (list[DictRow]):
+                rows of the producer, e.g. from `FanOutPipeline`.
+
+        Yields:
+            Unit:
+                batch of Postgres DictRows; the last unit carries the commit
+                moving the producer checkpoint to the end of `batch`.
+        """
+        commit = partial(self.producer.commit_batch, batch)
+        if self.enricher and self.merger:
+            rows, updates, save = self.renamed(batch)
+            if updates:
+                yield BulkActions(updates), None
+            if rows:
+                for enriched_batch in self.enricher.enrich_batch(
+                    rows, checkpoint=False
+                ):
+                    yield from self.merge(
+                        enriched_batch, batch[-1]['updated_at']
+                    )
+            yield [], _chain(save, commit)
+        elif self.merger:
+            yield from self.merge(batch, commit=commit)
+        else:
+            yield batch, commit
+
+    def run_staged(self) -> None:
+        """Runs extract, transform and load concurrently.
+
+        Each stage works in its own thread and hands batches to the next one
+        through a queue of `queue_size` batches, so Postgres, the transformer
+        and ElasticSearch are busy at the same time and a slow stage blocks
+        the previous ones instead of buffering the whole table. Producer
+        checkpoints are saved only after ElasticSearch acknowledged the
+        batch, so a crash never skips unloaded data.
+        """
+        extracted: queue.Queue[Unit | None] = queue.Queue(self.queue_size)
+        transformed: queue.Queue[Unit | None] = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        errors: list[BaseException] = []
+
+        def extract_stage() -> None:
+            extract = Stopwatch()
+            units = extract.wrap(self.extract_units())
+            try:
+                for unit in units:
+                    if not _put(extracted, unit, stop):
+                        return
+                _put(extracted, None, stop)
+            finally:
+                units.close()
+                STAGE_SECONDS.inc(
+                    extract.seconds, pipeline=self.name, stage='extract'
+                )
+
+        def transform_stage() -> None:
+            while unit := _get(extracted, stop):
+                rows, commit = unit
+                documents = self.transform_batch(rows)
+                if not _put(transformed, (documents, commit), stop):
+                    return
+            _put(transformed, None, stop)
+
+        stages = [
+            _Stage('extract', extract_stage, stop, errors),
+            _Stage('transform', transform_stage, stop, errors),
+        ]
+        for stage in stages:
+            stage.start()
+        queues = {'extracted': extracted, 'transformed': transformed}
+        try:
+            while unit := _get(transformed, stop):
+                for name, channel in queues.items():
+                    QUEUE_DEPTH.set(
+                        channel.qsize(), pipeline=self.name, queue=name
+                    )
+                documents, commit = unit
+                started = time.perf_counter()
+                if documents:
+                    self.es_loader.upload(doc for doc in documents)
+                if commit:
+                    commit()
+                STAGE_SECONDS.inc(
+                    time.perf_counter() - started,
+                    pipeline=self.name,
+                    stage='load',
+                )
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            for stage in stages:
+                stage.join()
+            for name in queues:
+                QUEUE_DEPTH.set(0, pipeline=self.name, queue=name)
+        if errors:
+            raise errors[0]
 
     def run(self) -> None:
-        """Runs the whole ETL pipeline"""
-        self.load(self.transform(self.extract()))
+        """Runs the whole ETL pipeline.
+
+        Checkpoint writes are coalesced by `State`; all of them are saved
+        when the run ends, even if it fails.
+        """
+        try:
+            if self.staged:
+                self.run_staged()
+            else:
+                extract = Stopwatch()
+                try:
+                    self.load(self.transform(extract.wrap(self.extract())))
+                finally:
+                    STAGE_SECONDS.inc(
+                        extract.seconds, pipeline=self.name, stage='extract'
+                    )
+        finally:
+            self.state.flush()
 
 
 class GenreETLPipeline(BasePipeline):
@@ -139,6 +588,7 @@ class GenreETLPipeline(BasePipeline):
         redis_key: str,
         producer_batch_size: int = 128,
         loader_batch_size: int = 128,
+        pool: PostgresConnectionPool | None = None,
     ):
         """
         Args:
@@ -148,12 +598,14 @@ class GenreETLPipeline(BasePipeline):
                 batch size for batch producer to extract updated entities. Defaults to 128.
             loader_batch_size (int, optional):
                 batch size for object uploading to ElasticSearch. Defaults to 128.
+            pool (PostgresConnectionPool | None, optional):
+                Postgres connection pool. Defaults to the process-wide pool.
         """
-        super().__init__(redis_key, loader_batch_size)
+        super().__init__(redis_key, loader_batch_size, pool)
         self._es_loader = ElasticSearchLoader(loader_batch_size, 'genres')
         self._es_transformer = ElasticSearchGenreTransformer(self.state)
         self._producer = PostgresGenreProducer(
-            self.state, producer_batch_size, 'et_genre_producer'
+            self.state, producer_batch_size, 'et_genre_producer', self.pool
         )
 
 
@@ -163,6 +615,7 @@ class PersonETLPipeline(BasePipeline):
         redis_key: str,
         producer_batch_size: int = 128,
         loader_batch_size: int = 128,
+        pool: PostgresConnectionPool | None = None,
     ):
         """
         Args:
@@ -172,12 +625,14 @@ class PersonETLPipeline(BasePipeline):
                 batch size for batch producer to extract updated entities. Defaults to 128.
             loader_batch_size (int, optional):
                 batch size for object uploading to ElasticSearch. Defaults to 128.
+            pool (PostgresConnectionPool | None, optional):
+                Postgres connection pool. Defaults to the process-wide pool.
         """
-        super().__init__(redis_key, loader_batch_size)
+        super().__init__(redis_key, loader_batch_size, pool)
         self._es_loader = ElasticSearchLoader(loader_batch_size, 'persons')
         self._es_transformer = ElasticSearchPersonTransformer(self.state)
         self._producer = PostgresPersonProducer(
-            self.state, producer_batch_size, 'et_person_producer'
+            self.state, producer_batch_size, 'et_person_producer', self.pool
         )
 
 
@@ -190,6 +645,11 @@ class FilmETLPipeline(BasePipeline):
         enricher_batch_size: int = 128,
         producer_batch_size: int = 128,
         loader_batch_size: int = 128,
+        pool: PostgresConnectionPool | None = None,
+        aggregate: bool = POSTGRES_AGGREGATE_FILMS,
+        dedup: FilmDedup | None = None,
+        partition: IdPartition | None = None,
+        partial_updates: bool = ETL_PARTIAL_UPDATES,
     ):
         """
         Args:
@@ -205,15 +665,204 @@ class FilmETLPipeline(BasePipeline):
                 batch size for batch enricher to add data to updated entities. Defaults to 128.
             loader_batch_size (int, optional):
                 batch size for object uploading to ElasticSearch. Defaults to 128.
+            pool (PostgresConnectionPool | None, optional):
+                Postgres connection pool. Defaults to the process-wide pool.
+            aggregate (bool, optional):
+                if True, genres and persons are aggregated by Postgres into
+                one row per filmwork (`PostgresFilmAggregateMerger`).
+                Defaults to `POSTGRES_AGGREGATE_FILMS`.
+            dedup (FilmDedup | None, optional):
+                dedup window shared by the film pipelines, so a filmwork
+                changed together with its persons and genres is merged and
+                indexed once. Defaults to None.
+            partition (IdPartition | None, optional):
+                if given, only the filmworks with ids in the partition are
+                loaded, with checkpoints kept under
+                `<redis_key>:<partition name>`. Requires the `film_work`
+                table. Defaults to None.
+            partial_updates (bool, optional):
+                if True, an enrich pipeline of persons or genres updates
+                only the names in the films of renamed entities
+                (`RenamePropagator`). Requires a fingerprint store.
+                Defaults to `ETL_PARTIAL_UPDATES`.
         """
-        super().__init__(redis_key, loader_batch_size)
+        if partition:
+            redis_key = f'{redis_key}:{partition.name}'
+        super().__init__(redis_key, loader_batch_size, pool)
         self._es_loader = ElasticSearchLoader(loader_batch_size, 'movies')
-        self._es_transformer = ElasticSearchFilmTransformer(self.state)
         self._producer = PostgresFilmProducer(
-            self.state, producer_batch_size, 'et_person_producer', table_name
+            self.state,
+            producer_batch_size,
+            'et_person_producer',
+            table_name,
+            self.pool,
+            partition=partition,
         )
-        self._merger = PostgresFilmMerger()
+        if aggregate:
+            self._es_transformer = ElasticSearchAggregatedFilmTransformer(
+                self.state
+            )
+            self._merger = PostgresFilmAggregateMerger(self.pool, partition)
+        else:
+            self._es_transformer = ElasticSearchFilmTransformer(self.state)
+            self._merger = PostgresFilmMerger(self.pool, partition)
         if enrich:
             self._enricher = PostgresFilmEnricher(
-                self.state, enricher_batch_size, table_name
+                self.state, enricher_batch_size, table_name, self.pool
+            )
+            fingerprints = self.es_loader.fingerprints
+            if (
+                partial_updates
+                and fingerprints
+                and table_name in RenamePropagator.FIELDS
+            ):
+                self.renames = RenamePropagator(
+                    table_name, self.es_loader, fingerprints, self.pool
+                )
+        self.dedup = dedup
+
+
+class FanOutPipeline:
+    """Feeds several pipelines of one source table from a single scan.
+
+    The pipelines (sinks), e.g. the `persons` index and the film pipeline
+    enriched by persons, keep their own producer checkpoints, but their
+    producers don't read Postgres. Every cycle `source` scans the table
+    once from the oldest sink checkpoint, and each batch is handed to the
+    sinks which haven't processed its rows yet. A sink loads its part of
+    the batch and moves its checkpoint before the next batch is read, so
+    it resumes from its own position after a failure. A failed sink gets
+    no more batches in the run, the others go on.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        source: PostgresProducer,
+        sinks: list[BasePipeline],
+    ):
+        """
+        Args:
+            name (str):
+                label of the pipeline metrics, set to the scheduler name by
+                `PipelineScheduler.add`.
+            source (PostgresProducer):
+                producer of the scan. Its position is derived from the sinks,
+                so it should keep it in a `MemoryStorage` state. Sinks with
+                a producer of its class get its rows as they are, the others
+                `(id, updated_at)` rows of the changed entities, as
+                `PostgresFilmProducer` would produce.
+            sinks (list[BasePipeline]):
+                pipelines fed by the scan, run in this order for every batch.
+        """
+        self.name = name
+        self.source = source
+        self.sinks = sinks
+
+    @property
+    def loaders(self) -> list[ElasticSearchLoader]:
+        """Loaders of the indices the sinks write to."""
+        return [sink.es_loader for sink in self.sinks]
+
+    @property
+    def checkpoint_lag(self) -> float | None:
+        """Lag of the sink furthest behind, None if one has no checkpoint."""
+        lags = [sink.checkpoint_lag for sink in self.sinks]
+        if any(lag is None for lag in lags):
+            return None
+        return max(cast(list[float], lags))
+
+    @staticmethod
+    def position(
+        producer: PostgresProducer,
+    ) -> tuple[datetime, str] | None:
+        """`(updated_at, id)` checkpoint of a producer, None if it has none."""
+        if producer.cold:
+            return None
+        last_id = producer.get_last_id() or MIN_UUID
+        return producer.get_last_modified(), last_id
+
+    def sink_rows(
+        self, sink: BasePipeline, batch: list[DictRow]
+    ) -> list[DictRow]:
+        """Rows of the batch after the checkpoint of the sink, in the shape
+        of its producer."""
+        id_column = self.source.id_column
+        position = self.position(sink.producer)
+        if position is not None:
+            batch = [
+                row
+                for row in batch
+                if (row['updated_at'], str(row[id_column])) > position
+            ]
+        if not batch or type(sink.producer) is type(self.source):
+            return batch
+        rows = {
+            row[id_column]: {
+                'id': row[id_column],
+                'updated_at': row['updated_at'],
+            }
+            for row in batch
+        }
+        return cast(list[DictRow], list(rows.values()))
+
+    def feed(self, sink: BasePipeline, rows: list[DictRow]) -> None:
+        """Loads the rows of one batch with `sink`, then commits its
+        checkpoint."""
+        extract = Stopwatch()
+        load = 0.0
+        for data, commit in extract.wrap(sink.batch_units(rows)):
+            documents = sink.transform_batch(data)
+            started = time.perf_counter()
+            if documents:
+                sink.es_loader.upload(doc for doc in documents)
+            if commit:
+                commit()
+            load += time.perf_counter() - started
+        STAGE_SECONDS.inc(
+            extract.seconds, pipeline=sink.name, stage='extract'
+        )
+        STAGE_SECONDS.inc(load, pipeline=sink.name, stage='load')
+
+    def run(self) -> None:
+        """Scans the source once and feeds every batch to the sinks.
+
+        Raises:
+            Exception: the first error of a sink, once the scan is over.
+        """
+        positions = [self.position(sink.producer) for sink in self.sinks]
+        if any(position is None for position in positions):
+            self.source.set_last_modified(datetime.min)
+        else:
+            self.source.set_last_modified(
+                *min(cast(list[tuple[datetime, str]], positions))
+            )
+        errors: dict[str, Exception] = {}
+        scan = Stopwatch()
+        try:
+            for batch in scan.wrap(
+                self.source.produce_batch(auto_commit=False)
+            ):
+                for sink in self.sinks:
+                    if sink.name in errors:
+                        continue
+                    rows = self.sink_rows(sink, batch)
+                    if not rows:
+                        continue
+                    try:
+                        self.feed(sink, rows)
+                    except Exception as e:
+                        logger.exception(
+                            'Sink %s of %s failed', sink.name, self.name
+                        )
+                        errors[sink.name] = e
+                if len(errors) == len(self.sinks):
+                    break
+        finally:
+            STAGE_SECONDS.inc(
+                scan.seconds, pipeline=self.name, stage='extract'
             )
+            for sink in self.sinks:
+                sink.state.flush()
+        if errors:
+            raise next(iter(errors.values()))
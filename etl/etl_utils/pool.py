@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from collections.abc import Generator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any
+
+import psycopg2
+import psycopg2.extensions
+from config import (
+    POSTGRES_DSL,
+    POSTGRES_POOL_CHECKOUT_TIMEOUT,
+    POSTGRES_POOL_HEALTH_CHECK,
+    POSTGRES_POOL_MAX_IDLE,
+    POSTGRES_POOL_MAX_SIZE,
+    POSTGRES_POOL_MIN_SIZE,
+)
+
+from etl_utils.loggers import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class PoolTimeoutError(psycopg2.OperationalError):
+    """No connection became available in time.
+
+    Subclasses `OperationalError`, so `backoff_function`/`backoff_generator`
+    decorated handlers retry it like any other connection problem.
+    """
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """psycopg2 connection which remembers when it was last used by the pool
+    and which statements were prepared in its session."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.released_at = time.monotonic()
+        self.prepared: set[str] = set()
+
+
+@dataclass
+class PoolStats:
+    """Checkout statistics, used to size the pool."""
+
+    checkouts: int = 0
+    opened: int = 0
+    discarded: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+
+    @property
+    def wait_avg(self) -> float:
+        return self.wait_total / self.checkouts if self.checkouts else 0.0
+
+
+class PostgresConnectionPool:
+    """Thread-safe blocking pool of Postgres connections.
+
+    Connections are handed out by `connection()` and returned when the context
+    exits. Broken connections are discarded instead of being returned, and
+    every failure is raised as a psycopg2 `InterfaceError`/`OperationalError`
+    so the existing backoff decorators keep working.
+    """
+
+    def __init__(
+        self,
+        dsl: dict[str, str | int],
+        min_size: int = 1,
+        max_size: int = 10,
+        max_idle: float = 300,
+        checkout_timeout: float = 30,
+        health_check: bool = True,
+    ):
+        """
+        Args:
+            dsl (dict[str, str | int]):
+                connection parameters for `psycopg2.connect`.
+            min_size (int, optional):
+                connections opened when the pool starts. Defaults to 1.
+            max_size (int, optional):
+                maximum number of open connections. Defaults to 10.
+            max_idle (float, optional):
+                seconds after which an idle connection is closed instead of
+                being reused. Defaults to 300.
+            checkout_timeout (float, optional):
+                seconds to wait for a free connection. Defaults to 30.
+            health_check (bool, optional):
+                if True, runs `SELECT 1` on every checked out connection.
+                Defaults to True.
+        """
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError('Expected 0 <= min_size <= max_size, max_size > 0')
+        self.dsl = dsl
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.checkout_timeout = checkout_timeout
+        self.health_check = health_check
+        self.stats = PoolStats()
+        self._idle: deque[PooledConnection] = deque()
+        self._size = 0
+        self._closed = False
+        self._lock = threading.Condition()
+
+    def _connect(self) -> PooledConnection:
+        conn: PooledConnection = psycopg2.connect(
+            connection_factory=PooledConnection, **self.dsl  # type: ignore
+        )
+        self.stats.opened += 1
+        return conn
+
+    def _discard(self, conn: PooledConnection) -> None:
+        if not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        with self._lock:
+            self._size -= 1
+            self.stats.discarded += 1
+            self._lock.notify()
+
+    def _is_usable(self, conn: PooledConnection) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.released_at > self.max_idle:
+            return False
+        if not self.health_check:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def open(self) -> None:
+        """Opens `min_size` connections in advance."""
+        while True:
+            with self._lock:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                with self._lock:
+                    self._size -= 1
+                raise
+            self.putconn(conn)
+
+    def getconn(self) -> PooledConnection:
+        """Checks out a connection, waiting up to `checkout_timeout` seconds.
+
+        Raises:
+            PoolTimeoutError: if no connection is freed in time.
+        """
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        while True:
+            with self._lock:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self._closed:
+                        raise PoolTimeoutError(
+                            'No free Postgres connection in the pool '
+                            f'after {self.checkout_timeout:g} seconds'
+                        )
+                    self._lock.wait(remaining)
+                if self._closed:
+                    raise PoolTimeoutError('Connection pool is closed')
+                conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    self._size += 1
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except psycopg2.Error:
+                    with self._lock:
+                        self._size -= 1
+                        self._lock.notify()
+                    raise
+            elif not self._is_usable(conn):
+                self._discard(conn)
+                continue
+            waited = time.monotonic() - started
+            with self._lock:
+                self.stats.checkouts += 1
+                self.stats.wait_total += waited
+                self.stats.wait_max = max(self.stats.wait_max, waited)
+            return conn
+
+    def putconn(self, conn: PooledConnection, discard: bool = False) -> None:
+        """Returns a connection to the pool.
+
+        Args:
+            conn (PooledConnection):
+                connection obtained from `getconn`.
+            discard (bool, optional):
+                if True, the connection is closed instead. Defaults to False.
+        """
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed or self._closed:
+            self._discard(conn)
+            return
+        conn.released_at = time.monotonic()
+        with self._lock:
+            self._idle.append(conn)
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self) -> Generator[PooledConnection, None, None]:
+        """Context manager which checks a connection out and back in.
+
+        The open transaction is rolled back on return. Connections which
+        failed with `InterfaceError`/`OperationalError` are discarded.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+            self.putconn(conn, discard=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def close(self) -> None:
+        """Closes all idle connections and refuses new checkouts."""
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._lock.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    def log_stats(self) -> None:
+        logger.info(
+            'Postgres pool: %d checkouts, %d opened, %d discarded. '
+            'Checkout wait avg %.4fs, max %.4fs.',
+            self.stats.checkouts,
+            self.stats.opened,
+            self.stats.discarded,
+            self.stats.wait_avg,
+            self.stats.wait_max,
+        )
+
+
+_shared_pool: PostgresConnectionPool | None = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_pool() -> PostgresConnectionPool:
+    """Returns the process-wide pool configured from `config`."""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None or _shared_pool._closed:
+            _shared_pool = PostgresConnectionPool(
+                POSTGRES_DSL,
+                min_size=POSTGRES_POOL_MIN_SIZE,
+                max_size=POSTGRES_POOL_MAX_SIZE,
+                max_idle=POSTGRES_POOL_MAX_IDLE,
+                checkout_timeout=POSTGRES_POOL_CHECKOUT_TIMEOUT,
+                health_check=POSTGRES_POOL_HEALTH_CHECK,
+            )
+        return _shared_pool
+
+
+def close_pool() -> None:
+    """Logs statistics and closes the process-wide pool, if any."""
+    global _shared_pool
+    with _shared_pool_lock:
+        pool, _shared_pool = _shared_pool, None
+    if pool is not None:
+        pool.log_stats()
+        pool.close()
@@ -1,50 +1,419 @@
-from collections.abc import Generator
+import io
+import re
+from collections.abc import Generator, Iterable, Mapping
 from contextlib import closing
 from datetime import datetime
+from typing import Any, cast
+from uuid import uuid4
 
 import psycopg2
-from config import POSTGRES_DSL
+from config import (
+    POSTGRES_COPY_BOOTSTRAP,
+    POSTGRES_CURSOR_ITERSIZE,
+    POSTGRES_ID_TEMP_TABLE_THRESHOLD,
+    POSTGRES_SERVER_SIDE_CURSORS,
+    POSTGRES_STREAM_MERGE,
+    SCHEMA_FOLDER,
+)
 from psycopg2 import sql
+from psycopg2.extensions import cursor as Cursor
 from psycopg2.extras import DictCursor, DictRow
 
 from etl_utils.backoff import backoff_function, backoff_generator
+from etl_utils.copy_stream import copy_rows
 from etl_utils.loggers import setup_logger
+from etl_utils.partitions import IdPartition
+from etl_utils.pool import PooledConnection, PostgresConnectionPool, get_pool
 from etl_utils.state import State, StatefulMixin
 
 logger = setup_logger(__file__)
 
+MIN_UUID = '00000000-0000-0000-0000-000000000000'
+
+CUSTOM_PLAN = 'SET LOCAL plan_cache_mode = force_custom_plan;'
+
+INDEXES_FILE = SCHEMA_FOLDER / 'keyset_indexes.sql'
+
+
+def database_now(pool: PostgresConnectionPool) -> datetime:
+    """Current time of the Postgres server, comparable with `updated_at`."""
+    with pool.connection() as conn:
+        with closing(conn.cursor()) as cur:
+            cur.execute('SELECT now();')
+            row = cur.fetchone()
+    assert row is not None
+    now: datetime = row[0]
+    return now
+
+
+def install_indexes(pool: PostgresConnectionPool) -> None:
+    """Creates the indexes of the keyset pagination, if they don't exist."""
+    with pool.connection() as conn:
+        with closing(conn.cursor()) as cur:
+            cur.execute(INDEXES_FILE.read_text())
+        conn.commit()
+    logger.info('Keyset pagination indexes installed.')
+
+
+class IdBatchQuery:
+    """Query filtered by a batch of ids.
+
+    Batches of up to `threshold` ids are passed as one `uuid[]` parameter,
+    joined through `unnest`, to a statement prepared once per pooled
+    connection, so batches of any size reuse one parsed statement. Larger
+    batches are copied into an analyzed temporary table, which lets the
+    planner see their real size.
+    """
+
+    PARAMETER = re.compile(r'%\((\w+)\)s')
+
+    def __init__(
+        self,
+        name: str,
+        template: sql.SQL,
+        column: sql.Composable,
+        identifiers: Mapping[str, sql.Composable] | None = None,
+        threshold: int = POSTGRES_ID_TEMP_TABLE_THRESHOLD,
+        order_by: sql.Composable | None = None,
+        custom_plan: bool = False,
+    ):
+        """
+        Args:
+            name (str):
+                name of the prepared statement.
+            template (sql.SQL):
+                query with the `{ids}` filter placeholder and `%(name)s`
+                parameters.
+            column (sql.Composable):
+                column compared with the ids.
+            identifiers (Mapping[str, sql.Composable] | None, optional):
+                other named `{}` fields of the template. Defaults to None.
+            threshold (int, optional):
+                maximum batch passed as an array.
+                Defaults to `POSTGRES_ID_TEMP_TABLE_THRESHOLD`.
+            order_by (sql.Composable | None, optional):
+                ordering appended to the `{ids}` filter. Defaults to None.
+            custom_plan (bool, optional):
+                plan the prepared statement with the actual ids on every
+                run, by `plan_cache_mode=force_custom_plan` until the end of
+                the transaction. A generic plan assumes a few ids, so an
+                `ORDER BY ... LIMIT` query would walk its ordering index
+                instead of joining the ids. Defaults to False.
+        """
+        self.name = name
+        self.threshold = threshold
+        self.custom_plan = custom_plan
+        identifiers = identifiers or {}
+        order: sql.Composable = sql.SQL('')
+        if order_by is not None:
+            order = sql.SQL('\nORDER BY {}').format(order_by)
+        self.array_query = template.format(
+            ids=sql.SQL('{} IN (SELECT unnest(%(ids)s::uuid[])){}').format(
+                column, order
+            ),
+            **identifiers,
+        )
+        self.temp_table_query = template.format(
+            ids=sql.SQL('{} IN (SELECT id FROM etl_lookup_ids){}').format(
+                column, order
+            ),
+            **identifiers,
+        )
+
+    def execute(
+        self, cur: Cursor, ids: Iterable[Any], params: dict[str, Any]
+    ) -> None:
+        """Executes the query for the ids with the other `params`."""
+        unique_ids = list(dict.fromkeys(str(id_) for id_ in ids))
+        if len(unique_ids) > self.threshold:
+            self.fill_lookup_table(cur, unique_ids)
+            cur.execute(self.temp_table_query, params)
+            return
+        params = {'ids': '{%s}' % ','.join(unique_ids), **params}
+        conn = cast(PooledConnection, cur.connection)
+        if self.name not in conn.prepared:
+            names = list(params)
+            text = self.PARAMETER.sub(
+                lambda match: f'${names.index(match.group(1)) + 1}',
+                self.array_query.as_string(conn),
+            )
+            cur.execute(
+                sql.SQL('PREPARE {} AS {}').format(
+                    sql.Identifier(self.name), sql.SQL(text)
+                )
+            )
+            conn.prepared.add(self.name)
+        query = sql.SQL('EXECUTE {} ({})').format(
+            sql.Identifier(self.name),
+            sql.SQL(', ').join(map(sql.Placeholder, params)),
+        )
+        if self.custom_plan:
+            query = sql.SQL(CUSTOM_PLAN) + query
+        cur.execute(query, params)
+
+    def fill_lookup_table(self, cur: Cursor, ids: list[str]) -> None:
+        """Copies the ids into the `etl_lookup_ids` table of the
+        transaction."""
+        cur.execute(
+            'DROP TABLE IF EXISTS pg_temp.etl_lookup_ids;'
+            'CREATE TEMP TABLE etl_lookup_ids (id uuid) ON COMMIT DROP;'
+        )
+        cur.copy_from(  # type: ignore
+            io.StringIO('\n'.join(ids)), 'etl_lookup_ids'
+        )
+        cur.execute('ANALYZE etl_lookup_ids;')
+
+    def stream(
+        self,
+        conn: PooledConnection,
+        ids: Iterable[Any],
+        params: dict[str, Any],
+        itersize: int = POSTGRES_CURSOR_ITERSIZE,
+    ) -> Generator[DictRow, None, None]:
+        """Streams the rows for the ids through a named server-side cursor,
+        fetching `itersize` rows per round trip.
+
+        A cursor can not be declared for a prepared statement, so the query
+        is sent as text.
+        """
+        unique_ids = list(dict.fromkeys(str(id_) for id_ in ids))
+        query = self.array_query
+        if len(unique_ids) > self.threshold:
+            with closing(conn.cursor()) as cur:
+                self.fill_lookup_table(cur, unique_ids)
+            query = self.temp_table_query
+        else:
+            params = {'ids': '{%s}' % ','.join(unique_ids), **params}
+        cursor = conn.cursor(
+            name=f'{self.name}_{uuid4().hex}', cursor_factory=DictCursor
+        )
+        with closing(cursor) as cur:
+            cur.execute(query, params)
+            while rows := cur.fetchmany(itersize):
+                yield from rows
+
 
 class PostgresProducer(StatefulMixin):
+    """Produces batches of rows ordered by the `(updated_at, id)` keyset.
+
+    `query` takes `updated_at`, `id` and `limit` named parameters and must
+    return rows ordered by `updated_at, <id_column>`.
+    """
+
+    id_column = 'id'
+
     def __init__(
         self,
         query: sql.SQL | sql.Composed,
         state: State,
         batch_size: int,
         name: str,
+        pool: PostgresConnectionPool | None = None,
+        server_side: bool = POSTGRES_SERVER_SIDE_CURSORS,
+        itersize: int = POSTGRES_CURSOR_ITERSIZE,
+        bootstrap: bool = POSTGRES_COPY_BOOTSTRAP,
     ):
+        """
+        Args:
+            query (sql.SQL | sql.Composed):
+                keyset query with `updated_at`, `id` and `limit` parameters.
+            state (State):
+                state storage for the `last_modified` checkpoint.
+            batch_size (int):
+                number of rows in a produced batch.
+            name (str):
+                prefix of the state key.
+            pool (PostgresConnectionPool | None, optional):
+                connection pool. Defaults to the process-wide pool.
+            server_side (bool, optional):
+                if True, all the rows after the checkpoint are streamed
+                through one named server-side cursor instead of one bounded
+                query per batch, so only `itersize` rows are held in memory.
+                Defaults to `POSTGRES_SERVER_SIDE_CURSORS`.
+            itersize (int, optional):
+                rows fetched from the server per network round trip
+                in `server_side` mode. Defaults to `POSTGRES_CURSOR_ITERSIZE`.
+            bootstrap (bool, optional):
+                if True, a producer without a checkpoint (the first run or
+                a full reindex) streams all the rows with `COPY ... TO
+                STDOUT` (see `copy_batches`). Defaults to
+                `POSTGRES_COPY_BOOTSTRAP`.
+        """
         super().__init__(state, f'{name}_last_modified')
         self.batch_size = batch_size
         self.query = query
+        self.pool = pool or get_pool()
+        self.server_side = server_side
+        self.itersize = itersize
+        self.bootstrap = bootstrap
+
+    def keyset_params(
+        self, updated_at: datetime, last_id: str | None, limit: int | None
+    ) -> dict[str, Any]:
+        """Query parameters for rows after the `(updated_at, id)` position.
+
+        Args:
+            updated_at (datetime):
+                `updated_at` of the last processed row.
+            last_id (str | None):
+                id of the last processed row, `None` if unknown.
+            limit (int | None):
+                maximum number of rows, `None` for no limit.
+        """
+        return {
+            'updated_at': updated_at,
+            'id': last_id or MIN_UUID,
+            'limit': limit,
+        }
+
+    def commit_batch(
+        self, batch: list[DictRow], id_column: str | None = None
+    ) -> None:
+        """Moves the checkpoint to the last row of a processed batch."""
+        last_row = batch[-1]
+        self.set_last_modified(
+            last_row['updated_at'], str(last_row[id_column or self.id_column])
+        )
+
+    @property
+    def cold(self) -> bool:
+        """True if the producer has no checkpoint yet."""
+        return self.get_last_modified() == datetime.min
+
+    def split_batches(
+        self, rows: Iterable[DictRow], id_column: str | None = None
+    ) -> Generator[list[DictRow], None, None]:
+        """Cuts rows into batches of about `batch_size` rows.
+
+        Rows sharing one keyset position (e.g. one person joined with its
+        films) are never split between batches, so every batch ends exactly
+        at a position the checkpoint can resume from.
+        """
+        id_column = id_column or self.id_column
+        batch: list[DictRow] = []
+        for row in rows:
+            if (
+                len(batch) >= self.batch_size
+                and row[id_column] != batch[-1][id_column]
+            ):
+                yield batch
+                batch = []
+            batch.append(row)
+        if batch:
+            yield batch
 
     @backoff_generator(psycopg2.InterfaceError, psycopg2.OperationalError)
-    def produce_batch(self) -> Generator[list[DictRow], None, None]:
-        """Extracts all entities updated after specific time, saved in the state.
+    def produce_batch(
+        self, auto_commit: bool = True
+    ) -> Generator[list[DictRow], None, None]:
+        """Extracts all entities updated after the `(updated_at, id)` position
+        saved in the state.
+
+        Args:
+            auto_commit (bool, optional):
+                if True, the position is saved after each yielded batch is
+                processed. Otherwise the caller saves it with `commit_batch`
+                once the batch is loaded. Defaults to True.
 
         Yields:
             list[DictRow]:
                 batch of (id, updated_at) DictRows from arbitary table.
         """
-        with closing(psycopg2.connect(**POSTGRES_DSL)) as conn:  # type: ignore
-            with closing(conn.cursor(cursor_factory=DictCursor)) as cur:
-                updated_after = self.get_last_modified()
-                cur.execute(self.query, (updated_after,))
-                while batch := cur.fetchmany(self.batch_size):
-                    yield batch
-                    self.set_last_modified(batch[-1]['updated_at'])
+        if self.bootstrap and self.cold:
+            batches = self.copy_batches()
+        elif self.server_side:
+            batches = self._stream_batches()
+        else:
+            batches = self._page_batches()
+        for batch in batches:
+            yield batch
+            if auto_commit:
+                self.commit_batch(batch)
+
+    def _page_batches(self) -> Generator[list[DictRow], None, None]:
+        """Runs one bounded keyset query per batch; the connection goes back
+        to the pool before the batch is yielded."""
+        updated_at, last_id = self.get_last_modified(), self.get_last_id()
+        while True:
+            with self.pool.connection() as conn:
+                with closing(conn.cursor(cursor_factory=DictCursor)) as cur:
+                    cur.execute(
+                        self.query,
+                        self.keyset_params(updated_at, last_id, self.batch_size),
+                    )
+                    rows = cur.fetchall()
+            if not rows:
+                return
+            updated_at = rows[-1]['updated_at']
+            last_id = str(rows[-1][self.id_column])
+            yield from self.split_batches(rows)
+
+    def _stream_batches(self) -> Generator[list[DictRow], None, None]:
+        """Streams all the rows after the checkpoint through a named cursor."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor(
+                name=f'{self.state_key}_{uuid4().hex}',
+                cursor_factory=DictCursor,
+            )
+            cursor.itersize = self.itersize
+            with closing(cursor) as cur:
+                cur.execute(
+                    self.query,
+                    self.keyset_params(
+                        self.get_last_modified(), self.get_last_id(), None
+                    ),
+                )
+                yield from self.split_batches(cur)
+
+    @backoff_generator(psycopg2.InterfaceError, psycopg2.OperationalError)
+    def copy_batches(
+        self,
+        query: sql.Composable | None = None,
+        id_column: str | None = None,
+    ) -> Generator[list[DictRow], None, None]:
+        """Streams all the rows after the checkpoint with one
+        `COPY (...) TO STDOUT`.
+
+        The rows skip the per-row `DictRow` building of the regular protocol
+        (see `copy_rows`), which makes the first full load several times
+        faster than the keyset pages. Batches still end at keyset positions,
+        so a failed load resumes through the incremental path.
+
+        Args:
+            query (sql.Composable | None, optional):
+                keyset query with `updated_at` and `id` parameters, ordered
+                by `updated_at, <id_column>`. Defaults to the producer query.
+            id_column (str | None, optional):
+                id column of `query`. Defaults to `id_column`.
+
+        Yields:
+            list[DictRow]: batches of `CopyRow` rows.
+        """
+        params = self.keyset_params(
+            self.get_last_modified(), self.get_last_id(), None
+        )
+        with self.pool.connection() as conn:
+            rows = copy_rows(conn, query or self.query, params)
+            try:
+                # `CopyRow` gives the column access the handlers use.
+                yield from self.split_batches(
+                    cast(Iterable[DictRow], rows), id_column
+                )
+            finally:
+                rows.close()
 
 
 class PostgresPersonProducer(PostgresProducer):
-    def __init__(self, state: State, batch_size: int, name: str):
+    id_column = 'p_id'
+
+    def __init__(
+        self,
+        state: State,
+        batch_size: int,
+        name: str,
+        pool: PostgresConnectionPool | None = None,
+        server_side: bool = POSTGRES_SERVER_SIDE_CURSORS,
+    ):
         query = sql.SQL(
             """
             SELECT
@@ -52,16 +421,28 @@ class PostgresPersonProducer(PostgresProducer):
                 p.full_name as p_full_name,
                 pfw.film_work_id as f_id,
                 p.updated_at
-            FROM content.person p
+            FROM (
+                SELECT id, full_name, updated_at
+                FROM content.person
+                WHERE (updated_at, id) > (%(updated_at)s, %(id)s)
+                ORDER BY updated_at, id
+                LIMIT %(limit)s
+            ) p
             LEFT JOIN content.person_film_work pfw ON pfw.person_id = p.id
-            WHERE p.updated_at > %s
-            ORDER BY p.updated_at;"""
+            ORDER BY p.updated_at, p.id;"""
         )
-        super().__init__(query, state, batch_size, name)
+        super().__init__(query, state, batch_size, name, pool, server_side)
 
 
 class PostgresGenreProducer(PostgresProducer):
-    def __init__(self, state: State, batch_size: int, name: str):
+    def __init__(
+        self,
+        state: State,
+        batch_size: int,
+        name: str,
+        pool: PostgresConnectionPool | None = None,
+        server_side: bool = POSTGRES_SERVER_SIDE_CURSORS,
+    ):
         query = sql.SQL(
             """
             SELECT
@@ -70,92 +451,335 @@ class PostgresGenreProducer(PostgresProducer):
                 description,
                 updated_at
             FROM content.genre
-            WHERE updated_at > %s
-            ORDER BY updated_at;"""
+            WHERE (updated_at, id) > (%(updated_at)s, %(id)s)
+            ORDER BY updated_at, id
+            LIMIT %(limit)s;"""
         )
-        super().__init__(query, state, batch_size, name)
+        super().__init__(query, state, batch_size, name, pool, server_side)
 
 
 class PostgresFilmProducer(PostgresProducer):
-    def __init__(self, state: State, batch_size: int, name: str, table: str):
+    def __init__(
+        self,
+        state: State,
+        batch_size: int,
+        name: str,
+        table: str,
+        pool: PostgresConnectionPool | None = None,
+        server_side: bool = POSTGRES_SERVER_SIDE_CURSORS,
+        partition: IdPartition | None = None,
+    ):
+        """
+        Args:
+            partition (IdPartition | None, optional):
+                if given, only the rows with ids in the partition are
+                produced, e.g. filmworks loaded by one process of a
+                partitioned reindex. Defaults to None.
+
+        Other arguments are described in `PostgresProducer`.
+        """
         self.table = table
+        self.partition = partition
+        partition_filter: sql.Composable = sql.SQL('')
+        if partition:
+            partition_filter = sql.SQL(' AND {}').format(
+                partition.condition(sql.Identifier('id'))
+            )
         query = sql.SQL(
             """
             SELECT id, updated_at
             FROM {}
-            WHERE updated_at > %s
-            ORDER BY updated_at;"""
-        ).format(sql.Identifier('content', table))
-        super().__init__(query, state, batch_size, name)
+            WHERE (updated_at, id) > (%(updated_at)s, %(id)s){}
+            ORDER BY updated_at, id
+            LIMIT %(limit)s;"""
+        ).format(sql.Identifier('content', table), partition_filter)
+        super().__init__(query, state, batch_size, name, pool, server_side)
 
 
 class PostgresFilmEnricher(StatefulMixin):
-    def __init__(self, state: State, batch_size: int, table: str):
+    def __init__(
+        self,
+        state: State,
+        batch_size: int,
+        table: str,
+        pool: PostgresConnectionPool | None = None,
+    ):
         super().__init__(state, f'{table}_enricher_last_modified')
         self.table = table
         self.batch_size = batch_size
-        self.query = sql.SQL(
-            """
-            SELECT fw.id, fw.updated_at
-            FROM content.film_work fw
-            LEFT JOIN {} produced ON produced.film_work_id = fw.id
-            WHERE {} IN %s AND fw.updated_at > %s
-            ORDER BY fw.updated_at;"""
-        ).format(
-            sql.Identifier('content', f'{table}_film_work'),
+        self.pool = pool or get_pool()
+        self.query = IdBatchQuery(
+            f'etl_enrich_by_{table}',
+            sql.SQL(
+                """
+                SELECT fw.id, fw.updated_at
+                FROM content.film_work fw
+                WHERE fw.id IN (
+                    SELECT film_work_id FROM {link_table} WHERE {ids}
+                )
+                AND (fw.updated_at, fw.id) > (%(updated_at)s, %(id)s)
+                ORDER BY fw.updated_at, fw.id
+                LIMIT %(limit)s;"""
+            ),
             sql.Identifier(f'{table}_id'),
+            {'link_table': sql.Identifier('content', f'{table}_film_work')},
+            custom_plan=True,
         )
 
     @backoff_generator(psycopg2.InterfaceError, psycopg2.OperationalError)
     def enrich_batch(
-        self, batch: list[DictRow]
+        self, batch: list[DictRow], checkpoint: bool = True
     ) -> Generator[list[DictRow], None, None]:
-        """Extracts all filmworks associated with entities in the batch
-            if these filmworks were updated after specific time, saved in the state.
+        """Extracts all filmworks associated with entities in the batch,
+            one bounded keyset query per yielded batch. The `(updated_at, id)`
+            position inside the batch is saved in the state, so an interrupted
+            batch resumes after the last processed filmwork.
 
         Args:
             batch: list[DictRow]:
                 list of (id, updated_at) DictRows form arbitary table.
+            checkpoint (bool, optional):
+                if False, the position is neither read from nor saved to the
+                state, and the whole batch is enriched. Used when the caller
+                saves producer checkpoints only after the data is loaded.
+                Defaults to True.
         Yields:
             list[DictRow]:
                 batch of (id, updated_at) DictRows from `film_work` table.
         """
-        with closing(psycopg2.connect(**POSTGRES_DSL)) as conn:  # type: ignore
-            with closing(conn.cursor(cursor_factory=DictCursor)) as cur:
-                updated_after = self.get_last_modified()
-                cur.execute(
-                    self.query,
-                    (tuple(row['id'] for row in batch), updated_after),
-                )
-                while batch := cur.fetchmany(self.batch_size):
-                    self.set_last_modified(batch[-1]['updated_at'])
-                    yield batch
-                self.set_last_modified(datetime.min)
+        ids = [row['id'] for row in batch]
+        updated_at, last_id = datetime.min, None
+        if checkpoint:
+            updated_at, last_id = self.get_last_modified(), self.get_last_id()
+        while True:
+            with self.pool.connection() as conn:
+                with closing(conn.cursor(cursor_factory=DictCursor)) as cur:
+                    self.query.execute(
+                        cur,
+                        ids,
+                        {
+                            'updated_at': updated_at,
+                            'id': last_id or MIN_UUID,
+                            'limit': self.batch_size,
+                        },
+                    )
+                    films = cur.fetchall()
+            if not films:
+                break
+            updated_at, last_id = films[-1]['updated_at'], films[-1]['id']
+            yield films
+            if checkpoint:
+                self.set_last_modified(updated_at, last_id)
+        if checkpoint:
+            self.set_last_modified(datetime.min)
 
 
-class PostgresFilmMerger:
-    def __init__(self) -> None:
-        self.query = sql.SQL(
+class PostgresEntityRows:
+    """Reads persons or genres by id, in the rows of their producers, for
+    sources which know the ids of the changed entities (see `etl_utils.cdc`).
+    """
+
+    QUERIES = {
+        'person': sql.SQL(
             """
             SELECT
-                fw.id as fw_id,
-                fw.title,
-                fw.description,
-                fw.rating,
-                fw.type,
-                fw.created_at,
-                fw.updated_at,
-                pfw.role as p_role,
                 p.id as p_id,
                 p.full_name as p_full_name,
-                g.name as g_name,
-                g.id as g_id
-            FROM content.film_work fw
-            LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-            LEFT JOIN content.person p ON p.id = pfw.person_id
-            LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-            LEFT JOIN content.genre g ON g.id = gfw.genre_id
-            WHERE fw.id IN %s;"""
+                pfw.film_work_id as f_id,
+                p.updated_at
+            FROM content.person p
+            LEFT JOIN content.person_film_work pfw ON pfw.person_id = p.id
+            WHERE {ids}"""
+        ),
+        'genre': sql.SQL(
+            """
+            SELECT
+                g.id,
+                g.name,
+                g.description,
+                g.updated_at
+            FROM content.genre g
+            WHERE {ids}"""
+        ),
+    }
+    ID_COLUMNS = {'person': 'p.id', 'genre': 'g.id'}
+
+    def __init__(self, table: str, pool: PostgresConnectionPool | None = None):
+        """
+        Args:
+            table (str):
+                'person' or 'genre'.
+            pool (PostgresConnectionPool | None, optional):
+                connection pool. Defaults to the process-wide pool.
+        """
+        self.table = table
+        self.pool = pool or get_pool()
+        self.query = IdBatchQuery(
+            f'etl_{table}_rows',
+            self.QUERIES[table],
+            sql.SQL(self.ID_COLUMNS[table]),
+            # The person transformer groups the rows of a person.
+            order_by=sql.SQL(self.ID_COLUMNS[table]),
+        )
+
+    @backoff_function(psycopg2.InterfaceError, psycopg2.OperationalError)
+    def fetch(self, ids: Iterable[str]) -> list[DictRow]:
+        """Selects the rows of the entities; deleted ones have none."""
+        with self.pool.connection() as conn:
+            with closing(conn.cursor(cursor_factory=DictCursor)) as cur:
+                self.query.execute(cur, ids, {})
+                return cur.fetchall()
+
+
+class PostgresEntityLinks:
+    """Reads the name of persons or genres together with their links to
+    filmworks, to tell a rename from a change of the film documents."""
+
+    NAME_COLUMNS = {'person': 'full_name', 'genre': 'name'}
+
+    def __init__(self, table: str, pool: PostgresConnectionPool | None = None):
+        """
+        Args:
+            table (str):
+                'person' or 'genre'.
+            pool (PostgresConnectionPool | None, optional):
+                connection pool. Defaults to the process-wide pool.
+        """
+        self.table = table
+        self.pool = pool or get_pool()
+        # Genre links have no role, person links are compared with it.
+        role = sql.SQL("l.role || ','" if table == 'person' else "','")
+        self.query = IdBatchQuery(
+            f'etl_links_of_{table}',
+            sql.SQL(
+                """
+                SELECT
+                    e.id,
+                    e.{name} AS name,
+                    md5(coalesce(string_agg(
+                        l.film_work_id::text || ',' || {role},
+                        '' ORDER BY l.film_work_id, {role}
+                    ), '')) AS links,
+                    coalesce(array_agg(DISTINCT l.film_work_id::text)
+                        FILTER (WHERE l.film_work_id IS NOT NULL), '{{}}')
+                        AS film_ids
+                FROM {table} e
+                LEFT JOIN {link_table} l ON l.{link_column} = e.id
+                WHERE {ids}
+                GROUP BY e.id;"""
+            ),
+            sql.SQL('e.id'),
+            {
+                'name': sql.Identifier(self.NAME_COLUMNS[table]),
+                'role': role,
+                'table': sql.Identifier('content', table),
+                'link_table': sql.Identifier('content', f'{table}_film_work'),
+                'link_column': sql.Identifier(f'{table}_id'),
+            },
+        )
+
+    @backoff_function(psycopg2.InterfaceError, psycopg2.OperationalError)
+    def fetch(self, batch: list[DictRow]) -> list[DictRow]:
+        """Selects the entities of the batch.
+
+        Args:
+            batch (list[DictRow]):
+                (id, updated_at) DictRows of persons or genres.
+
+        Returns:
+            list[DictRow]:
+                (id, name, links, film_ids) DictRows, `links` is the md5 of
+                all the links of the entity to filmworks.
+        """
+        with self.pool.connection() as conn:
+            with closing(conn.cursor(cursor_factory=DictCursor)) as cur:
+                self.query.execute(cur, (row['id'] for row in batch), {})
+                return cur.fetchall()
+
+
+class PostgresFilmMerger:
+    def __init__(
+        self,
+        pool: PostgresConnectionPool | None = None,
+        partition: IdPartition | None = None,
+        stream: bool = POSTGRES_STREAM_MERGE,
+        itersize: int = POSTGRES_CURSOR_ITERSIZE,
+    ) -> None:
+        """
+        Args:
+            pool (PostgresConnectionPool | None, optional):
+                connection pool. Defaults to the process-wide pool.
+            partition (IdPartition | None, optional):
+                if given, `keyset_query` selects only the filmworks of the
+                partition. Defaults to None.
+            stream (bool, optional):
+                if True, the pipelines merge batches with `stream_batch`
+                instead of `merge_batch`. Defaults to `POSTGRES_STREAM_MERGE`.
+            itersize (int, optional):
+                rows fetched per round trip and yielded together by
+                `stream_batch`. Defaults to `POSTGRES_CURSOR_ITERSIZE`.
+        """
+        self.pool = pool or get_pool()
+        self.partition = partition
+        self.stream = stream
+        self.itersize = itersize
+        self.set_queries(
+            sql.SQL(
+                """
+                SELECT
+                    fw.id as fw_id,
+                    fw.title,
+                    fw.description,
+                    fw.rating,
+                    fw.type,
+                    fw.created_at,
+                    fw.updated_at,
+                    pfw.role as p_role,
+                    p.id as p_id,
+                    p.full_name as p_full_name,
+                    g.name as g_name,
+                    g.id as g_id
+                FROM content.film_work fw
+                LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+                LEFT JOIN content.person p ON p.id = pfw.person_id
+                LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+                LEFT JOIN content.genre g ON g.id = gfw.genre_id
+                WHERE {ids};"""
+            )
+        )
+
+    def set_queries(
+        self, template: sql.SQL, **identifiers: sql.Composable
+    ) -> None:
+        """Builds the merge queries from a template ending with a `{ids}`
+        filter: `query` for batches of filmwork ids, `stream_query` for the
+        same ordered by filmwork and `keyset_query` for all the filmworks
+        after an `(updated_at, id)` position, used by
+        `PostgresProducer.copy_batches` on a cold start.
+        """
+        self.query = IdBatchQuery(
+            f'etl_{type(self).__name__.lower()}',
+            template,
+            sql.SQL('fw.id'),
+            identifiers,
+        )
+        self.stream_query = IdBatchQuery(
+            f'etl_{type(self).__name__.lower()}_stream',
+            template,
+            sql.SQL('fw.id'),
+            identifiers,
+            order_by=sql.SQL('fw.id'),
+        )
+        keyset: sql.Composable = sql.SQL(
+            '(fw.updated_at, fw.id) > (%(updated_at)s, %(id)s)'
+        )
+        if self.partition:
+            keyset = sql.SQL('{} AND {}').format(
+                keyset, self.partition.condition(sql.SQL('fw.id'))
+            )
+        self.keyset_query = template.format(
+            ids=sql.SQL('{}\nORDER BY fw.updated_at, fw.id').format(keyset),
+            **identifiers,
         )
 
     @backoff_function(psycopg2.InterfaceError, psycopg2.OperationalError)
@@ -165,9 +789,128 @@ class PostgresFilmMerger:
 
         Returns:
             list[DictRow]:
-                batch of DictRows. Contains many DictRows per one filmwork.
+                batch of DictRows. Contains many DictRows per one filmwork,
+                or exactly one with `PostgresFilmAggregateMerger`.
         """
-        with closing(psycopg2.connect(**POSTGRES_DSL)) as conn:  # type: ignore
+        with self.pool.connection() as conn:
             with closing(conn.cursor(cursor_factory=DictCursor)) as cur:
-                cur.execute(self.query, (tuple(row['id'] for row in batch),))
-                return cur.fetchall()  # type: ignore
+                self.query.execute(cur, (row['id'] for row in batch), {})
+                return cur.fetchall()
+
+    def stream_batch(
+        self, batch: list[DictRow]
+    ) -> Generator[list[DictRow], None, None]:
+        """Merges the filmworks of the batch like `merge_batch`, without
+        holding all the rows at once.
+
+        The flat join returns persons x genres rows per filmwork, so a few
+        films with huge casts make a batch of hundreds of thousands of rows.
+        Here the rows are read ordered by filmwork through a server-side
+        cursor, and complete filmworks are yielded as soon as they add up
+        to `itersize` rows: the memory is bounded by `itersize` and the
+        largest filmwork instead of the batch. A retried stream skips the
+        filmworks it already yielded.
+
+        Yields:
+            list[DictRow]:
+                rows of one or more filmworks, all the rows of each of them.
+        """
+        last_id = None
+        for rows in self._stream_groups(batch):
+            if last_id is not None:
+                rows = [row for row in rows if str(row['fw_id']) > last_id]
+                if not rows:
+                    continue
+            last_id = str(rows[-1]['fw_id'])
+            yield rows
+
+    @backoff_generator(psycopg2.InterfaceError, psycopg2.OperationalError)
+    def _stream_groups(
+        self, batch: list[DictRow]
+    ) -> Generator[list[DictRow], None, None]:
+        with self.pool.connection() as conn:
+            rows: list[DictRow] = []
+            for row in self.stream_query.stream(
+                conn, (row['id'] for row in batch), {}, self.itersize
+            ):
+                if (
+                    len(rows) >= self.itersize
+                    and row['fw_id'] != rows[-1]['fw_id']
+                ):
+                    yield rows
+                    rows = []
+                rows.append(row)
+            if rows:
+                yield rows
+
+
+class PostgresFilmAggregateMerger(PostgresFilmMerger):
+    """Builds one row per filmwork: genres and persons of every role are
+    aggregated by Postgres into JSON arrays of `{"id", "name"}` objects,
+    sorted by name.
+
+    The flat join returns persons x genres rows per filmwork, so the row
+    count and the transferred data no longer grow with the product of the
+    two lists, and the rows need no regrouping in Python.
+    """
+
+    ROLES = {'AC': 'actors', 'WR': 'writers', 'DR': 'director'}
+
+    def __init__(
+        self,
+        pool: PostgresConnectionPool | None = None,
+        partition: IdPartition | None = None,
+        stream: bool = POSTGRES_STREAM_MERGE,
+        itersize: int = POSTGRES_CURSOR_ITERSIZE,
+    ) -> None:
+        super().__init__(pool, partition, stream, itersize)
+        persons = sql.SQL(
+            """(
+                SELECT COALESCE(
+                    json_agg(
+                        json_build_object('id', p.id, 'name', p.full_name)
+                        ORDER BY p.full_name, p.id
+                    ),
+                    '[]'
+                )
+                FROM (
+                    SELECT DISTINCT p.id, p.full_name
+                    FROM content.person_film_work pfw
+                    JOIN content.person p ON p.id = pfw.person_id
+                    WHERE pfw.film_work_id = fw.id AND pfw.role = {}
+                ) p
+            ) as {}"""
+        )
+        template = sql.SQL(
+            """
+            SELECT
+                fw.id as fw_id,
+                fw.title,
+                fw.description,
+                fw.rating,
+                fw.type,
+                fw.created_at,
+                fw.updated_at,
+                (
+                    SELECT COALESCE(
+                        json_agg(
+                            json_build_object('id', g.id, 'name', g.name)
+                            ORDER BY g.name, g.id
+                        ),
+                        '[]'
+                    )
+                    FROM content.genre_film_work gfw
+                    JOIN content.genre g ON g.id = gfw.genre_id
+                    WHERE gfw.film_work_id = fw.id
+                ) as genres,
+                {persons}
+            FROM content.film_work fw
+            WHERE {ids};"""
+        )
+        self.set_queries(
+            template,
+            persons=sql.SQL(',\n').join(
+                persons.format(sql.Literal(role), sql.Identifier(field))
+                for role, field in self.ROLES.items()
+            ),
+        )
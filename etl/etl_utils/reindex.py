@@ -0,0 +1,383 @@
+from __future__ import annotations
+
+import multiprocessing
+import re
+import time
+from collections import Counter
+from collections.abc import Callable, Iterable, Mapping
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
+
+from config import (
+    ELASTIC_KEEP_INDEX_VERSIONS,
+    ELASTIC_MAINTENANCE_TIMEOUT,
+    ETL_REINDEX_PARTITION_RETRIES,
+    ETL_REINDEX_PARTITIONS,
+    ETL_REINDEX_PROCESSES,
+)
+from elasticsearch.exceptions import TransportError
+
+from etl_utils.backoff import backoff_function
+from etl_utils.loggers import setup_logger
+from etl_utils.partitions import IdPartition, id_partitions
+from etl_utils.pipelines import BasePipeline
+from etl_utils.pool import PostgresConnectionPool, close_pool
+from etl_utils.postgres_handlers import database_now
+
+logger = setup_logger(__name__)
+
+# Index settings used while a new version is bulk loaded.
+BULK_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+# State key of the version being loaded and the start of its rebuild.
+REBUILD_KEY = 'rebuild'
+# State key of the version the checkpoints of a partition belong to.
+TARGET_KEY = 'rebuild_target'
+
+
+@dataclass
+class PartitionRun:
+    """Result of loading one partition."""
+
+    partition: str
+    documents: int
+    seconds: float
+    resumed: bool
+
+
+def load_partition(
+    build: Callable[..., BasePipeline],
+    partition: IdPartition,
+    index: str,
+    fresh: bool,
+) -> PartitionRun:
+    """Loads the documents of one partition into `index`.
+
+    Runs in a worker process of `IndexRebuilder.load_partitions`. The
+    checkpoints of the partition are reset if `fresh` is set or they were
+    saved while loading another index, otherwise the partition resumes
+    from them.
+    """
+    pipeline = build(partition=partition)
+    pipeline.es_loader.write_index = index
+    pipeline.es_loader.index_exists = True
+    resumed = not fresh and pipeline.state.get_state(TARGET_KEY) == index
+    if not resumed:
+        pipeline.producer.set_last_modified(datetime.min)
+        pipeline.state.set_state(TARGET_KEY, index)
+        pipeline.state.flush()
+    started = time.perf_counter()
+    try:
+        pipeline.run()
+    finally:
+        close_pool()
+    return PartitionRun(
+        partition.name,
+        pipeline.es_loader.stats.documents,
+        time.perf_counter() - started,
+        resumed,
+    )
+
+
+class IndexRebuilder:
+    """Rebuilds an ElasticSearch index without downtime.
+
+    Every version of the index is a separate `<alias>_v<n>` index. A new
+    version is created with refresh disabled and no replicas, bulk loaded,
+    restored to the settings from `SCHEMA_FOLDER`, force merged and then
+    published by moving the alias in one atomic `update_aliases` call.
+    Readers and the incremental pipelines use the alias only, so they
+    switch to the new version at once.
+    """
+
+    def __init__(
+        self,
+        pipeline: BasePipeline,
+        catch_up: Iterable[BasePipeline] = (),
+        keep_versions: int = ELASTIC_KEEP_INDEX_VERSIONS,
+        partitioned: Callable[..., BasePipeline] | None = None,
+        partitions: int = ETL_REINDEX_PARTITIONS,
+        processes: int = ETL_REINDEX_PROCESSES,
+        retries: int = ETL_REINDEX_PARTITION_RETRIES,
+    ):
+        """
+        Args:
+            pipeline (BasePipeline):
+                pipeline loading every document of the index. Its checkpoints
+                are reset, so it must not share state with the incremental
+                pipelines.
+            catch_up (Iterable[BasePipeline], optional):
+                pipelines of the same index which are run from the start of
+                the rebuild once the alias is moved, to apply the changes made
+                while the index was loaded. Like `pipeline`, they must use
+                their own state. Defaults to ().
+            keep_versions (int, optional):
+                previous versions kept after publishing, for rollback.
+                Defaults to `ELASTIC_KEEP_INDEX_VERSIONS`.
+            partitioned (Callable[..., BasePipeline] | None, optional):
+                builds the pipeline of one id partition when called with
+                `partition=`. If given and `partitions` > 1, the new version
+                is loaded by one such pipeline per partition in separate
+                processes instead of `pipeline`. It is sent to spawned
+                processes, so it must be picklable, e.g. a
+                `functools.partial` of a pipeline class. Defaults to None.
+            partitions (int, optional):
+                number of id partitions. Defaults to `ETL_REINDEX_PARTITIONS`.
+            processes (int, optional):
+                partitions loaded at the same time.
+                Defaults to `ETL_REINDEX_PROCESSES`.
+            retries (int, optional):
+                restarts of a failed partition, each resuming from its
+                checkpoint. Defaults to `ETL_REINDEX_PARTITION_RETRIES`.
+        """
+        self.pipeline = pipeline
+        self.catch_up = list(catch_up)
+        self.keep_versions = keep_versions
+        self.partitioned = partitioned
+        self.partitions = partitions
+        self.processes = processes
+        self.retries = retries
+        self.loader = pipeline.es_loader
+        self.alias = self.loader.index_name
+        self.es_client = self.loader.es_client
+
+    def versions(self) -> list[int]:
+        """Numbers of the existing versions of the index, ascending."""
+        pattern = re.compile(rf'{re.escape(self.alias)}_v(\d+)')
+        indices = self.es_client.indices.get(index=f'{self.alias}_v*')
+        return sorted(
+            int(match.group(1))
+            for name in indices.body
+            if (match := pattern.fullmatch(name))
+        )
+
+    @backoff_function(TransportError)
+    def create(self) -> str:
+        """Creates the next version of the index, tuned for bulk loading.
+
+        Returns:
+            str: name of the new index.
+        """
+        version = max(self.versions(), default=0) + 1
+        index = f'{self.alias}_v{version}'
+        mappings, settings = self.loader.index_schema()
+        self.es_client.indices.create(
+            index=index, mappings=mappings, settings=settings | BULK_SETTINGS
+        )
+        logger.info('Index %s created for the rebuild of %s.', index, self.alias)
+        return index
+
+    @backoff_function(TransportError)
+    def publish(self, index: str) -> None:
+        """Restores search settings of a loaded index and moves the alias.
+
+        A concrete index named like the alias, created before indices were
+        versioned, is deleted by the same atomic alias update.
+        """
+        _, settings = self.loader.index_schema()
+        self.es_client.indices.put_settings(
+            index=index,
+            settings={
+                'refresh_interval': settings.get('refresh_interval', '1s'),
+                'number_of_replicas': settings.get('number_of_replicas', 1),
+            },
+        )
+        maintenance = self.es_client.options(
+            request_timeout=ELASTIC_MAINTENANCE_TIMEOUT
+        )
+        maintenance.indices.refresh(index=index)
+        maintenance.indices.forcemerge(index=index, max_num_segments=1)
+
+        actions: list[Mapping[str, Any]] = [
+            {'add': {'index': index, 'alias': self.alias}}
+        ]
+        if self.es_client.indices.exists_alias(name=self.alias):
+            previous = self.es_client.indices.get_alias(name=self.alias)
+            actions.extend(
+                {'remove': {'index': name, 'alias': self.alias}}
+                for name in previous.body
+                if name != index
+            )
+        elif self.es_client.indices.exists(index=self.alias):
+            actions.append({'remove_index': {'index': self.alias}})
+        self.es_client.indices.update_aliases(actions=actions)
+        logger.info('Alias %s moved to %s.', self.alias, index)
+        # Fingerprints describe the documents of the previous version.
+        if self.loader.fingerprints:
+            self.loader.fingerprints.clear(self.alias)
+
+    def drop_old_versions(self, index: str) -> None:
+        """Deletes versions older than the `keep_versions` previous ones."""
+        versions = [
+            f'{self.alias}_v{version}' for version in self.versions()
+        ]
+        previous = versions[: versions.index(index)]
+        stale = previous[: max(len(previous) - self.keep_versions, 0)]
+        for name in stale:
+            self.es_client.indices.delete(index=name)
+            logger.info('Old index version %s deleted.', name)
+
+    def unpublished(self) -> tuple[str, datetime] | None:
+        """Version left unpublished by an interrupted rebuild.
+
+        Returns:
+            tuple[str, datetime] | None:
+                name of the version and the start time of its rebuild.
+        """
+        rebuild = self.pipeline.state.get_state(REBUILD_KEY)
+        if not rebuild:
+            return None
+        index = rebuild['index']
+        if not self.es_client.indices.exists(
+            index=index
+        ) or self.es_client.indices.exists_alias(name=self.alias, index=index):
+            return None
+        return index, datetime.fromisoformat(rebuild['started_at'])
+
+    def load(self, index: str, fresh: bool) -> None:
+        """Loads every document into `index`.
+
+        Args:
+            index (str):
+                version being rebuilt.
+            fresh (bool):
+                if True, the load starts from scratch, otherwise it resumes
+                from the checkpoints of an interrupted rebuild.
+        """
+        if self.partitioned and self.partitions > 1:
+            self.load_partitions(index, fresh)
+            return
+        if fresh:
+            self.pipeline.producer.set_last_modified(datetime.min)
+            if self.pipeline.enricher:
+                self.pipeline.enricher.set_last_modified(datetime.min)
+        self.pipeline.run()
+
+    def load_partitions(self, index: str, fresh: bool) -> None:
+        """Loads the id partitions in parallel processes.
+
+        Each partition is an independent pipeline with its own checkpoints,
+        so a partition which failed or whose process died is started again
+        and resumes where it stopped, up to `retries` times. Processes are
+        spawned, not forked, so they never inherit open connections.
+        """
+        assert self.partitioned is not None
+        pending = {
+            partition.name: partition
+            for partition in id_partitions(self.partitions)
+        }
+        attempts: Counter[str] = Counter()
+        documents = 0
+        started = time.perf_counter()
+        context = multiprocessing.get_context('spawn')
+        while pending:
+            with ProcessPoolExecutor(
+                max_workers=min(self.processes, len(pending)),
+                mp_context=context,
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        load_partition,
+                        self.partitioned,
+                        partition,
+                        index,
+                        fresh and not attempts[name],
+                    ): name
+                    for name, partition in pending.items()
+                }
+                for future in as_completed(futures):
+                    name = futures[future]
+                    attempts[name] += 1
+                    try:
+                        run = future.result()
+                    except Exception as e:
+                        if attempts[name] > self.retries:
+                            for other in futures:
+                                other.cancel()
+                            raise
+                        logger.warning(
+                            'Partition %s of %s failed (attempt %d), '
+                            'it will resume from its checkpoint: %r',
+                            name,
+                            index,
+                            attempts[name],
+                            e,
+                        )
+                        continue
+                    del pending[name]
+                    documents += run.documents
+                    logger.info(
+                        'Partition %s of %s %s: %d documents in %.1fs.',
+                        name,
+                        index,
+                        'resumed and loaded' if run.resumed else 'loaded',
+                        run.documents,
+                        run.seconds,
+                    )
+        elapsed = time.perf_counter() - started
+        logger.info(
+            '%d partitions of %s loaded by %d processes: %d documents '
+            'in %.1fs (%.0f docs/s).',
+            self.partitions,
+            index,
+            min(self.processes, self.partitions),
+            documents,
+            elapsed,
+            documents / elapsed if elapsed else 0.0,
+        )
+
+    def rebuild(
+        self, pool: PostgresConnectionPool, resume: bool = False
+    ) -> str:
+        """Loads a new version of the index from scratch and publishes it.
+
+        Args:
+            pool (PostgresConnectionPool):
+                pool used to read the start time from the Postgres clock.
+            resume (bool, optional):
+                if True, a version left unpublished by an interrupted
+                rebuild is loaded further from its checkpoints instead of
+                creating a new one. Defaults to False.
+
+        Returns:
+            str: name of the published index.
+        """
+        state = self.pipeline.state
+        unpublished = self.unpublished() if resume else None
+        if unpublished:
+            index, started_at = unpublished
+            logger.info(
+                'Resuming the rebuild of %s into %s.', self.alias, index
+            )
+        else:
+            started_at = database_now(pool)
+            index = self.create()
+            state.set_state(
+                REBUILD_KEY,
+                {'index': index, 'started_at': started_at.isoformat()},
+            )
+            state.flush()
+        self.loader.write_index = index
+        self.loader.index_exists = True
+        try:
+            self.load(index, fresh=unpublished is None)
+        finally:
+            self.loader.write_index = self.alias
+        self.publish(index)
+        state.set_state(REBUILD_KEY, None)
+
+        # Rows changed after the scan finished were written to the previous
+        # version; the pipeline resumes from its checkpoint through the alias.
+        # Partitions were loaded by other pipelines, so it starts from the
+        # beginning of the rebuild.
+        if self.partitioned and self.partitions > 1:
+            self.pipeline.producer.set_last_modified(started_at)
+        self.pipeline.run()
+        for pipeline in self.catch_up:
+            pipeline.producer.set_last_modified(started_at)
+            if pipeline.enricher:
+                pipeline.enricher.set_last_modified(datetime.min)
+            pipeline.run()
+        self.drop_old_versions(index)
+        return index
@@ -0,0 +1,175 @@
+import hashlib
+from collections.abc import Callable
+from functools import partial
+from typing import Any
+
+from psycopg2.extras import DictRow
+
+from etl_utils.elastic_search_handlers import ElasticSearchLoader
+from etl_utils.fingerprints import FingerprintStore
+from etl_utils.loggers import setup_logger
+from etl_utils.pool import PostgresConnectionPool
+from etl_utils.postgres_handlers import PostgresEntityLinks
+
+logger = setup_logger(__name__)
+
+# Rows of the entities to merge in full, scripted updates of the films of
+# the renamed ones, and the callback saving the state of both.
+Propagation = tuple[
+    list[DictRow], list[dict[str, Any]], Callable[[], None] | None
+]
+
+# Renames the entities of `params.names` (id -> name) in the nested
+# `params.fields` of a film, keeping the order of the transformers: by name,
+# then by id. A film without any of them is left untouched.
+RENAME_SCRIPT = """
+boolean changed = false;
+for (String field : params.fields) {
+    List entities = ctx._source[field];
+    if (entities == null) {
+        continue;
+    }
+    boolean renamed = false;
+    for (Map entity : entities) {
+        String name = params.names[entity.id];
+        if (name != null && !name.equals(entity.name)) {
+            entity.name = name;
+            renamed = true;
+        }
+    }
+    if (renamed) {
+        entities.sort((a, b) -> a.name.compareTo(b.name) != 0
+            ? a.name.compareTo(b.name) : a.id.compareTo(b.id));
+        changed = true;
+    }
+}
+if (!changed) {
+    ctx.op = 'noop';
+}
+"""
+
+
+class RenamePropagator:
+    """Propagates name-only changes of persons or genres to `movies` with
+    scripted bulk updates of the nested fields, instead of merging every
+    film of the entity from Postgres again.
+
+    The name and a hash of the links to filmworks of every entity are kept
+    in the fingerprint store once the films are updated. An entity whose
+    links changed, or which was never seen, is left to the full merge, as
+    the documents may need to gain or lose it.
+    """
+
+    FIELDS = {
+        'person': ['actors', 'writers', 'director'],
+        'genre': ['genres'],
+    }
+
+    def __init__(
+        self,
+        table: str,
+        loader: ElasticSearchLoader,
+        fingerprints: FingerprintStore,
+        pool: PostgresConnectionPool | None = None,
+    ):
+        """
+        Args:
+            table (str):
+                'person' or 'genre'.
+            loader (ElasticSearchLoader):
+                loader of the `movies` index.
+            fingerprints (FingerprintStore):
+                store of the entity names and links, under the
+                `<index>:<table>` index, cleared together with the index.
+            pool (PostgresConnectionPool | None, optional):
+                connection pool. Defaults to the process-wide pool.
+        """
+        self.table = table
+        self.fields = self.FIELDS[table]
+        self.loader = loader
+        self.fingerprints = fingerprints
+        self.key = f'{loader.index_name}:{table}'
+        self.links = PostgresEntityLinks(table, pool)
+
+    @staticmethod
+    def entity_state(entity: DictRow) -> bytes:
+        """8 bytes of the name hash followed by 8 bytes of the links hash."""
+        name = hashlib.blake2b(entity['name'].encode(), digest_size=8)
+        return name.digest() + bytes.fromhex(entity['links'])[:8]
+
+    def update_actions(
+        self, renamed: list[DictRow]
+    ) -> list[dict[str, Any]]:
+        """One scripted update per film of the renamed entities."""
+        names: dict[str, dict[str, str]] = {}
+        for entity in renamed:
+            for film_id in entity['film_ids']:
+                names.setdefault(film_id, {})[str(entity['id'])] = entity[
+                    'name'
+                ]
+        return [
+            {
+                '_op_type': 'update',
+                '_id': film_id,
+                'script': {
+                    'source': RENAME_SCRIPT,
+                    'lang': 'painless',
+                    'params': {'fields': self.fields, 'names': film_names},
+                },
+            }
+            for film_id, film_names in names.items()
+        ]
+
+    def propagate(
+        self, batch: list[DictRow]
+    ) -> Propagation:
+        """Builds the updates of the films of the renamed entities of the
+        batch.
+
+        The updates are returned rather than sent, so they reach the index
+        after the documents extracted before them, which may still carry
+        the old names. Does nothing while `IndexRebuilder` loads a new
+        version of the index, which is merged in full.
+
+        Args:
+            batch (list[DictRow]):
+                (id, updated_at) DictRows of changed persons or genres.
+
+        Returns:
+            Propagation:
+                rows of the entities to enrich and merge in full, scripted
+                updates of the films of the renamed ones, and the callback
+                saving the state of both, to run once they are loaded.
+        """
+        if self.loader.write_index != self.loader.index_name:
+            return batch, [], None
+        entities = self.links.fetch(batch)
+        known = self.fingerprints.get(
+            self.key, [str(entity['id']) for entity in entities]
+        )
+        merged: dict[str, bytes] = {}
+        renamed: list[DictRow] = []
+        states: dict[str, bytes] = {}
+        for entity, previous in zip(entities, known):
+            state = self.entity_state(entity)
+            if previous is None or previous[8:] != state[8:]:
+                merged[str(entity['id'])] = state
+                states[str(entity['id'])] = state
+            elif previous != state:
+                renamed.append(entity)
+                states[str(entity['id'])] = state
+        actions = self.update_actions(renamed) if renamed else []
+        if len(merged) < len(entities):
+            logger.info(
+                '%s changes: %d renamed by scripted updates of %d films, '
+                '%d unchanged, %d merged in full.',
+                self.table,
+                len(renamed),
+                len(actions),
+                len(entities) - len(renamed) - len(merged),
+                len(merged),
+            )
+        rows = [row for row in batch if str(row['id']) in merged]
+        if not states:
+            return rows, actions, None
+        return rows, actions, partial(self.fingerprints.save, self.key, states)
@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+
+from config import ETL_MAX_WORKERS, ETL_SERIALIZE_SAME_INDEX
+
+from etl_utils.cdc import CdcPipeline
+from etl_utils.dedup import FilmDedup
+from etl_utils.loggers import setup_logger
+from etl_utils.metrics import get_metrics
+from etl_utils.pipelines import BasePipeline, FanOutPipeline
+
+logger = setup_logger(__name__)
+
+# Pipelines the scheduler runs: a single pipeline, several fed by one
+# source scan, or the one fed by logical replication.
+ScheduledRun = BasePipeline | FanOutPipeline | CdcPipeline
+
+metrics = get_metrics()
+PIPELINE_RUNS = metrics.counter(
+    'etl_pipeline_runs_total',
+    'Pipeline runs by result: ok or failed.',
+    ['pipeline', 'result'],
+)
+PIPELINE_SECONDS = metrics.summary(
+    'etl_pipeline_run_seconds',
+    'Duration of the pipeline runs.',
+    ['pipeline'],
+)
+PIPELINE_LAST_SUCCESS = metrics.gauge(
+    'etl_pipeline_last_success_timestamp_seconds',
+    'Unix time of the end of the last successful run.',
+    ['pipeline'],
+)
+CHECKPOINT_LAG = metrics.gauge(
+    'etl_checkpoint_lag_seconds',
+    'Now minus the last_modified checkpoint of the pipeline producer.',
+    ['pipeline'],
+)
+CYCLE_SECONDS = metrics.summary(
+    'etl_cycle_seconds', 'Duration of the scheduler cycles.'
+)
+
+
+@dataclass
+class PipelineRun:
+    """Result of one pipeline run."""
+
+    name: str
+    seconds: float
+    error: BaseException | None = None
+    documents: int = 0
+    skipped: int = 0
+
+
+@dataclass
+class CycleReport:
+    """Results of all the pipeline runs of one cycle."""
+
+    runs: list[PipelineRun] = field(default_factory=list)
+    seconds: float = 0.0
+    dedup_checked: int = 0
+    dedup_hits: int = 0
+
+    @property
+    def failed(self) -> list[PipelineRun]:
+        return [run for run in self.runs if run.error is not None]
+
+    @property
+    def skipped(self) -> int:
+        return sum(run.skipped for run in self.runs)
+
+    @property
+    def documents(self) -> int:
+        return sum(run.documents for run in self.runs)
+
+
+def record_run(
+    name: str,
+    seconds: float,
+    error: BaseException | None = None,
+    documents: int = 0,
+    skipped: int = 0,
+) -> PipelineRun:
+    """Counts a finished pipeline run in the metrics and logs it."""
+    result = 'failed' if error else 'ok'
+    PIPELINE_RUNS.inc(pipeline=name, result=result)
+    PIPELINE_SECONDS.observe(seconds, pipeline=name)
+    if error:
+        return PipelineRun(name, seconds, error)
+    PIPELINE_LAST_SUCCESS.set(time.time(), pipeline=name)
+    logger.info(
+        'Pipeline %s finished in %.3fs: %d documents uploaded, '
+        '%d unchanged skipped.',
+        name,
+        seconds,
+        documents,
+        skipped,
+    )
+    return PipelineRun(name, seconds, documents=documents, skipped=skipped)
+
+
+def report_cycle(report: CycleReport, dedup: FilmDedup | None) -> None:
+    """Counts a finished cycle in the metrics and logs its summary, with
+    the dedup statistics of the cycle."""
+    CYCLE_SECONDS.observe(report.seconds)
+    logger.info(
+        'ETL cycle finished in %.3fs (%s). %d pipelines failed.',
+        report.seconds,
+        ', '.join(f'{run.name}: {run.seconds:.3f}s' for run in report.runs),
+        len(report.failed),
+    )
+    if report.skipped:
+        logger.info(
+            'Unchanged documents skipped: %d of %d (%.0f%%; %s).',
+            report.skipped,
+            report.skipped + report.documents,
+            100 * report.skipped / (report.skipped + report.documents),
+            ', '.join(
+                f'{run.name}: {run.skipped}/{run.skipped + run.documents}'
+                for run in report.runs
+                if run.skipped
+            ),
+        )
+    if dedup:
+        report.dedup_checked = dedup.checked
+        report.dedup_hits = dedup.hits
+        logger.info(
+            'Film dedup: %d of %d filmworks already merged this cycle.',
+            report.dedup_hits,
+            report.dedup_checked,
+        )
+
+
+def collect_checkpoint_lags(pipelines: Mapping[str, ScheduledRun]) -> None:
+    """Refreshes the checkpoint lag of every pipeline."""
+    for name, pipeline in pipelines.items():
+        lag = pipeline.checkpoint_lag
+        if lag is None:
+            CHECKPOINT_LAG.remove(pipeline=name)
+        else:
+            CHECKPOINT_LAG.set(lag, pipeline=name)
+
+
+@dataclass
+class ScheduledPipeline:
+    name: str
+    pipeline: ScheduledRun
+    limit: threading.BoundedSemaphore
+
+
+class PipelineScheduler:
+    """Runs ETL pipelines concurrently in a thread pool.
+
+    Pipelines are I/O bound (Postgres, Redis and ElasticSearch round trips),
+    so threads are enough and the pipelines share one connection pool.
+    Each pipeline has its own concurrency limit, and pipelines loading the
+    same index can be serialized with a per-index lock.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = ETL_MAX_WORKERS,
+        serialize_same_index: bool = ETL_SERIALIZE_SAME_INDEX,
+        dedup: FilmDedup | None = None,
+    ):
+        """
+        Args:
+            max_workers (int, optional):
+                number of pipelines running at the same time.
+                Defaults to `ETL_MAX_WORKERS`.
+            serialize_same_index (bool, optional):
+                if True, pipelines writing to the same ElasticSearch index
+                never run at the same time.
+                Defaults to `ETL_SERIALIZE_SAME_INDEX`.
+            dedup (FilmDedup | None, optional):
+                film dedup window of the pipelines, started anew and
+                reported with every cycle. Defaults to None.
+        """
+        self.serialize_same_index = serialize_same_index
+        self.dedup = dedup
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='etl'
+        )
+        self.pipelines: dict[str, ScheduledPipeline] = {}
+        self._index_locks: dict[str, threading.Lock] = {}
+        metrics.add_collector(self.collect_metrics)
+
+    def add(
+        self, name: str, pipeline: ScheduledRun, max_concurrency: int = 1
+    ) -> None:
+        """Registers a pipeline.
+
+        Args:
+            name (str):
+                pipeline name used in reports.
+            pipeline (ScheduledRun):
+                pipeline to run, or a `FanOutPipeline` of several.
+            max_concurrency (int, optional):
+                maximum number of simultaneous runs of this pipeline.
+                Defaults to 1, since concurrent runs share one checkpoint.
+        """
+        pipeline.name = name
+        self.pipelines[name] = ScheduledPipeline(
+            name, pipeline, threading.BoundedSemaphore(max_concurrency)
+        )
+        for loader in pipeline.loaders:
+            self._index_locks.setdefault(loader.index_name, threading.Lock())
+
+    def _run(self, scheduled: ScheduledPipeline) -> PipelineRun:
+        loaders = scheduled.pipeline.loaders
+
+        def totals() -> tuple[int, int]:
+            return (
+                sum(loader.stats.documents for loader in loaders),
+                sum(loader.stats.skipped for loader in loaders),
+            )
+
+        with ExitStack() as stack:
+            stack.enter_context(scheduled.limit)
+            if self.serialize_same_index:
+                # Locks are taken in one order, so runs writing to several
+                # indices never wait for each other in a cycle.
+                for index_name in sorted(
+                    {loader.index_name for loader in loaders}
+                ):
+                    stack.enter_context(self._index_locks[index_name])
+            started = time.perf_counter()
+            documents, skipped = totals()
+            try:
+                scheduled.pipeline.run()
+            except Exception as e:
+                logger.exception('Pipeline %s failed', scheduled.name)
+                return record_run(
+                    scheduled.name, time.perf_counter() - started, e
+                )
+            documents_after, skipped_after = totals()
+            return record_run(
+                scheduled.name,
+                time.perf_counter() - started,
+                documents=documents_after - documents,
+                skipped=skipped_after - skipped,
+            )
+
+    def submit(self, name: str) -> Future[PipelineRun]:
+        """Schedules one run of the pipeline registered as `name`."""
+        return self.executor.submit(self._run, self.pipelines[name])
+
+    def run_cycle(self, names: list[str] | None = None) -> CycleReport:
+        """Runs each pipeline once and waits for all of them.
+
+        Args:
+            names (list[str] | None, optional):
+                pipelines to run. Defaults to all registered pipelines.
+
+        Returns:
+            CycleReport: wall-clock time of every run and of the whole cycle.
+        """
+        if self.dedup:
+            self.dedup.start_cycle()
+        started = time.perf_counter()
+        futures = [self.submit(name) for name in names or self.pipelines]
+        wait(futures)
+        report = CycleReport(
+            runs=[future.result() for future in futures],
+            seconds=time.perf_counter() - started,
+        )
+        report_cycle(report, self.dedup)
+        return report
+
+    def collect_metrics(self) -> None:
+        """Refreshes the checkpoint lag of every pipeline."""
+        collect_checkpoint_lags(
+            {
+                name: scheduled.pipeline
+                for name, scheduled in self.pipelines.items()
+            }
+        )
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
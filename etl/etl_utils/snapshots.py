@@ -0,0 +1,422 @@
+from __future__ import annotations
+
+import gzip
+import json
+import mmap
+import os
+import shutil
+import time
+from collections.abc import Iterable, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+from config import (
+    ELASTIC_BULK_THREADS,
+    ETL_SNAPSHOT_CHUNK_BYTES,
+    ETL_SNAPSHOT_CHUNK_DOCS,
+    ETL_SNAPSHOT_COMPRESSLEVEL,
+)
+from elastic_transport import HttpHeaders
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import expand_action
+
+from etl_utils.backoff import backoff_function, exponential_backoff_timings
+from etl_utils.bulk import BulkStats
+from etl_utils.elastic_search_handlers import (
+    BULK_BYTES,
+    BULK_REQUESTS,
+    DOCUMENTS_LOADED,
+    DOCUMENTS_RETRIED,
+    ElasticSearchLoader,
+)
+from etl_utils.loggers import setup_logger
+from etl_utils.pipelines import BasePipeline
+
+logger = setup_logger(__name__)
+
+MANIFEST = 'manifest.json'
+
+
+@dataclass
+class SnapshotChunk:
+    """One file of a snapshot: a gzipped body of one bulk request."""
+
+    file: str
+    documents: int
+    bytes: int
+    compressed_bytes: int
+
+
+@dataclass
+class IndexSnapshot:
+    """Documents of one index as they were at `exported_at`."""
+
+    index: str
+    exported_at: str
+    chunks: list[SnapshotChunk] = field(default_factory=list)
+
+    @property
+    def documents(self) -> int:
+        return sum(chunk.documents for chunk in self.chunks)
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> IndexSnapshot:
+        chunks = [SnapshotChunk(**chunk) for chunk in data['chunks']]
+        return cls(data['index'], data['exported_at'], chunks)
+
+
+def read_manifest(directory: Path) -> dict[str, IndexSnapshot]:
+    """Snapshots of the indices exported to `directory`, by index."""
+    path = directory / MANIFEST
+    if not path.exists():
+        return {}
+    with path.open() as manifest_file:
+        manifest = json.load(manifest_file)
+    return {
+        index: IndexSnapshot.from_dict(data)
+        for index, data in manifest['indices'].items()
+    }
+
+
+def write_manifest(
+    directory: Path, snapshots: Mapping[str, IndexSnapshot]
+) -> None:
+    """Replaces the manifest at once, so it never lists missing chunks."""
+    path = directory / MANIFEST
+    temporary = path.with_suffix('.tmp')
+    with temporary.open('w') as manifest_file:
+        json.dump(
+            {
+                'indices': {
+                    index: asdict(snapshot)
+                    for index, snapshot in sorted(snapshots.items())
+                }
+            },
+            manifest_file,
+            indent=4,
+        )
+    os.replace(temporary, path)
+
+
+class SnapshotExporter:
+    """Writes the documents built by pipelines to NDJSON snapshot files.
+
+    The documents of an index are split into chunks of at most
+    `chunk_documents` documents and `chunk_bytes` bytes, each saved as
+    `<directory>/<index>/part-<n>.ndjson.gz`: the gzipped body of a bulk
+    request of `index` actions without `_index`, so the files can be
+    replayed into any index. `manifest.json` lists the chunks and the time
+    of the export, it is updated once all the chunks of an index are
+    written.
+    """
+
+    def __init__(
+        self,
+        directory: Path | str,
+        chunk_documents: int = ETL_SNAPSHOT_CHUNK_DOCS,
+        chunk_bytes: int = ETL_SNAPSHOT_CHUNK_BYTES,
+        compresslevel: int = ETL_SNAPSHOT_COMPRESSLEVEL,
+    ):
+        """
+        Args:
+            directory (Path | str):
+                directory of the snapshot.
+            chunk_documents (int, optional):
+                maximum documents of a chunk.
+                Defaults to `ETL_SNAPSHOT_CHUNK_DOCS`.
+            chunk_bytes (int, optional):
+                maximum uncompressed size of a chunk.
+                Defaults to `ETL_SNAPSHOT_CHUNK_BYTES`.
+            compresslevel (int, optional):
+                gzip compression level.
+                Defaults to `ETL_SNAPSHOT_COMPRESSLEVEL`.
+        """
+        self.directory = Path(directory)
+        self.chunk_documents = chunk_documents
+        self.chunk_bytes = chunk_bytes
+        self.compresslevel = compresslevel
+
+    def write_chunk(
+        self, path: Path, lines: list[bytes], documents: int
+    ) -> SnapshotChunk:
+        with gzip.open(
+            path, 'wb', compresslevel=self.compresslevel
+        ) as chunk_file:
+            chunk_file.writelines(lines)
+        return SnapshotChunk(
+            path.name,
+            documents,
+            sum(len(line) for line in lines),
+            path.stat().st_size,
+        )
+
+    def export_index(
+        self, pipeline: BasePipeline, exported_at: datetime
+    ) -> IndexSnapshot:
+        """Runs the extract and transform stages of `pipeline` and writes
+        the documents to the chunks of its index.
+
+        The pipeline reads every row from its checkpoints on, so it should
+        start from scratch with a state of its own.
+
+        Args:
+            pipeline (BasePipeline):
+                pipeline building every document of the index.
+            exported_at (datetime):
+                time, by the Postgres clock, before the extraction started.
+
+        Returns:
+            IndexSnapshot: chunks written.
+        """
+        index = pipeline.es_loader.index_name
+        # Chunks are written aside and replace the previous ones at the
+        # end, so a failed export leaves the last snapshot usable.
+        partial = self.directory / f'{index}.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        partial.mkdir(parents=True)
+        serializers = pipeline.es_loader.es_client.transport.serializers
+        dumps = serializers.get_serializer('application/json').dumps
+        snapshot = IndexSnapshot(index, exported_at.isoformat())
+        lines: list[bytes] = []
+        documents = size = 0
+        started = time.perf_counter()
+
+        def flush() -> None:
+            name = f'part-{len(snapshot.chunks):05d}.ndjson.gz'
+            chunk = self.write_chunk(partial / name, lines, documents)
+            chunk.file = f'{index}/{name}'
+            snapshot.chunks.append(chunk)
+
+        for action in pipeline.transform(pipeline.extract()):
+            header, body = expand_action(action)
+            document = [dumps(header) + b'\n', dumps(body) + b'\n']
+            length = len(document[0]) + len(document[1])
+            if documents and (
+                documents >= self.chunk_documents
+                or size + length > self.chunk_bytes
+            ):
+                flush()
+                lines = []
+                documents = size = 0
+            lines.extend(document)
+            documents += 1
+            size += length
+        if documents:
+            flush()
+        shutil.rmtree(self.directory / index, ignore_errors=True)
+        partial.rename(self.directory / index)
+        pipeline.state.flush()
+        logger.info(
+            '%d documents of %s exported to %d chunk(s) in %.1fs.',
+            snapshot.documents,
+            index,
+            len(snapshot.chunks),
+            time.perf_counter() - started,
+        )
+        return snapshot
+
+    def export(
+        self, pipelines: Iterable[BasePipeline], exported_at: datetime
+    ) -> dict[str, IndexSnapshot]:
+        """Exports the index of every pipeline and updates the manifest.
+
+        Indices exported before and not exported again stay in the
+        manifest with their own `exported_at`.
+
+        Returns:
+            dict[str, IndexSnapshot]: snapshots of the manifest, by index.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        snapshots = read_manifest(self.directory)
+        for pipeline in pipelines:
+            snapshot = self.export_index(pipeline, exported_at)
+            snapshots[snapshot.index] = snapshot
+            write_manifest(self.directory, snapshots)
+        return snapshots
+
+
+class SnapshotReplayer:
+    """Loads a snapshot of an index into ElasticSearch.
+
+    Chunk files are memory-mapped and sent as they are, gzipped, as bulk
+    request bodies: documents are neither decompressed, parsed nor
+    validated again, and the body is never copied in Python. Up to
+    `threads` chunks are sent at once. Only when ElasticSearch fails
+    documents of a chunk is the chunk decompressed, to send those
+    documents again with the retries and dead letters of `loader`.
+    """
+
+    def __init__(
+        self,
+        loader: ElasticSearchLoader,
+        directory: Path | str,
+        threads: int = ELASTIC_BULK_THREADS,
+    ):
+        """
+        Args:
+            loader (ElasticSearchLoader):
+                loader of the index, documents go to its `write_index`.
+            directory (Path | str):
+                directory of the snapshot.
+            threads (int, optional):
+                bulk requests in flight. Defaults to `ELASTIC_BULK_THREADS`.
+        """
+        self.loader = loader
+        self.directory = Path(directory)
+        self.threads = threads
+        self.client = loader.es_client
+        self.serializers = self.client.transport.serializers
+        self.headers = HttpHeaders(
+            {
+                'content-type': 'application/x-ndjson',
+                'content-encoding': 'gzip',
+                'accept': 'application/json',
+            }
+        )
+
+    @backoff_function(TransportError)
+    def request(self, body: memoryview) -> tuple[int, Any]:
+        """Sends one bulk request of a gzipped body.
+
+        The request goes straight to a node: the client would serialize
+        the body again, copying it and appending a newline to it.
+
+        Returns:
+            tuple[int, Any]: status and parsed body of the response.
+        """
+        node = self.client.transport.node_pool.get()
+        response = node.perform_request(
+            'POST',
+            f'/{self.loader.write_index}/_bulk',
+            body=body,  # type: ignore
+            headers=self.headers,
+        )
+        result = self.serializers.loads(
+            response.body, response.meta.mimetype
+        )
+        return response.meta.status, result
+
+    def send(
+        self, chunk: SnapshotChunk
+    ) -> tuple[BulkStats, list[str], list[dict[str, Any]]]:
+        """Sends one chunk, again while the whole request is rejected with
+        429 or a server error.
+
+        Returns:
+            tuple[BulkStats, list[str], list[dict[str, Any]]]:
+                totals of the chunk, ids of its documents and the actions
+                of the documents ElasticSearch failed.
+        """
+        stats = BulkStats(documents=chunk.documents)
+        timings = exponential_backoff_timings()
+        with open(self.directory / chunk.file, 'rb') as chunk_file:
+            with mmap.mmap(
+                chunk_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mapped, memoryview(mapped) as body:
+                for attempt in range(self.loader.max_retries + 1):
+                    started = time.perf_counter()
+                    status, result = self.request(body)
+                    stats.seconds += time.perf_counter() - started
+                    stats.requests += 1
+                    stats.bytes += chunk.compressed_bytes
+                    if status != 429 and status < 500:
+                        break
+                    if attempt < self.loader.max_retries:
+                        stats.rejected += chunk.documents
+                        time.sleep(next(timings))
+                lines = None
+                if status >= 300:
+                    # The whole request failed, every document is sent
+                    # again by the loader.
+                    lines = gzip.decompress(body).splitlines()
+                    failed = set(range(chunk.documents))
+                else:
+                    failed = {
+                        position
+                        for position, item in enumerate(result['items'])
+                        if next(iter(item.values()))['status'] >= 300
+                    }
+                    if failed:
+                        lines = gzip.decompress(body).splitlines()
+        if lines is None:
+            ids = [
+                str(next(iter(item.values()))['_id'])
+                for item in result['items']
+            ]
+            return stats, ids, []
+        loads = self.serializers.get_serializer('application/json').loads
+        ids = []
+        actions = []
+        for position in range(chunk.documents):
+            header = loads(lines[2 * position])
+            ((_, meta),) = header.items()
+            ids.append(str(meta['_id']))
+            if position in failed:
+                body_line = loads(lines[2 * position + 1])
+                actions.append({'_id': meta['_id'], **body_line})
+        stats.documents -= len(failed)
+        return stats, ids, actions
+
+    def replay(self, snapshot: IndexSnapshot) -> BulkStats:
+        """Loads every chunk of `snapshot`.
+
+        Failed documents are uploaded again by `loader`, those failing
+        for good are saved as its dead letters.
+
+        Returns:
+            BulkStats: totals of the replay, `seconds` is its wall-clock time.
+
+        Raises:
+            BulkIndexError: if documents failed and the loader has no dead
+                letter store.
+        """
+        index = self.loader.index_name
+        stats = BulkStats()
+        ids: list[str] = []
+        failed: list[dict[str, Any]] = []
+        started = time.perf_counter()
+        with ThreadPoolExecutor(
+            max_workers=self.threads, thread_name_prefix=f'replay_{index}'
+        ) as executor:
+            for chunk_stats, chunk_ids, actions in executor.map(
+                self.send, snapshot.chunks
+            ):
+                stats.add(chunk_stats)
+                ids.extend(chunk_ids)
+                failed.extend(actions)
+        stats.seconds = time.perf_counter() - started
+        DOCUMENTS_LOADED.inc(stats.documents, index=index)
+        BULK_REQUESTS.inc(stats.requests, index=index)
+        BULK_BYTES.inc(stats.bytes, index=index)
+        self.loader.stats.add(stats)
+        errors: list[dict[str, Any]] = []
+        if failed:
+            DOCUMENTS_RETRIED.inc(len(failed), index=index)
+            logger.warning(
+                'Sending %d failed document(s) of %s again.',
+                len(failed),
+                index,
+            )
+            errors = self.loader.upload_streaming(
+                failed, self.loader.max_retries
+            )
+            errors = self.loader.retry_failed(errors)
+        self.loader.settle(None, ids, {}, 0, errors)
+        logger.info(
+            '%d documents (%.2f MiB gzipped) of the snapshot of %s taken '
+            'at %s replayed into %s in %.3fs: %.0f docs/s, %d requests. '
+            '%d errors.',
+            stats.documents,
+            stats.bytes / 2**20,
+            index,
+            snapshot.exported_at,
+            self.loader.write_index,
+            stats.seconds,
+            stats.docs_per_second,
+            stats.requests,
+            len(errors),
+        )
+        return stats
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import abc
 import json
+import time
 from datetime import date, datetime
 from pathlib import Path
 from typing import Any
@@ -21,19 +22,66 @@ class BaseStorage:
     def retrieve_state(self) -> dict[str, Any]:
         """Load state from the storage."""
 
+    def save_keys(self, state: dict[str, Any], keys: set[str]) -> None:
+        """Save the changed `keys` of the state.
+
+        Storages which can't update single keys save the whole state.
+        """
+        self.save_state(state)
+
 
 class State:
     """
     Class for keeping state while working with data.
+
+    Writes can be coalesced: changed keys are saved once `flush_every`
+    changes are collected or `flush_interval` seconds passed since the last
+    save, and on `flush`. Unsaved changes are lost on a crash, so callers
+    must only set positions they can safely resume from.
     """
 
-    def __init__(self, storage: BaseStorage):
+    def __init__(
+        self,
+        storage: BaseStorage,
+        flush_every: int = 1,
+        flush_interval: float | None = None,
+    ):
+        """
+        Args:
+            storage (BaseStorage):
+                state storage.
+            flush_every (int, optional):
+                changes saved together. Defaults to 1, i.e. every change is
+                saved at once.
+            flush_interval (float | None, optional):
+                maximum seconds between saves of pending changes.
+                Defaults to None (no limit).
+        """
         self.storage = storage
         self.state = self.storage.retrieve_state() or {}
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._dirty: set[str] = set()
+        self._pending = 0
+        self._flushed_at = time.monotonic()
 
     def set_state(self, key: str, value: Any) -> None:
         self.state[key] = value
-        self.storage.save_state(self.state)
+        self._dirty.add(key)
+        self._pending += 1
+        if self._pending >= self.flush_every or (
+            self.flush_interval is not None
+            and time.monotonic() - self._flushed_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """Saves all the pending changes."""
+        if self._dirty:
+            self.storage.save_keys(self.state, self._dirty)
+        self._dirty = set()
+        self._pending = 0
+        self._flushed_at = time.monotonic()
 
     def get_state(self, key: str) -> Any | None:
         return self.state.get(key)
@@ -97,23 +145,107 @@ class RedisStorage(BaseStorage):
         return json.loads(state_str) if state_str else None
 
 
+class RedisHashStorage(BaseStorage):
+    """Keeps every state key in a field of a Redis hash as compact JSON,
+    so a change of one key writes that key only.
+
+    A state saved by `RedisStorage` under `legacy_name` is copied to the
+    hash when the hash doesn't exist yet; the old key is left intact.
+    """
+
+    def __init__(
+        self,
+        redis_adapter: Redis[Any],
+        name: str,
+        legacy_name: str | None = None,
+    ):
+        self.redis_adapter = redis_adapter
+        self.name = name
+        self.legacy_name = legacy_name
+
+    @staticmethod
+    def dumps(value: Any) -> str:
+        return json.dumps(
+            value, separators=(',', ':'), default=json_serializer
+        )
+
+    @backoff_function(ConnectionError)
+    def save_state(self, state: dict[str, Any]) -> None:
+        if state:
+            self.save_keys(state, set(state))
+
+    @backoff_function(ConnectionError)
+    def save_keys(self, state: dict[str, Any], keys: set[str]) -> None:
+        self.redis_adapter.hset(
+            self.name, mapping={key: self.dumps(state[key]) for key in keys}
+        )
+
+    @backoff_function(ConnectionError)
+    def retrieve_state(self) -> Any:
+        fields = self.redis_adapter.hgetall(self.name)
+        if fields:
+            return {
+                key.decode(): json.loads(value)
+                for key, value in fields.items()
+            }
+        if self.legacy_name:
+            legacy = RedisStorage(self.redis_adapter, self.legacy_name)
+            state = legacy.retrieve_state()
+            if state:
+                self.save_state(state)
+                return state
+        return None
+
+
+class MemoryStorage(BaseStorage):
+    """Process-local storage, for positions which are never persisted,
+    e.g. in benchmarks or the source scan of `FanOutPipeline`."""
+
+    def __init__(self) -> None:
+        self.state: dict[str, Any] = {}
+
+    def save_state(self, state: dict[str, Any]) -> None:
+        self.state = dict(state)
+
+    def retrieve_state(self) -> dict[str, Any]:
+        return dict(self.state)
+
+
 class StatefulMixin:
-    """Mixin and state wrapper for classes which require `last_modified` state."""
+    """Mixin and state wrapper for classes which require `last_modified` state.
+
+    The checkpoint is a `(updated_at, id)` keyset position. It is stored as
+    `{"updated_at": ..., "id": ...}`; plain `updated_at` strings written by
+    older versions are still accepted and resume with `id=None`.
+    """
 
     def __init__(self, state: State, state_key: str):
         self.state = state
         self.state_key = state_key
         init_state = self.state.get_state(self.state_key)
 
+        self.last_id: str | None = None
         if init_state is None:
-            self.state.set_state(self.state_key, datetime.min)
-            self.last_modified = datetime.min
+            self.set_last_modified(datetime.min)
+        elif isinstance(init_state, dict):
+            self.last_modified = datetime.fromisoformat(
+                init_state['updated_at']
+            )
+            self.last_id = init_state.get('id')
         else:
             self.last_modified = datetime.fromisoformat(init_state)
 
     def get_last_modified(self) -> datetime:
         return self.last_modified
 
-    def set_last_modified(self, last_modified: datetime) -> None:
+    def get_last_id(self) -> str | None:
+        return self.last_id
+
+    def set_last_modified(
+        self, last_modified: datetime, last_id: str | None = None
+    ) -> None:
         self.last_modified = last_modified
-        self.state.set_state(self.state_key, last_modified)
+        self.last_id = last_id
+        self.state.set_state(
+            self.state_key, {'updated_at': last_modified, 'id': last_id}
+        )
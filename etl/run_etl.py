@@ -1,34 +1,573 @@
-import time
+import argparse
+import asyncio
+import signal
+import sys
+import threading
+from datetime import datetime
+from functools import partial
 from pathlib import Path
+from types import FrameType
 
+from config import (
+    ETL_ENGINE,
+    ETL_FAN_OUT,
+    ETL_METRICS_FILE,
+    ETL_METRICS_PORT,
+    ETL_POLL_INTERVAL,
+    ETL_REINDEX_PARTITIONS,
+    ETL_REINDEX_PROCESSES,
+    ETL_SNAPSHOT_DIR,
+    ETL_SOURCE,
+)
+
+from etl_utils.async_engine import AsyncPipelineScheduler
+from etl_utils.cdc import CdcPipeline, install_replication
+from etl_utils.dead_letters import get_dead_letters
+from etl_utils.dedup import FilmDedup, get_film_dedup
+from etl_utils.elastic_search_handlers import ElasticSearchLoader
+from etl_utils.loggers import setup_logger
+from etl_utils.metrics import get_metrics
+from etl_utils.notifications import PostgresChangeListener, install_triggers
 from etl_utils.pipelines import (
+    BasePipeline,
+    FanOutPipeline,
     FilmETLPipeline,
     GenreETLPipeline,
     PersonETLPipeline,
 )
+from etl_utils.pool import PostgresConnectionPool, close_pool, get_pool
+from etl_utils.postgres_handlers import (
+    PostgresGenreProducer,
+    PostgresPersonProducer,
+    database_now,
+    install_indexes,
+)
+from etl_utils.reindex import IndexRebuilder
+from etl_utils.scheduler import CycleReport, PipelineScheduler, ScheduledRun
+from etl_utils.snapshots import (
+    SnapshotExporter,
+    SnapshotReplayer,
+    read_manifest,
+)
+from etl_utils.state import MemoryStorage, State
 
+logger = setup_logger(__name__)
 
-def main() -> None:
-    states_dir = Path('states').resolve()
-    states_dir.mkdir(parents=True, exist_ok=True)
-    pipelines = {
-        'person_pipeline': PersonETLPipeline(redis_key='person_etl'),
-        'genre_pipeline': GenreETLPipeline(redis_key='genre_etl'),
+# Tables whose change notifications wake each pipeline in daemon mode.
+# Pipelines still select rows by `updated_at`, so a link table change is
+# indexed once the application touches the related row as well.
+PIPELINE_TABLES = {
+    'person_pipeline': {'person', 'person_film_work'},
+    'genre_pipeline': {'genre'},
+    'filmwork_pipeline': {'film_work', 'person_film_work', 'genre_film_work'},
+    'filmwork_by_person_pipeline': {'person', 'person_film_work'},
+    'filmwork_by_genre_pipeline': {'genre', 'genre_film_work'},
+    'person_fan_out': {'person', 'person_film_work'},
+    'genre_fan_out': {'genre', 'genre_film_work'},
+    'cdc_pipeline': {
+        'film_work',
+        'person',
+        'genre',
+        'person_film_work',
+        'genre_film_work',
+    },
+}
+
+# Pipelines fed by one scan of their source table with `ETL_FAN_OUT`:
+# producer of the scan and the pipelines it replaces.
+FAN_OUT_PIPELINES = {
+    'person_fan_out': (
+        PostgresPersonProducer,
+        ['person_pipeline', 'filmwork_by_person_pipeline'],
+    ),
+    'genre_fan_out': (
+        PostgresGenreProducer,
+        ['genre_pipeline', 'filmwork_by_genre_pipeline'],
+    ),
+}
+
+# Pipelines loading every document of an index during a full reindex.
+REINDEX_PIPELINES = {
+    'movies': 'filmwork_pipeline',
+    'genres': 'genre_pipeline',
+    'persons': 'person_pipeline',
+}
+
+# Builders of the id partition pipelines of indices reindexed in parallel
+# processes, with the state keys of the pipelines in `REINDEX_PIPELINES`.
+PARTITIONED_REINDEX = {
+    'movies': partial(
+        FilmETLPipeline,
+        redis_key='reindex_filmwork_etl',
+        table_name='film_work',
+    ),
+}
+
+
+def build_pipelines(
+    pool: PostgresConnectionPool,
+    state_prefix: str = '',
+    dedup: FilmDedup | None = None,
+) -> dict[str, BasePipeline]:
+    return {
+        'person_pipeline': PersonETLPipeline(
+            redis_key=f'{state_prefix}person_etl', pool=pool
+        ),
+        'genre_pipeline': GenreETLPipeline(
+            redis_key=f'{state_prefix}genre_etl', pool=pool
+        ),
         'filmwork_pipeline': FilmETLPipeline(
-            redis_key='filmwork_etl', table_name='film_work'
+            redis_key=f'{state_prefix}filmwork_etl',
+            table_name='film_work',
+            pool=pool,
+            dedup=dedup,
         ),
         'filmwork_by_person_pipeline': FilmETLPipeline(
-            redis_key='filmwork_by_person_etl',
+            redis_key=f'{state_prefix}filmwork_by_person_etl',
             table_name='person',
             enrich=True,
+            pool=pool,
+            dedup=dedup,
         ),
         'filmwork_by_genre_pipeline': FilmETLPipeline(
-            redis_key='filmwork_by_genre_etl', table_name='genre', enrich=True
+            redis_key=f'{state_prefix}filmwork_by_genre_etl',
+            table_name='genre',
+            enrich=True,
+            pool=pool,
+            dedup=dedup,
         ),
     }
-    for _, pipeline in pipelines.items():
-        pipeline.run()
-        time.sleep(3)
+
+
+def build_fan_outs(
+    pipelines: dict[str, BasePipeline], pool: PostgresConnectionPool
+) -> dict[str, ScheduledRun]:
+    """Replaces the pipelines of `FAN_OUT_PIPELINES` by fan-outs, so the
+    persons and the genres are read once per cycle. The pipelines keep
+    their checkpoints and, as sinks, their names in the metrics."""
+    scheduled: dict[str, ScheduledRun] = dict(pipelines)
+    for name, (source_class, sink_names) in FAN_OUT_PIPELINES.items():
+        sinks = []
+        for sink_name in sink_names:
+            sink = pipelines[sink_name]
+            sink.name = sink_name
+            sinks.append(sink)
+            del scheduled[sink_name]
+        source = source_class(
+            State(MemoryStorage()),
+            sinks[0].producer.batch_size,
+            f'{name}_source',
+            pool,
+        )
+        scheduled[name] = FanOutPipeline(name, source, sinks)
+    return scheduled
+
+
+def build_scheduler(
+    fan_out: bool = ETL_FAN_OUT, source: str = ETL_SOURCE
+) -> PipelineScheduler:
+    """Builds the scheduler of the pipelines of the configured source:
+    polling `updated_at`, or logical replication (`cdc`), which feeds every
+    index from one pipeline."""
+    if source == 'cdc':
+        scheduler = PipelineScheduler()
+        scheduler.add('cdc_pipeline', CdcPipeline(pool=get_pool()))
+        return scheduler
+    dedup = get_film_dedup()
+    scheduler = PipelineScheduler(dedup=dedup)
+    pool = get_pool()
+    pipelines = build_pipelines(pool, dedup=dedup)
+    scheduled: dict[str, ScheduledRun] = dict(pipelines)
+    if fan_out:
+        scheduled = build_fan_outs(pipelines, pool)
+    for name, pipeline in scheduled.items():
+        scheduler.add(name, pipeline)
+    return scheduler
+
+
+async def run_async_cycle() -> CycleReport:
+    """Runs every pipeline once in one event loop."""
+    dedup = get_film_dedup()
+    async with AsyncPipelineScheduler(dedup=dedup) as scheduler:
+        for name, pipeline in build_pipelines(get_pool(), dedup=dedup).items():
+            scheduler.add(name, pipeline)
+        return await scheduler.run_cycle()
+
+
+def run_once(args: argparse.Namespace) -> int:
+    """Runs every pipeline once, e.g. from cron, in threads or with the
+    asyncio engine (`--engine`).
+
+    The metrics of the run are written to `ETL_METRICS_FILE`, if set.
+    """
+    scheduler = None
+    try:
+        if args.engine == 'async':
+            report = asyncio.run(run_async_cycle())
+        else:
+            scheduler = build_scheduler()
+            report = scheduler.run_cycle()
+    finally:
+        if scheduler:
+            scheduler.shutdown()
+        close_pool()
+        if ETL_METRICS_FILE:
+            get_metrics().write(ETL_METRICS_FILE)
+    return 1 if report.failed else 0
+
+
+def run_daemon(args: argparse.Namespace) -> int:
+    """Stays resident and runs the pipelines whose tables were changed.
+
+    Every pipeline also runs when no notification arrives for
+    `--poll-interval` seconds, which covers missing triggers and
+    notifications lost while the listener was reconnecting.
+
+    Metrics are served on `ETL_METRICS_PORT`, unless it is 0.
+    """
+    stop = threading.Event()
+
+    def handle_signal(signum: int, frame: FrameType | None) -> None:
+        logger.info('Received signal %d, stopping after current cycle.', signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    scheduler = build_scheduler()
+    listener = PostgresChangeListener()
+    server = None
+    if ETL_METRICS_PORT:
+        server = get_metrics().serve(ETL_METRICS_PORT)
+    try:
+        listener.connect()
+        scheduler.run_cycle()
+        while not stop.is_set():
+            tables = listener.wait(args.poll_interval, stop)
+            if stop.is_set():
+                break
+            if tables is None:
+                scheduler.run_cycle()
+                continue
+            names = [
+                name
+                for name, pipeline_tables in PIPELINE_TABLES.items()
+                if pipeline_tables & tables and name in scheduler.pipelines
+            ]
+            logger.info('Changed tables: %s.', ', '.join(sorted(tables)))
+            if names:
+                scheduler.run_cycle(names)
+    finally:
+        listener.close()
+        scheduler.shutdown()
+        close_pool()
+        if server:
+            server.shutdown()
+            server.server_close()
+    return 0
+
+
+def run_install_triggers(args: argparse.Namespace) -> int:
+    try:
+        install_triggers(get_pool())
+    finally:
+        close_pool()
+    return 0
+
+
+def run_install_indexes(args: argparse.Namespace) -> int:
+    try:
+        install_indexes(get_pool())
+    finally:
+        close_pool()
+    return 0
+
+
+def run_install_cdc(args: argparse.Namespace) -> int:
+    try:
+        install_replication(get_pool())
+    finally:
+        close_pool()
+    return 0
+
+
+def run_reindex(args: argparse.Namespace) -> int:
+    """Rebuilds indices from scratch and swaps their aliases.
+
+    The rebuild keeps its checkpoints under separate keys, so the cron or
+    daemon pipelines keep updating the live index through the alias
+    meanwhile. Movies are loaded by `--partitions` id ranges in separate
+    processes; with `--resume` an interrupted rebuild continues from its
+    checkpoints.
+    """
+    pool = get_pool()
+    pipelines = build_pipelines(pool, state_prefix='reindex_')
+    try:
+        for index in args.indices or REINDEX_PIPELINES:
+            pipeline = pipelines[REINDEX_PIPELINES[index]]
+            catch_up = [
+                other
+                for other in pipelines.values()
+                if other is not pipeline
+                and other.es_loader.index_name == index
+            ]
+            rebuilder = IndexRebuilder(
+                pipeline,
+                catch_up,
+                partitioned=PARTITIONED_REINDEX.get(index),
+                partitions=args.partitions,
+                processes=args.processes,
+            )
+            rebuilder.rebuild(pool, resume=args.resume)
+    finally:
+        close_pool()
+    return 0
+
+
+def run_dlq_replay(args: argparse.Namespace) -> int:
+    """Sends the dead letters to ElasticSearch again.
+
+    Letters of the documents indexed now are dropped, documents failing
+    again stay in the store with their attempts counted.
+    """
+    dead_letters = get_dead_letters()
+    if not dead_letters:
+        logger.error('Dead letters are disabled by ETL_DEAD_LETTERS.')
+        return 1
+    remaining = 0
+    for index in args.indices or dead_letters.indices():
+        letters = dead_letters.letters(index)
+        if not letters:
+            continue
+        loader = ElasticSearchLoader(
+            args.batch_size, index, bulk_threads=1, dead_letters=dead_letters
+        )
+        loader.upload(letter.action for letter in letters)
+        left = len(dead_letters.letters(index))
+        logger.info(
+            '%d of %d dead letters of %s replayed, %d left.',
+            len(letters) - left,
+            len(letters),
+            index,
+            left,
+        )
+        remaining += left
+    return 1 if remaining else 0
+
+
+def run_snapshot_export(args: argparse.Namespace) -> int:
+    """Writes every document of the indices to a snapshot directory.
+
+    The documents are built by the pipelines of `REINDEX_PIPELINES` from
+    scratch, with checkpoints kept under separate keys, so the cron or
+    daemon pipelines are not affected.
+    """
+    pool = get_pool()
+    pipelines = build_pipelines(pool, state_prefix='snapshot_')
+    try:
+        exported_at = database_now(pool)
+        selected = []
+        for index in args.indices or REINDEX_PIPELINES:
+            pipeline = pipelines[REINDEX_PIPELINES[index]]
+            pipeline.producer.set_last_modified(datetime.min)
+            selected.append(pipeline)
+        SnapshotExporter(args.directory).export(selected, exported_at)
+    finally:
+        close_pool()
+    return 0
+
+
+def run_snapshot_replay(args: argparse.Namespace) -> int:
+    """Loads a snapshot into ElasticSearch without reading Postgres.
+
+    Missing indices are created from `SCHEMA_FOLDER`. Rows changed after
+    the export are not in the snapshot: with `--catch-up` the pipelines
+    of the index load them again from the time of the export.
+    """
+    snapshots = read_manifest(Path(args.directory))
+    if not snapshots:
+        logger.error('No snapshot in %s.', args.directory)
+        return 1
+    for index in args.indices or snapshots:
+        if index not in snapshots:
+            logger.error('No snapshot of %s in %s.', index, args.directory)
+            return 1
+    try:
+        pipelines = build_pipelines(get_pool()) if args.catch_up else {}
+        for index in args.indices or snapshots:
+            snapshot = snapshots[index]
+            loader = ElasticSearchLoader(args.batch_size, index)
+            if not loader.es_client.indices.exists(index=index):
+                loader.create_index()
+            elif loader.fingerprints:
+                # Fingerprints describe the documents replaced now.
+                loader.fingerprints.clear(index)
+            loader.index_exists = True
+            SnapshotReplayer(loader, args.directory).replay(snapshot)
+            exported_at = datetime.fromisoformat(snapshot.exported_at)
+            if not args.catch_up:
+                logger.warning(
+                    'Changes made after %s are not in the snapshot of %s, '
+                    'run the pipelines from then to load them.',
+                    snapshot.exported_at,
+                    index,
+                )
+                continue
+            for pipeline in pipelines.values():
+                if pipeline.es_loader.index_name != index:
+                    continue
+                last_modified = pipeline.producer.get_last_modified()
+                if (
+                    last_modified != datetime.min
+                    and last_modified > exported_at
+                ):
+                    pipeline.producer.set_last_modified(exported_at)
+                if pipeline.enricher:
+                    pipeline.enricher.set_last_modified(datetime.min)
+                pipeline.run()
+    finally:
+        close_pool()
+    return 0
+
+
+def main() -> None:
+    states_dir = Path('states').resolve()
+    states_dir.mkdir(parents=True, exist_ok=True)
+
+    parser = argparse.ArgumentParser(
+        description='Loads movies data from Postgres to ElasticSearch.'
+    )
+    parser.set_defaults(handler=run_once, engine=ETL_ENGINE)
+    commands = parser.add_subparsers(title='commands')
+    once = commands.add_parser(
+        'once', help='run every pipeline once (default, e.g. from cron)'
+    )
+    once.add_argument(
+        '--engine',
+        choices=('threads', 'async'),
+        default=ETL_ENGINE,
+        help='psycopg2 pipelines in threads, or asyncpg in one event loop',
+    )
+    once.set_defaults(handler=run_once)
+    daemon = commands.add_parser(
+        'daemon', help='stay resident and wake on Postgres notifications'
+    )
+    daemon.add_argument(
+        '--poll-interval',
+        type=float,
+        default=ETL_POLL_INTERVAL,
+        help='seconds without notifications before polling every table',
+    )
+    daemon.set_defaults(handler=run_daemon)
+    commands.add_parser(
+        'install-triggers',
+        help='create the change notification triggers in Postgres',
+    ).set_defaults(handler=run_install_triggers)
+    commands.add_parser(
+        'install-indexes',
+        help='create the keyset pagination indexes in Postgres',
+    ).set_defaults(handler=run_install_indexes)
+    commands.add_parser(
+        'install-cdc',
+        help='create the publication and replication slot of ETL_SOURCE=cdc',
+    ).set_defaults(handler=run_install_cdc)
+    reindex = commands.add_parser(
+        'reindex',
+        help='rebuild indices into new versions and swap their aliases',
+    )
+    reindex.add_argument(
+        'indices',
+        nargs='*',
+        metavar='INDEX',
+        help=f'indices to rebuild: {", ".join(REINDEX_PIPELINES)} (default: all)',
+    )
+    reindex.add_argument(
+        '--partitions',
+        type=int,
+        default=ETL_REINDEX_PARTITIONS,
+        help='id ranges of movies loaded in separate processes',
+    )
+    reindex.add_argument(
+        '--processes',
+        type=int,
+        default=ETL_REINDEX_PROCESSES,
+        help='partitions loaded at the same time',
+    )
+    reindex.add_argument(
+        '--resume',
+        action='store_true',
+        help='continue an interrupted rebuild from its checkpoints',
+    )
+    reindex.set_defaults(handler=run_reindex)
+
+    dlq_replay = commands.add_parser(
+        'dlq-replay',
+        help='send the documents which failed to index again',
+    )
+    dlq_replay.add_argument(
+        'indices',
+        nargs='*',
+        metavar='INDEX',
+        help='indices to replay (default: all with dead letters)',
+    )
+    dlq_replay.add_argument(
+        '--batch-size',
+        type=int,
+        default=128,
+        help='documents per bulk request',
+    )
+    dlq_replay.set_defaults(handler=run_dlq_replay)
+
+    snapshot_export = commands.add_parser(
+        'snapshot-export',
+        help='write the documents of indices to gzipped NDJSON files',
+    )
+    snapshot_export.add_argument(
+        'indices',
+        nargs='*',
+        metavar='INDEX',
+        help=f'indices to export: {", ".join(REINDEX_PIPELINES)} (default: all)',
+    )
+    snapshot_export.add_argument(
+        '--directory',
+        default=ETL_SNAPSHOT_DIR,
+        help='directory of the snapshot',
+    )
+    snapshot_export.set_defaults(handler=run_snapshot_export)
+
+    snapshot_replay = commands.add_parser(
+        'snapshot-replay',
+        help='load an exported snapshot into ElasticSearch',
+    )
+    snapshot_replay.add_argument(
+        'indices',
+        nargs='*',
+        metavar='INDEX',
+        help='indices to load (default: all in the snapshot)',
+    )
+    snapshot_replay.add_argument(
+        '--directory',
+        default=ETL_SNAPSHOT_DIR,
+        help='directory of the snapshot',
+    )
+    snapshot_replay.add_argument(
+        '--batch-size',
+        type=int,
+        default=128,
+        help='documents per bulk request of failed documents sent again',
+    )
+    snapshot_replay.add_argument(
+        '--catch-up',
+        action='store_true',
+        help='then load the changes made since the export by the pipelines',
+    )
+    snapshot_replay.set_defaults(handler=run_snapshot_replay)
+
+    args = parser.parse_args()
+    for index in getattr(args, 'indices', None) or []:
+        if index not in REINDEX_PIPELINES:
+            parser.error(f'unknown index {index!r}')
+    sys.exit(args.handler(args))
 
 
 if __name__ == '__main__':
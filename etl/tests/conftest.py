@@ -0,0 +1,9 @@
+import os
+import sys
+from pathlib import Path
+
+# The ETL modules are imported from the `etl` directory, as by `run_etl.py`;
+# the tests don't use the Redis stores.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('ETL_DEAD_LETTERS', 'off')
+os.environ.setdefault('ETL_FINGERPRINTS', 'off')
@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Any
+
+from elastic_transport import ConnectionError, JsonSerializer
+
+from etl_utils.async_engine import AsyncElasticSearchLoader
+from etl_utils.bulk import AdaptiveChunkSize, ParallelBulkUploader
+from etl_utils.elastic_search_handlers import ElasticSearchLoader
+from etl_utils.fingerprints import FingerprintStore, SqliteFingerprintStore
+
+
+class Response:
+    def __init__(self, body: dict[str, Any]):
+        self.body = body
+
+
+class Serializers:
+    def get_serializer(self, mimetype: str) -> JsonSerializer:
+        return JsonSerializer()
+
+
+class Transport:
+    serializers = Serializers()
+
+
+class StubElasticsearch:
+    """Indexes bulk actions into `documents`, failing the first `down`
+    requests before they reach the index."""
+
+    def __init__(self, down: int = 0):
+        self.transport = Transport()
+        self.documents: dict[str, Any] = {}
+        self.down = down
+
+    def options(self, **kwargs: Any) -> StubElasticsearch:
+        return self
+
+    def bulk(self, operations: list[bytes], **kwargs: Any) -> Response:
+        if self.down:
+            self.down -= 1
+            raise ConnectionError('ElasticSearch is down')
+        lines = iter(json.loads(line) for line in operations)
+        items = []
+        for header in lines:
+            ((op, meta),) = header.items()
+            id_, status = meta['_id'], 200
+            if op == 'delete':
+                status = 200 if self.documents.pop(id_, None) else 404
+            elif op == 'update':
+                body = next(lines)
+                if id_ in self.documents:
+                    updates = self.documents[id_].setdefault('_updates', [])
+                    updates.append(body)
+                else:
+                    status = 404
+            else:
+                self.documents[id_] = next(lines)
+            items.append({op: {'_id': id_, 'status': status}})
+        errors = any(
+            result['status'] >= 300
+            for item in items
+            for result in item.values()
+        )
+        return Response({'errors': errors, 'items': items})
+
+
+class SlowStubElasticsearch(StubElasticsearch):
+    """Answers the requests with the first version of a document late."""
+
+    def bulk(self, operations: list[bytes], **kwargs: Any) -> Response:
+        if any(b'"first"' in line for line in operations):
+            time.sleep(0.2)
+        return super().bulk(operations, **kwargs)
+
+
+class AsyncStubElasticsearch(StubElasticsearch):
+    def options(self, **kwargs: Any) -> AsyncStubElasticsearch:
+        return self
+
+    async def bulk(  # type: ignore[override]
+        self, operations: list[bytes], **kwargs: Any
+    ) -> Response:
+        return StubElasticsearch.bulk(self, operations, **kwargs)
+
+
+def documents() -> list[dict[str, Any]]:
+    return [
+        {'_id': 'a', 'title': 'first'},
+        {'_id': 'b', 'title': 'other'},
+        {'_id': 'a', 'title': 'second'},
+    ]
+
+
+def build_loader(
+    es_client: StubElasticsearch,
+    fingerprints: FingerprintStore | None = None,
+) -> ElasticSearchLoader:
+    loader = ElasticSearchLoader(
+        2, 'movies', bulk_threads=1, fingerprints=fingerprints
+    )
+    loader.es_client = es_client  # type: ignore[assignment]
+    loader.index_exists = True
+    return loader
+
+
+def test_upload_streaming_duplicate_ids() -> None:
+    es_client = StubElasticsearch()
+    loader = build_loader(es_client)
+
+    errors = loader.upload_streaming(documents())
+
+    assert errors == []
+    assert loader.stats.documents == 3
+    assert es_client.documents['a'] == {'title': 'second'}
+
+
+def test_upload_streaming_duplicate_ids_after_transport_error() -> None:
+    es_client = StubElasticsearch(down=1)
+    loader = build_loader(es_client)
+
+    errors = loader.upload_streaming(documents())
+
+    assert errors == []
+    assert loader.stats.documents == 3
+    assert es_client.documents['a'] == {'title': 'second'}
+
+
+def test_upload_parallel_duplicate_ids_across_chunks() -> None:
+    es_client = SlowStubElasticsearch()
+    uploader = ParallelBulkUploader(
+        es_client,  # type: ignore[arg-type]
+        AdaptiveChunkSize(1, minimum=1, maximum=1),
+        threads=2,
+    )
+
+    stats = uploader.upload(documents(), 'movies')
+
+    assert stats.errors == []
+    assert stats.documents == 3
+    assert es_client.documents['a'] == {'title': 'second'}
+
+
+def test_async_upload_streaming_duplicate_ids() -> None:
+    es_client = AsyncStubElasticsearch(down=1)
+    loader = AsyncElasticSearchLoader(
+        build_loader(StubElasticsearch()),
+        es_client,  # type: ignore[arg-type]
+        asyncio.Lock(),
+    )
+
+    errors = asyncio.run(loader.upload_streaming(documents()))
+
+    assert errors == []
+    assert loader.loader.stats.documents == 3
+    assert es_client.documents['a'] == {'title': 'second'}
+
+
+def test_upload_forgets_fingerprint_of_updated_document(
+    tmp_path: Path,
+) -> None:
+    fingerprints = SqliteFingerprintStore(tmp_path / 'fingerprints.sqlite3')
+    es_client = StubElasticsearch()
+    loader = build_loader(es_client, fingerprints)
+    update = {'_op_type': 'update', '_id': 'a', 'script': {'source': ''}}
+
+    loader.upload(action for action in [documents()[0], update])
+
+    assert es_client.documents['a']['_updates'] == [{'script': {'source': ''}}]
+    assert fingerprints.get('movies', ['a']) == [None]
+
+
+def test_upload_drops_update_of_missing_document() -> None:
+    es_client = StubElasticsearch()
+    loader = build_loader(es_client)
+    update = {'_op_type': 'update', '_id': 'c', 'script': {'source': ''}}
+
+    loader.upload(action for action in [documents()[0], update])
+
+    assert es_client.documents == {'a': {'title': 'first'}}
@@ -0,0 +1,280 @@
+from __future__ import annotations
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, cast
+
+import psycopg2.extras
+from psycopg2 import sql
+
+from etl_utils.cdc import (
+    Begin,
+    ChangeBatch,
+    Commit,
+    LogicalReplicationSource,
+    PgOutputDecoder,
+    Relation,
+    RowChange,
+    format_lsn,
+    install_replication,
+)
+from etl_utils.pool import PostgresConnectionPool
+from etl_utils.state import MemoryStorage, State
+
+# `pgoutput` messages, protocol version 1, captured from Postgres 16 with
+# `pg_logical_slot_get_binary_changes` on `content.genre` and on
+# `content.person_film_work` with `REPLICA IDENTITY FULL`.
+GENRE = bytes.fromhex(
+    '52000047a1636f6e74656e740067656e7265006400030169640000000b86ffffffff'
+    '006e616d650000000019ffffffff006465736372697074696f6e0000000019ffffff'
+    'ff'
+)
+LINK = bytes.fromhex(
+    '52000047a8636f6e74656e7400706572736f6e5f66696c6d5f776f726b0066000401'
+    '69640000000b86ffffffff0166696c6d5f776f726b5f69640000000b86ffffffff01'
+    '706572736f6e5f69640000000b86ffffffff01726f6c650000000019ffffffff'
+)
+# Inserted genre 'Drama', in its own transaction.
+BEGIN = bytes.fromhex('42000000001275b8a0000301173d06e2f90000053b')
+INSERT = bytes.fromhex(
+    '49000047a14e0003740000002436643066366138652d316334612d346138632d3966'
+    '34362d38643266356132633165303174000000054472616d616e'
+)
+COMMIT = bytes.fromhex(
+    '4300000000001275b8a0000000001275b8d0000301173d06e2f9'
+)
+# Renamed genre, its TOASTed description unchanged, in its own transaction.
+RENAME_BEGIN = bytes.fromhex('42000000001275e2f8000301173d06ed510000053d')
+RENAME = bytes.fromhex(
+    '55000047a14e0003740000002436643066366138652d316334612d346138632d3966'
+    '34362d386432663561326331653032740000000946696c6d206e6f697275'
+)
+RENAME_COMMIT = bytes.fromhex(
+    '4300000000001275e2f8000000001275e328000301173d06ed51'
+)
+# Genre 'Drama' with a new id.
+KEY_UPDATE = bytes.fromhex(
+    '55000047a14b0003740000002436643066366138652d316334612d346138632d3966'
+    '34362d3864326635613263316530316e6e4e0003740000002436643066366138652d'
+    '316334612d346138632d396634362d38643266356132633165303374000000054472'
+    '616d616e'
+)
+# Role of a link changed from 'actor' to 'director', then the link deleted.
+LINK_UPDATE = bytes.fromhex(
+    '55000047a84f0004740000002461306231633264332d653466352d346136622d3863'
+    '37642d396530663161326233633031740000002462376131653063322d336435662d'
+    '346536612d386239632d306431653266336134623031740000002463346435653666'
+    '372d306131622d346332642d396533662d3461356236633764386530317400000005'
+    '6163746f724e0004740000002461306231633264332d653466352d346136622d3863'
+    '37642d396530663161326233633031740000002462376131653063322d336435662d'
+    '346536612d386239632d306431653266336134623031740000002463346435653666'
+    '372d306131622d346332642d396533662d3461356236633764386530317400000008'
+    '6469726563746f72'
+)
+LINK_DELETE = bytes.fromhex(
+    '44000047a84f0004740000002461306231633264332d653466352d346136622d3863'
+    '37642d396530663161326233633031740000002462376131653063322d336435662d'
+    '346536612d386239632d306431653266336134623031740000002463346435653666'
+    '372d306131622d346332642d396533662d3461356236633764386530317400000008'
+    '6469726563746f72'
+)
+TRUNCATE = bytes.fromhex('540000000100000047a8')
+
+DRAMA = '6d0f6a8e-1c4a-4a8c-9f46-8d2f5a2c1e01'
+NOIR = '6d0f6a8e-1c4a-4a8c-9f46-8d2f5a2c1e02'
+DRAMA_NEW_ID = '6d0f6a8e-1c4a-4a8c-9f46-8d2f5a2c1e03'
+LINK_ROW = {
+    'id': 'a0b1c2d3-e4f5-4a6b-8c7d-9e0f1a2b3c01',
+    'film_work_id': 'b7a1e0c2-3d5f-4e6a-8b9c-0d1e2f3a4b01',
+    'person_id': 'c4d5e6f7-0a1b-4c2d-9e3f-4a5b6c7d8e01',
+}
+
+
+def decoder(*relations: bytes) -> PgOutputDecoder:
+    decoder = PgOutputDecoder()
+    for relation in relations:
+        assert decoder.decode(relation) is None
+    return decoder
+
+
+def test_decode_transaction_boundaries() -> None:
+    begin = decoder().decode(BEGIN)
+    commit = decoder().decode(COMMIT)
+
+    assert isinstance(begin, Begin) and isinstance(commit, Commit)
+    assert begin.final_lsn == commit.lsn == 0x1275B8A0
+    assert begin.xid == 0x53B
+    assert commit.end_lsn == 0x1275B8D0
+    assert begin.committed_at == commit.committed_at
+    assert isinstance(commit.committed_at, datetime)
+    assert commit.committed_at.year == 2026
+
+
+def test_decode_relation_and_insert() -> None:
+    change = decoder(GENRE).decode(INSERT)
+
+    assert change == RowChange(
+        Relation('content', 'genre', ['id', 'name', 'description']),
+        'I',
+        new={'id': DRAMA, 'name': 'Drama', 'description': None},
+    )
+
+
+def test_decode_update_leaves_out_unchanged_toast_value() -> None:
+    change = decoder(GENRE).decode(RENAME)
+
+    assert isinstance(change, RowChange)
+    assert change.operation == 'U'
+    assert change.new == {'id': NOIR, 'name': 'Film noir'}
+    assert change.old == {}
+
+
+def test_decode_update_of_key() -> None:
+    change = decoder(GENRE).decode(KEY_UPDATE)
+    batch = ChangeBatch()
+    assert isinstance(change, RowChange)
+    batch.add(change)
+
+    assert change.old == {'id': DRAMA, 'name': None, 'description': None}
+    assert change.new['id'] == DRAMA_NEW_ID
+    assert batch.genres == {DRAMA, DRAMA_NEW_ID}
+    assert batch.enrich['genre'] == {DRAMA_NEW_ID}
+
+
+def test_decode_update_and_delete_with_full_identity() -> None:
+    decoded = decoder(LINK)
+    update = decoded.decode(LINK_UPDATE)
+    delete = decoded.decode(LINK_DELETE)
+
+    assert isinstance(update, RowChange) and isinstance(delete, RowChange)
+    assert update.old == {**LINK_ROW, 'role': 'actor'}
+    assert update.new == {**LINK_ROW, 'role': 'director'}
+    assert delete.operation == 'D'
+    assert delete.old == {**LINK_ROW, 'role': 'director'}
+    assert delete.new == {}
+
+
+def test_decode_truncate() -> None:
+    relations = decoder(LINK).decode(TRUNCATE)
+
+    assert isinstance(relations, list)
+    assert [relation.name for relation in relations] == ['person_film_work']
+
+
+@dataclass
+class Message:
+    payload: bytes
+
+
+@dataclass
+class StubReplicationCursor:
+    """Sends the `messages` of a slot, then reports that nothing is left."""
+
+    messages: list[bytes]
+    wal_end: int = 0
+    closed: bool = False
+    feedback: list[int] = field(default_factory=list)
+
+    def read_message(self) -> Message | None:
+        if not self.messages:
+            return None
+        return Message(self.messages.pop(0))
+
+    def send_feedback(self, flush_lsn: int, force: bool) -> None:
+        self.feedback.append(flush_lsn)
+
+
+class StubReplicationSource(LogicalReplicationSource):
+    def __init__(self, state: State, cursor: StubReplicationCursor):
+        super().__init__(state, batch_size=1, idle_timeout=0)
+        self.stub_cursor = cursor
+
+    def connect(self) -> psycopg2.extras.ReplicationCursor:
+        self.cursor = cast(Any, self.stub_cursor)
+        return self.cursor
+
+
+def test_restart_skips_saved_transactions() -> None:
+    storage = MemoryStorage()
+    stream = [
+        GENRE, BEGIN, INSERT, COMMIT, RENAME_BEGIN, RENAME, RENAME_COMMIT
+    ]
+    cursor = StubReplicationCursor(list(stream), wal_end=0x1275E328)
+    source = StubReplicationSource(State(storage), cursor)
+
+    first = next(source.batches())
+    source.commit(first)
+
+    assert first.genres == {DRAMA}
+    assert cursor.feedback == [0x1275B8D0]
+    # The process stops before the slot has the confirmation, so the slot
+    # sends both transactions again.
+    cursor = StubReplicationCursor(list(stream), wal_end=0x1275E328)
+    restarted = StubReplicationSource(State(storage), cursor)
+    assert restarted.lsn == 0x1275B8D0
+
+    batches = []
+    for batch in restarted.batches():
+        restarted.commit(batch)
+        batches.append(batch)
+
+    assert [batch.genres for batch in batches] == [{NOIR}]
+    assert cursor.feedback == [0x1275E328]
+    saved = State(storage).get_state('cdc_lsn')
+    assert saved and saved['lsn'] == format_lsn(0x1275E328)
+
+
+class StubConnection:
+    """Records the queries of `install_replication` on a server running
+    with `wal_level = logical`."""
+
+    def __init__(self) -> None:
+        self.queries: list[Any] = []
+
+    def __enter__(self) -> StubConnection:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+    def cursor(self) -> StubConnection:
+        return self
+
+    def execute(self, query: Any, params: Any = None) -> None:
+        self.queries.append(query)
+
+    def fetchone(self) -> tuple[str]:
+        return ('logical',)
+
+    def commit(self) -> None:
+        pass
+
+
+class StubPool:
+    def __init__(self) -> None:
+        self.conn = StubConnection()
+
+    @contextmanager
+    def connection(self) -> Iterator[StubConnection]:
+        yield self.conn
+
+
+def test_install_replication_renders_publication() -> None:
+    pool = StubPool()
+
+    install_replication(
+        cast(PostgresConnectionPool, pool), publication='etl_films'
+    )
+
+    (script,) = [
+        query
+        for query in pool.conn.queries
+        if isinstance(query, sql.Composed)
+    ]
+    assert sql.Identifier('etl_films') in script.seq
+    assert sql.Literal('etl_films') in script.seq
+    assert 'etl_cdc' not in ''.join(
+        part.string for part in script.seq if isinstance(part, sql.SQL)
+    )